@@ -1,7 +1,23 @@
 __all__ = ["PyQtMapView", "Marker", "Path", "Buttons", "OfflineLoader"]
 
-from .mapView import PyQtMapView
-from .element import Marker
-from .element import Path
-from .element import Buttons
-from .offline_loading import OfflineLoader
\ No newline at end of file
+import importlib
+
+# the widgets are imported on first use, so modules without a GUI dependency
+# (e.g. the seeding command python -m PyQtMapView.seed) can be used without PyQt5
+_modules = {"PyQtMapView": ".mapView",
+            "Marker": ".element",
+            "Path": ".element",
+            "Buttons": ".element",
+            "OfflineLoader": ".offline_loading"}
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_modules[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
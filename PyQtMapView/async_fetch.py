@@ -0,0 +1,128 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Dict, NamedTuple, Union
+from urllib.parse import urlsplit
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency, only needed for the asyncio backend
+    aiohttp = None
+
+from .tile_http import USER_AGENT
+
+
+class TileResponse(NamedTuple):
+    url: str
+    status: int
+    content: bytes
+    headers: Dict[str, str]
+
+
+class AsyncTileFetcher:
+    """ Tile fetch engine running one asyncio event loop on a background thread.
+
+        Thousands of requests can be in flight at once; a semaphore per host limits how many of
+        them are sent to the same server concurrently. Failed requests (connection errors, timeouts,
+        429 and 5xx answers) are retried with exponential backoff. submit() is thread-safe and
+        returns a concurrent.futures.Future of a TileResponse, its done callbacks run on the
+        event loop thread. One fetcher can be shared by every map view and loader of a process. """
+
+    def __init__(self, maxRequestsPerHost: int = 16, timeout: float = 10, retries: int = 2, retryDelay: float = 0.5):
+        if aiohttp is None:
+            raise ImportError("AsyncTileFetcher requires the aiohttp package")
+        self.maxRequestsPerHost = maxRequestsPerHost
+        self.timeout = timeout
+        self.retries = retries
+        self.retryDelay = retryDelay
+
+        self.__semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.__lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(daemon=True, target=self.loop.run_forever, name="AsyncTileFetcher")
+        self.thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self.__createSession(), self.loop).result()
+
+    async def __createSession(self) -> "aiohttp.ClientSession":
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.maxRequestsPerHost)
+        return aiohttp.ClientSession(connector=connector,
+                                     headers={"User-Agent": USER_AGENT},
+                                     timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def submit(self, url: str, headers: Union[Dict[str, str], None] = None) -> Future:
+        """ schedules a request and returns a future of its TileResponse """
+        with self.__lock:
+            self.submitted += 1
+        future = asyncio.run_coroutine_threadsafe(self.__fetch(url, headers), self.loop)
+        future.add_done_callback(self.__countResult)
+        return future
+
+    def fetch(self, url: str, headers: Union[Dict[str, str], None] = None) -> TileResponse:
+        """ blocking request, for callers that are already running in a worker thread """
+        return self.submit(url, headers).result()
+
+    def __countResult(self, future: Future):
+        with self.__lock:
+            if future.cancelled() or future.exception() is not None:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    async def __fetch(self, url: str, headers: Union[Dict[str, str], None]) -> TileResponse:
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        semaphore = self.__semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.__semaphores[host] = asyncio.Semaphore(self.maxRequestsPerHost)
+
+        attempt = 0
+        while True:
+            try:
+                async with semaphore:
+                    async with self.session.get(url, headers=headers) as response:
+                        content = await response.read()
+                        result = TileResponse(url, response.status, content, dict(response.headers))
+                if (result.status == 429 or result.status >= 500) and attempt < self.retries:
+                    raise aiohttp.ClientResponseError(response.request_info, (), status=result.status)
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+            attempt += 1
+            with self.__lock:
+                self.retried += 1
+            await asyncio.sleep(self.retryDelay * 2 ** (attempt - 1))
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of requests submitted, completed, failed, retried and still in flight """
+        with self.__lock:
+            return {"submitted": self.submitted,
+                    "completed": self.completed,
+                    "failed": self.failed,
+                    "retried": self.retried,
+                    "inFlight": self.submitted - self.completed - self.failed}
+
+    def close(self):
+        """ closes the HTTP session and stops the event loop thread """
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+
+_sharedFetcher: Union[AsyncTileFetcher, None] = None
+_sharedFetcherLock = threading.Lock()
+
+
+def getAsyncFetcher() -> AsyncTileFetcher:
+    """ returns the fetcher shared by the whole process, created on first use """
+    global _sharedFetcher
+    with _sharedFetcherLock:
+        if _sharedFetcher is None:
+            _sharedFetcher = AsyncTileFetcher()
+        return _sharedFetcher
@@ -0,0 +1,274 @@
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, NamedTuple, Union
+
+from .tile_store import connectReader, connectWriter
+
+
+DEFAULT_DISK_CACHE_SIZE = 1024 * 1024 * 1024
+DEFAULT_MAX_AGE = 7 * 24 * 3600  # used when the server sends no Cache-Control or Expires header
+
+
+class CacheEntry(NamedTuple):
+    data: bytes
+    etag: Union[str, None]
+    lastModified: Union[str, None]
+    expires: float
+    fetched: float
+
+    @property
+    def fresh(self) -> bool:
+        return self.expires > time.time()
+
+    def conditionalHeaders(self) -> Dict[str, str]:
+        """ request headers that let the server answer 304 Not Modified if the tile did not change """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified:
+            headers["If-Modified-Since"] = self.lastModified
+        return headers
+
+
+def expiryTime(headers: Mapping[str, str], now: float, defaultMaxAge: float = DEFAULT_MAX_AGE) -> float:
+    """ returns the time until which a response may be used without revalidation, header names in lower case """
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() in ("no-cache", "no-store"):
+            return now
+        if name.lower() == "max-age":
+            try:
+                return now + int(value.strip('"'))
+            except ValueError:
+                pass
+    if "expires" in headers:
+        try:
+            return parsedate_to_datetime(headers["expires"]).timestamp()
+        except (TypeError, ValueError):
+            return now
+    return now + defaultMaxAge
+
+
+class DiskTileCache:
+    """ Persistent write-through cache of tiles fetched from tile servers.
+
+        Tiles are stored in one SQLite file together with their ETag, Last-Modified and expiry time,
+        so stale tiles can be revalidated with conditional requests. Writes are queued and committed
+        in batches by a background thread; when the file grows over maxBytes the least recently used
+        tiles are deleted. Every thread reads through its own connection. """
+
+    def __init__(self, path: str, maxBytes: int = DEFAULT_DISK_CACHE_SIZE, defaultMaxAge: float = DEFAULT_MAX_AGE,
+                 batchSize: int = 64, flushInterval: float = 1.0):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.defaultMaxAge = defaultMaxAge
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL;")
+        connection.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                    server TEXT NOT NULL,
+                                    zoom INTEGER NOT NULL,
+                                    x INTEGER NOT NULL,
+                                    y INTEGER NOT NULL,
+                                    data BLOB NOT NULL,
+                                    etag TEXT,
+                                    last_modified TEXT,
+                                    expires REAL NOT NULL,
+                                    fetched REAL NOT NULL,
+                                    accessed REAL NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    PRIMARY KEY (server, zoom, x, y));""")
+        connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);")
+        connection.commit()
+        self.bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache;").fetchone()[0]
+        connection.close()
+
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__pending: Dict[tuple, CacheEntry] = {}  # written but not yet committed
+        self.__writeQueue: "queue.Queue[Union[tuple, None]]" = queue.Queue()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+        self.__writer = threading.Thread(daemon=True, target=self.__writeLoop, name="DiskTileCache")
+        self.__writer.start()
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = connectReader(self.path)
+            self.__local.connection = connection
+        return connection
+
+    def get(self, server: str, zoom: int, x: int, y: int) -> Union[CacheEntry, None]:
+        """ returns the stored tile, fresh or stale, or None """
+        key = (server, zoom, x, y)
+        with self.__lock:
+            entry = self.__pending.get(key)
+        if entry is None:
+            try:
+                row = self.__connection().execute("SELECT data, etag, last_modified, expires, fetched FROM cache "
+                                                  "WHERE server=? AND zoom=? AND x=? AND y=?;", key).fetchone()
+            except sqlite3.Error:
+                row = None
+            entry = CacheEntry(*row) if row is not None else None
+        with self.__lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.__writeQueue.put(("touch", key, time.time()))
+        return entry
+
+    def put(self, server: str, zoom: int, x: int, y: int, data: bytes, headers: Mapping[str, str]) -> CacheEntry:
+        """ stores a tile received with status 200 """
+        now = time.time()
+        headers = {name.lower(): value for name, value in headers.items()}
+        entry = CacheEntry(data, headers.get("etag"), headers.get("last-modified"),
+                           expiryTime(headers, now, self.defaultMaxAge), now)
+        key = (server, zoom, x, y)
+        with self.__lock:
+            self.__pending[key] = entry
+            self.writes += 1
+        self.__writeQueue.put(("put", key, entry))
+        return entry
+
+    def revalidated(self, server: str, zoom: int, x: int, y: int, entry: CacheEntry, headers: Mapping[str, str]) -> CacheEntry:
+        """ records a 304 Not Modified answer, the stored tile becomes fresh again """
+        now = time.time()
+        headers = {name.lower(): value for name, value in headers.items()}
+        entry = entry._replace(etag=headers.get("etag", entry.etag),
+                               lastModified=headers.get("last-modified", entry.lastModified),
+                               expires=expiryTime(headers, now, self.defaultMaxAge), fetched=now)
+        key = (server, zoom, x, y)
+        with self.__lock:
+            self.__pending[key] = entry
+            self.revalidations += 1
+        self.__writeQueue.put(("put", key, entry))
+        return entry
+
+    def flush(self, timeout: Union[float, None] = None) -> bool:
+        """ waits until every queued write is committed """
+        marker = ("flush", threading.Event())
+        self.__writeQueue.put(marker)
+        return marker[1].wait(timeout)
+
+    def close(self):
+        self.flush()
+        self.__writeQueue.put(None)
+        self.__writer.join()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """ Returns hits, misses, writes, revalidations, evictions, bytes and maxBytes """
+        with self.__lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "writes": self.writes,
+                    "revalidations": self.revalidations,
+                    "evictions": self.evictions,
+                    "pendingWrites": len(self.__pending),
+                    "bytes": self.bytes,
+                    "maxBytes": self.maxBytes}
+
+    def __writeLoop(self):
+        connection = connectWriter(self.path)
+        running = True
+        while running:
+            batch = [self.__writeQueue.get()]
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < self.batchSize and batch[-1] is not None and batch[-1][0] != "flush":
+                try:
+                    batch.append(self.__writeQueue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+            self.__commit(connection, batch)
+        connection.close()
+
+    def __commit(self, connection: sqlite3.Connection, batch: list):
+        puts: Dict[tuple, CacheEntry] = {}
+        touches: Dict[tuple, float] = {}
+        for operation in batch:
+            if operation[0] == "put":
+                puts[operation[1]] = operation[2]
+            elif operation[0] == "touch":
+                touches[operation[1]] = operation[2]
+
+        added = 0
+        try:
+            with connection:
+                for key, entry in puts.items():
+                    old = connection.execute("SELECT size FROM cache WHERE server=? AND zoom=? AND x=? AND y=?;", key).fetchone()
+                    added += len(entry.data) - (old[0] if old else 0)
+                    connection.execute("INSERT OR REPLACE INTO cache (server, zoom, x, y, data, etag, last_modified, "
+                                       "expires, fetched, accessed, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                                       (*key, entry.data, entry.etag, entry.lastModified, entry.expires, entry.fetched,
+                                        entry.fetched, len(entry.data)))
+                connection.executemany("UPDATE cache SET accessed=? WHERE server=? AND zoom=? AND x=? AND y=?;",
+                                       [(accessed, *key) for key, accessed in touches.items()])
+        except sqlite3.Error:
+            # the transaction was rolled back, nothing was added
+            added = 0
+
+        with self.__lock:
+            self.bytes += added
+            for key, entry in puts.items():
+                if self.__pending.get(key) is entry:
+                    del self.__pending[key]
+        if self.bytes > self.maxBytes:
+            self.__evict(connection)
+
+        for operation in batch:
+            if operation[0] == "flush":
+                operation[1].set()
+
+    def __evict(self, connection: sqlite3.Connection):
+        # delete least recently used tiles until the cache is 10% below its quota
+        target = self.maxBytes * 0.9
+        removed = 0
+        rows = connection.execute("SELECT server, zoom, x, y, size FROM cache ORDER BY accessed;")
+        victims = []
+        for row in rows:
+            if self.bytes - removed <= target:
+                break
+            victims.append(row[:4])
+            removed += row[4]
+        rows.close()
+        try:
+            with connection:
+                connection.executemany("DELETE FROM cache WHERE server=? AND zoom=? AND x=? AND y=?;", victims)
+        except sqlite3.Error:
+            return
+        with self.__lock:
+            self.bytes -= removed
+            self.evictions += len(victims)
+
+
+_caches: Dict[str, DiskTileCache] = {}
+_cachesLock = threading.Lock()
+
+
+def getDiskCache(path: str, maxBytes: int = DEFAULT_DISK_CACHE_SIZE) -> DiskTileCache:
+    """ returns the disk cache shared by every map view using the same file """
+    path = os.path.abspath(path)
+    with _cachesLock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = DiskTileCache(path, maxBytes)
+            atexit.register(cache.close)
+        return cache
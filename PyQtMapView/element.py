@@ -343,6 +343,10 @@ class Path(QGraphicsLineItem):
         """Returns the number of path segments."""
         return self.__segments
     
+    def getPositions(self) -> list[tuple]:
+        """Returns the positions (lat, lon) of the path, starting with the start position."""
+        return [position for position, _ in self.__positionList]
+    
     def updateColorLine(self, segment: int, color: str):
         """Changing the color of a path segment.
  
@@ -12,12 +12,31 @@ import threading
 import time
 import io
 import sqlite3
+import weakref
 import geocoder
+from collections import deque
 from typing import Callable, List, Dict, Union, Tuple
 from functools import partial
+from concurrent.futures import Future
 
 from .element import Tile, Marker, Buttons, Path
 from .utility_functions import decimal_to_osm, osm_to_decimal
+from .tile_cache import TileCache, DEFAULT_CACHE_SIZE
+from .tile_scheduler import TileLoadScheduler
+from .tile_inflight import InFlightTable
+from .tile_http import getTileClient, legacyServerUrl, formatTileUrl, DEFAULT_SUBDOMAINS
+from .async_fetch import AsyncTileFetcher
+from .disk_cache import DiskTileCache, CacheEntry, getDiskCache, DEFAULT_DISK_CACHE_SIZE
+from .tile_prefetch import PrefetchPlanner
+from .tile_failures import NegativeTileCache, getCircuitBreaker, retryAfterSeconds
+from .tile_rate_limit import getRateLimiter
+from .mbtiles import MBTilesStore, isMBTiles
+from .tile_archive import TileArchive, isTileArchive, ARCHIVE_EXTENSION
+from .tile_store import connectReader, tileHash
+
+
+# default directory of offline databases and the disk cache
+DEFAULT_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "TileStorage")
 
 
 class PyQtMapView(QGraphicsView):
@@ -27,6 +46,12 @@ class PyQtMapView(QGraphicsView):
                  dataPath: str | None = None,
                  useDatabaseOnly: bool = False,
                  buttons: bool = True,
+                 cacheSize: int = DEFAULT_CACHE_SIZE,
+                 loadThreads: int = 25,
+                 fetcher: Union[AsyncTileFetcher, None] = None,
+                 diskCacheSize: int = DEFAULT_DISK_CACHE_SIZE,
+                 uploadBudget: float = 6.0,
+                 prefetchRate: float = 20,
                  **kwargs):
         super().__init__(*args, **kwargs)
         # qSetMessagePattern('%{appname} %{file} %{function} %{line} %{threadid}  %{backtrace depth=10 separator=\"\n\"}')
@@ -51,17 +76,20 @@ class PyQtMapView(QGraphicsView):
         # map layers
         self.mapLayers: list[dict] = []
         self.mapLayers.append({'nameMap': 'Open Street Map',
-                                        'tileServer': 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png',
+                                        'tileServer': 'https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',
+                                        'subdomains': ('a', 'b', 'c'),
                                         'tileSize': 256,
                                         'nameDir': 'OpenStreetMap',
                                         'maxZoom': 19})
         self.mapLayers.append({'nameMap': 'Google satellite',
-                                        'tileServer': 'https://mt0.google.com/vt/lyrs=s&hl=en&x={x}&y={y}&z={z}&s=Ga',
+                                        'tileServer': 'https://mt{s}.google.com/vt/lyrs=s&hl=en&x={x}&y={y}&z={z}&s=Ga',
+                                        'subdomains': ('0', '1', '2', '3'),
                                         'tileSize': 256,
                                         'nameDir': 'GoogleSattelite' ,
                                         'maxZoom': 22})
         self.mapLayers.append({'nameMap': 'Google normal',
-                                        'tileServer': 'https://mt0.google.com/vt/lyrs=m&hl=en&x={x}&y={y}&z={z}&s=Ga',
+                                        'tileServer': 'https://mt{s}.google.com/vt/lyrs=m&hl=en&x={x}&y={y}&z={z}&s=Ga',
+                                        'subdomains': ('0', '1', '2', '3'),
                                         'tileSize': 256,
                                         'nameDir': 'GoogleNormal' ,
                                         'maxZoom': 22})
@@ -97,6 +125,23 @@ class PyQtMapView(QGraphicsView):
         self.upperLeftTilePos: Tuple[float, float] = (0, 0)  # in OSM coords
         self.lowerRightTilePos: Tuple[float, float] = (0, 0)
         self.last_zoom: float = self.zoom
+        self.zoom_direction: int = 0  # +1 zooming in, -1 zooming out, at zoom_direction_time
+        self.zoom_direction_time: float = 0.0
+        
+        # memory budget of the tile image cache in bytes
+        self.tileCacheSize = cacheSize
+        # number of background threads loading tile images
+        self.tileLoadThreads = loadThreads
+        # optional asyncio fetch backend, with it a few loading threads are enough
+        self.tileFetcher = fetcher
+        # milliseconds per frame the GUI thread may spend turning loaded tiles into pixmaps
+        self.tileUploadBudget = uploadBudget
+        # tiles per second the pre-cache thread may fetch ahead of the view, 0 disables pre-caching
+        self.tilePrefetchRate = prefetchRate
+        # tiles fetched from tile servers are kept on disk between sessions, diskCacheSize=0 disables it
+        self.tileDiskCache: Union[DiskTileCache, None] = None
+        if diskCacheSize > 0:
+            self.tileDiskCache = getDiskCache(os.path.join(dataPath or DEFAULT_DATA_PATH, "TileCache.db"), diskCacheSize)
         
         self.setTileServer('Open Street Map', dataPath=dataPath)
         
@@ -115,6 +160,7 @@ class PyQtMapView(QGraphicsView):
     
     def destroy(self):
         self.running = False
+        self.tileManager.stop()
         super().destroy()
 
     def add_right_click_menu_command(self, label: str, command: Callable, pass_coords: bool = False) -> None:
@@ -238,10 +284,12 @@ class PyQtMapView(QGraphicsView):
     
     
     
-    def addTileServer(self, nameMap: str, nameDir: str,  tileServer: str, tileSize: int = 256, maxZoom: int = 19):
-        """ Adds a new server for tiles """
+    def addTileServer(self, nameMap: str, nameDir: str,  tileServer: str, tileSize: int = 256, maxZoom: int = 19,
+                      subdomains: Union[Tuple[str, ...], None] = None):
+        """ Adds a new server for tiles, {s} in tileServer is replaced by one of the subdomains (default a, b, c) """
         layer = {'nameMap': nameMap,
                  'tileServer': tileServer,
+                 'subdomains': tuple(subdomains) if subdomains else DEFAULT_SUBDOMAINS,
                  'tileSize': tileSize,
                  'nameDir': nameDir,
                  'maxZoom': maxZoom}
@@ -270,9 +318,10 @@ class PyQtMapView(QGraphicsView):
             self.currentLayers = 0
             
         self.tileServer: str = self.mapLayers[self.currentLayers].get('tileServer')
+        self.tileSubdomains: Tuple[str, ...] = self.mapLayers[self.currentLayers].get('subdomains', DEFAULT_SUBDOMAINS)
         self.tileSize: int = self.mapLayers[self.currentLayers].get('tileSize')
         if dataPath is None:
-            dataPath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "TileStorage")
+            dataPath = DEFAULT_DATA_PATH
         dataPath = os.path.join(dataPath, f"{self.mapLayers[self.currentLayers].get('nameDir')}")
         self.maxZoom = self.mapLayers[self.currentLayers].get('maxZoom')  # should be set according to tile server max zoom
         self.minZoom: int = math.ceil(math.log2(math.ceil(self._width / self.tileSize)))  # min zoom at which map completely fills widget    
@@ -282,8 +331,16 @@ class PyQtMapView(QGraphicsView):
             self.clearScene()
             self.__drawInitialArray()
         else:
-            self.tileManager = TileManager(self, useDatabaseOnly, dataPath)
+            self.tileManager = TileManager(self, useDatabaseOnly, dataPath,
+                                           cacheSize=self.tileCacheSize, workerCount=self.tileLoadThreads,
+                                           fetcher=self.tileFetcher, diskCache=self.tileDiskCache,
+                                           uploadBudget=self.tileUploadBudget, prefetchRate=self.tilePrefetchRate)
     
+    def setRateLimit(self, rate: float = None, burst: int = None, maxConcurrent: int = None, tileServer: str = None):
+        """ Limits the requests per second, burst size and concurrent requests sent to a tile server
+            (the current one by default) by all map views and offline loaders of the process """
+        getRateLimiter(tileServer or self.tileServer, rate, burst, maxConcurrent)
+
     def getTileServer(self) -> str:
         """ Returns the current tile server """
         return self.mapLayers[self.currentLayers].get('nameMap')
@@ -335,6 +392,8 @@ class PyQtMapView(QGraphicsView):
                                      current_tile_mouse_position[1] + (1 - relative_pointer_y) * (self._height / self.tileSize))
         
         if round(self.zoom) != round(self.last_zoom):
+            self.zoom_direction = 1 if round(self.zoom) > round(self.last_zoom) else -1
+            self.zoom_direction_time = time.time()
             self.__checkMapBorderCrossing()
             self.__drawZoom()
             self.last_zoom = round(self.zoom)
@@ -351,8 +410,8 @@ class PyQtMapView(QGraphicsView):
 
             image = self.tileManager.getTileImageFromCache(round(self.zoom), *tile_name_position)
             if image is False:
-                tile = Tile(self, self.tileManager.notLoadedTileImage, tile_name_position)
-                self.tileManager.imageLoadQueueTasks.append(((round(self.zoom), *tile_name_position), tile))
+                tile = Tile(self, self.tileManager.getFallbackImage(round(self.zoom), *tile_name_position), tile_name_position)
+                self.tileManager.queueTile((round(self.zoom), *tile_name_position), tile)
             else:
                 tile = Tile(self, image, tile_name_position)
 
@@ -368,9 +427,9 @@ class PyQtMapView(QGraphicsView):
 
             image = self.tileManager.getTileImageFromCache(round(self.zoom), *tile_name_position)
             if image is False:
-                # image is not in image cache, load blank tile and append position to image_load_queue
-                tile = Tile(self, self.tileManager.notLoadedTileImage, tile_name_position)
-                self.tileManager.imageLoadQueueTasks.append(((round(self.zoom), *tile_name_position), tile))
+                # image is not in image cache, show a fallback tile and append position to image_load_queue
+                tile = Tile(self, self.tileManager.getFallbackImage(round(self.zoom), *tile_name_position), tile_name_position)
+                self.tileManager.queueTile((round(self.zoom), *tile_name_position), tile)
             else:
                 # image is already in cache
                 tile = Tile(self, image, tile_name_position)
@@ -382,7 +441,7 @@ class PyQtMapView(QGraphicsView):
         self.canvas_tile_array.insert(insert, canvas_tile_column)       
            
     def __drawInitialArray(self):
-        self.tileManager.imageLoadQueueTasks = []
+        self.tileManager.imageLoadScheduler.clear()
 
         x_tile_range = math.ceil(self.lowerRightTilePos[0]) - math.floor(self.upperLeftTilePos[0])
         y_tile_range = math.ceil(self.lowerRightTilePos[1]) - math.floor(self.upperLeftTilePos[1])
@@ -406,9 +465,9 @@ class PyQtMapView(QGraphicsView):
 
                 image = self.tileManager.getTileImageFromCache(round(self.zoom), *tile_name_position)
                 if image is False:
-                    # image is not in image cache, load blank tile and append position to image_load_queue
-                    tile = Tile(self, self.tileManager.notLoadedTileImage, tile_name_position)
-                    self.tileManager.imageLoadQueueTasks.append(((round(self.zoom), *tile_name_position), tile))
+                    # image is not in image cache, show a fallback tile and append position to image_load_queue
+                    tile = Tile(self, self.tileManager.getFallbackImage(round(self.zoom), *tile_name_position), tile_name_position)
+                    self.tileManager.queueTile((round(self.zoom), *tile_name_position), tile)
                 else:
                     # image is already in cache
                     tile = Tile(self, image, tile_name_position)
@@ -427,8 +486,9 @@ class PyQtMapView(QGraphicsView):
             element.draw()
 
         # update pre-cache position
-        self.tileManager.preCachePosition = (round((self.upperLeftTilePos[0] + self.lowerRightTilePos[0]) / 2),
-                                   round((self.upperLeftTilePos[1] + self.lowerRightTilePos[1]) / 2))
+        self.tileManager.setPreCachePosition((round((self.upperLeftTilePos[0] + self.lowerRightTilePos[0]) / 2),
+                                              round((self.upperLeftTilePos[1] + self.lowerRightTilePos[1]) / 2)))
+        self.__pinVisibleTiles()
         
         self.mapScene.update()
         
@@ -500,16 +560,17 @@ class PyQtMapView(QGraphicsView):
                 element.draw()
 
             # update pre-cache position
-            self.tileManager.preCachePosition = (round((self.upperLeftTilePos[0] + self.lowerRightTilePos[0]) / 2),
-                                       round((self.upperLeftTilePos[1] + self.lowerRightTilePos[1]) / 2))
+            self.tileManager.setPreCachePosition((round((self.upperLeftTilePos[0] + self.lowerRightTilePos[0]) / 2),
+                                                  round((self.upperLeftTilePos[1] + self.lowerRightTilePos[1]) / 2)))
+            self.__pinVisibleTiles()
 
             self.mapScene.update()
             
     def __drawZoom(self):
         
         if self.canvas_tile_array:
-            # clear tile image loading queue, so that no old images from other zoom levels get displayed
-            self.tileManager.imageLoadQueueTasks = []
+            # cancel queued tasks of other zoom levels, so that no old images get displayed
+            self.tileManager.imageLoadScheduler.cancelStaleZoom(round(self.zoom))
 
             # upper left tile name position
             upper_left_x = math.floor(self.upperLeftTilePos[0])
@@ -522,18 +583,25 @@ class PyQtMapView(QGraphicsView):
 
                     image = self.tileManager.getTileImageFromCache(round(self.zoom), *tile_name_position)
                     if image is False:
-                        image = self.tileManager.notLoadedTileImage
+                        # show a scaled parent or child tile until the exact tile is loaded
+                        image = self.tileManager.getFallbackImage(round(self.zoom), *tile_name_position)
                         # noinspection PyCompatibility
-                        self.tileManager.imageLoadQueueTasks.append(((round(self.zoom), *tile_name_position), self.canvas_tile_array[x_pos][y_pos]))
+                        self.tileManager.queueTile((round(self.zoom), *tile_name_position), self.canvas_tile_array[x_pos][y_pos])
 
                     self.canvas_tile_array[x_pos][y_pos].set_image_and_position(image, tile_name_position)
 
-            self.tileManager.preCachePosition = (round((self.upperLeftTilePos[0] + self.lowerRightTilePos[0]) / 2),
-                                       round((self.upperLeftTilePos[1] + self.lowerRightTilePos[1]) / 2))
+            self.tileManager.setPreCachePosition((round((self.upperLeftTilePos[0] + self.lowerRightTilePos[0]) / 2),
+                                                  round((self.upperLeftTilePos[1] + self.lowerRightTilePos[1]) / 2)))
             
             self.mapScene.update()
             self.__drawMove(called_after_zoom=True)
 
+    def __pinVisibleTiles(self):
+        """ protects the tiles on screen from being evicted from the image cache """
+        zoom = round(self.zoom)
+        self.tileManager.tileImageCache.setPinned(self.tileManager.cacheKey(zoom, *tile.tile_name_position)
+                                                  for column in self.canvas_tile_array for tile in column)
+
     def __fadingMove(self):
         delta_t = time.time() - self.last_move_time
         self.last_move_time = time.time()
@@ -710,37 +778,77 @@ class PyQtMapView(QGraphicsView):
     
     
     
+class TileSignals(QObject):
+    """ delivers tiles fetched on the asyncio thread to the Qt thread """
+    signalTileFetched = pyqtSignal(object, object)  # ((server, zoom, x, y), decoded QImage or emptyTileImage)
+
+
 class TileManager:
-    def __init__(self, gui: "PyQtMapView", useDatabaseOnly: bool, dataPath: str):
+    def __init__(self, gui: "PyQtMapView", useDatabaseOnly: bool, dataPath: str,
+                 cacheSize: int = DEFAULT_CACHE_SIZE, workerCount: int = 25,
+                 fetcher: Union[AsyncTileFetcher, None] = None,
+                 diskCache: Union[DiskTileCache, None] = None,
+                 uploadBudget: float = 6.0,
+                 prefetchRate: float = 20):
         self.gui = gui
         self.useDatabaseOnly = useDatabaseOnly
         self.dataPath = dataPath
         
         self.running = True
         
-        # pre caching for smoother movements (load tile images into cache at a certain radius around the preCachePosition)
+        # network requests go through the asyncio fetcher if one is given, otherwise they block a loading thread
+        self.fetcher = fetcher
+        self.signals = TileSignals()
+        self.signals.signalTileFetched.connect(self.__finishTile)
+        # write-through disk cache of fetched tiles, stale tiles are revalidated with conditional requests
+        self.diskCache = diskCache
+        
+        # decoded tile images, keyed by (server, zoom, x, y) and limited by cacheSize bytes
+        self.tileImageCache = TileCache(cacheSize)
+        # scaled ancestor tiles and mosaics of child tiles shown until the exact tile is loaded
+        self.fallbackImageCache = TileCache(cacheSize // 8)
+        self.fallbackDepth = 6  # zoom levels searched upwards for an ancestor tile
+        # fetches in progress, shared by the pre-cache and the image loading threads
+        self.inFlight = InFlightTable()
+        # tiles that were missing or failed recently are not requested again until their failure expires
+        self.negativeCache = NegativeTileCache()
+        # loads of visible tiles rejected while the circuit breaker of the server is open, queued again
+        # by updateTileImages once it may be probed; a shorter backoff after failures is waited out
+        self.deferredLoads: deque = deque()  # ((server, zoom, x, y), canvas tile object)
+        self.maxBackoffWait = 5.0  # seconds
+        # images decoded by the background threads that are not yet converted to pixmaps in the Qt thread
+        self.pendingUploads: Dict[tuple, QImage] = {}
+        # one pixmap per distinct tile image (blank ocean, desert...), keyed by the hash of the encoded data;
+        # like the pixmaps in tileImageCache it is only used in the Qt thread
+        self.sharedPixmaps: "weakref.WeakValueDictionary[str, QPixmap]" = weakref.WeakValueDictionary()
+        
+        # pre caching for smoother movements (load tile images into cache along the pan trajectory,
+        # at the zoom level the user is moving to and at a certain radius around the preCachePosition)
         self.preCachePosition: Union[Tuple[float, float], None] = None
+        self.preCacheEvent = threading.Event()  # set when the preCachePosition changes
+        self.prefetchPlanner = PrefetchPlanner(prefetchRate)
         self.preCacheThread = threading.Thread(daemon=True, target=self.preCache)
-        self.preCacheThread.start()
-
-        self.tileImageCache: Dict[str, QPixmap] = {}
         
-        # image loading in background threads
+        # image loading in background threads, results are attached to the canvas tiles once per frame
         self.timer = QTimer()                         
-        self.timer.setInterval(5) 
-        self.imageLoadQueueTasks: List[tuple] = []  # task: ((zoom, x, y), canvas_tile_object)
-        self.imageLoadQueueResults: List[tuple] = []  # result: ((zoom, x, y), canvas_tile_object, photo_image)
+        self.timer.setInterval(16) 
+        self.uploadBudget = uploadBudget  # milliseconds per frame
+        self.imageLoadScheduler = TileLoadScheduler()  # task: ((zoom, x, y), canvas_tile_object), nearest to the view center first
+        self.imageLoadQueueResults: deque = deque()  # result: ((server, zoom, x, y), canvas_tile_object or None, QImage or QPixmap)
         self.timer.timeout.connect(self.updateTileImages)    
         self.imageLoadThreadPool: List[threading.Thread] = []
         self.timer.start()
         
-        # add background threads which load tile images from self.imageLoadQueueTasks
-        for i in range(25):
+        # add background threads which load tile images from self.imageLoadScheduler
+        for i in range(workerCount):
             imageLoadThread = threading.Thread(daemon=True, target=self.loadImagesBackground)
-            imageLoadThread.start()
             self.imageLoadThreadPool.append(imageLoadThread)
             
+        # the threads open the offline database, so they are started once its path is known
         self.setDataPath(dataPath, True)
+        self.preCacheThread.start()
+        for imageLoadThread in self.imageLoadThreadPool:
+            imageLoadThread.start()
         
     def createImage(self, color):
         image = QImage(self.gui.tileSize, self.gui.tileSize, QImage.Format_RGB32)
@@ -748,83 +856,160 @@ class TileManager:
         return QPixmap.fromImage(image)
     
     def setDataPath(self, dataPath: str, dataBase: bool):
-        self.dataPath = self.dataPath + ".db" if dataBase else dataPath
-        self.imageLoadQueueResults = []
-        self.imageLoadQueueTasks = []
-        self.tileImageCache: Dict[str, QPixmap] = {}
+        if dataBase:
+            # a tile archive takes precedence over an MBTiles file, which takes precedence over an offline database of the old format
+            dataPath = next((dataPath + extension for extension in (ARCHIVE_EXTENSION, ".mbtiles")
+                             if os.path.exists(dataPath + extension)), dataPath + ".db")
+        self.dataPath = dataPath
+        self.archive = TileArchive(dataPath) if isTileArchive(dataPath) else None
+        self.mbtiles = MBTilesStore(dataPath, readOnly=True) if self.archive is None and isMBTiles(dataPath) else None
+        self.imageLoadQueueResults = deque()
+        self.pendingUploads = {}
+        self.negativeCache.clear()
+        self.deferredLoads = deque()
+        self.imageLoadScheduler.clear()
         self.emptyTileImage = self.createImage((190, 190, 190)) # used for zooming and moving
         self.notLoadedTileImage = self.createImage((250, 250, 250)) # only used when image not found on tile server 
 
-    def preCache(self):
-        """ single threaded pre-chache tile images in area of self.preCachePosition """
-        lastPreCachePosition = None
-        radius = 1
-        zoom = round(self.gui.zoom)
+    def stop(self):
+        """ stops the pre-cache and image loading threads """
+        self.running = False
+        self.timer.stop()
+        self.imageLoadScheduler.close()
+        self.preCacheEvent.set()
+        if self.diskCache is not None:
+            self.diskCache.flush()
+
+    def setPreCachePosition(self, position: Tuple[int, int]):
+        """ moves the pre-cache area and reorders waiting tile loads around the new view center """
+        if position != self.preCachePosition:
+            self.preCachePosition = position
+            gui = self.gui
+            viewSize = (gui.lowerRightTilePos[0] - gui.upperLeftTilePos[0], gui.lowerRightTilePos[1] - gui.upperLeftTilePos[1])
+            # move_velocity is in widget pixels per second
+            velocity = (gui.move_velocity[0] / gui._width * viewSize[0], gui.move_velocity[1] / gui._height * viewSize[1]) \
+                if gui.is_dragging or gui.fadingTimer.isActive() else (0, 0)
+            self.prefetchPlanner.update(((gui.upperLeftTilePos[0] + gui.lowerRightTilePos[0]) / 2,
+                                         (gui.upperLeftTilePos[1] + gui.lowerRightTilePos[1]) / 2),
+                                        round(gui.zoom), viewSize, velocity, gui.zoom_direction, gui.zoom_direction_time,
+                                        gui.minZoom, gui.maxZoom)
+            self.preCacheEvent.set()
+            self.imageLoadScheduler.reprioritize(self.tilePriority)
+
+    def tilePriority(self, key: Tuple[int, int, int]) -> tuple:
+        """ tiles of the current zoom level come first, then the ones closest to the view center """
+        zoom, x, y = key
+        center_x = (self.gui.upperLeftTilePos[0] + self.gui.lowerRightTilePos[0]) / 2
+        center_y = (self.gui.upperLeftTilePos[1] + self.gui.lowerRightTilePos[1]) / 2
+        return zoom != round(self.gui.zoom), (x + 0.5 - center_x) ** 2 + (y + 0.5 - center_y) ** 2
+
+    def queueTile(self, key: Tuple[int, int, int], tile: Tile):
+        """ queues a canvas tile for loading in the background threads """
+        self.imageLoadScheduler.put(key, tile, self.tilePriority(key))
+
+    def cacheKey(self, zoom: int, x: int, y: int) -> tuple:
+        """ key of a tile of the current tile server in the image cache """
+        return self.gui.tileServer, zoom, x, y
 
-        if self.dataPath is not None and os.path.exists(self.dataPath):
+    def preCache(self):
+        """ single threaded pre-cache of the tiles planned by the prefetchPlanner, limited to prefetchPlanner.rate
+            tiles per second and paused while tiles of the view are waiting to be loaded """
+        if self.dataPath is not None and os.path.exists(self.dataPath) and self.archive is None:
             
-            dbConnection = sqlite3.connect(self.dataPath)
+            dbConnection = connectReader(self.dataPath)
             
             dbCursor = dbConnection.cursor()
         else:
             dbCursor = None
 
         while self.running:
-            if lastPreCachePosition != self.preCachePosition:
-                lastPreCachePosition = self.preCachePosition
-                zoom = round(self.gui.zoom)
-                radius = 1
-
-            if lastPreCachePosition is not None and radius <= 8:
-
-                # pre cache top and bottom row
-                for x in range(self.preCachePosition[0] - radius, self.preCachePosition[0] + radius + 1):
-                    if f"{zoom}{x}{self.preCachePosition[1] + radius}" not in self.tileImageCache:
-                        self.requestImage(zoom, x, self.preCachePosition[1] + radius, dbCursor==dbCursor)
-                    if f"{zoom}{x}{self.preCachePosition[1] - radius}" not in self.tileImageCache:
-                        self.requestImage(zoom, x, self.preCachePosition[1] - radius, dbCursor=dbCursor)
-
-                # pre cache left and right column
-                for y in range(self.preCachePosition[1] - radius, self.preCachePosition[1] + radius + 1):
-                    if f"{zoom}{self.preCachePosition[0] + radius}{y}" not in self.tileImageCache:
-                        self.requestImage(zoom, self.preCachePosition[0] + radius, y, dbCursor=dbCursor)
-                    if f"{zoom}{self.preCachePosition[0] - radius}{y}" not in self.tileImageCache:
-                        self.requestImage(zoom, self.preCachePosition[0] - radius, y, dbCursor=dbCursor)
-
-                # raise the radius
-                radius += 1
-                
+            self.preCacheEvent.clear()
+            generation, tiles = self.prefetchPlanner.plan()
+
+            for zoom, x, y in tiles:
+                if not self.running or self.prefetchPlanner.generation != generation:
+                    break
+                if self.cacheKey(zoom, x, y) in self.tileImageCache or self.cacheKey(zoom, x, y) in self.negativeCache:
+                    continue
+                # foreground loads go first
+                while len(self.imageLoadScheduler) > 0 and self.running and self.prefetchPlanner.generation == generation:
+                    self.preCacheEvent.wait(0.05)
+                if not self.prefetchPlanner.throttle(self.preCacheEvent):
+                    break
+                # pre-caching waits for every tile, so it never fetches more than one tile at a time
+                self.loadTile(zoom, x, y, dbCursor=dbCursor).result()
             else:
-                time.sleep(0.1)
+                # sleep until the pre-cache position changes
+                self.preCacheEvent.wait()
+
+    def requestImage(self, zoom: int, x: int, y: int, dbCursor=None) -> Union[QImage, QPixmap, None]:
+        """ loads a tile in the calling thread, returns the decoded QImage or emptyTileImage,
+            or None if the server may not be requested now (see serverAvailable) """
+        server = self.gui.tileServer
+        image = self.requestImageFromDatabase(server, zoom, x, y, dbCursor)
+        if image is not None:
+            return image
+
+        key = (server, zoom, x, y)
+        entry = self.diskCache.get(*key) if self.diskCache is not None else None
+        if entry is not None and entry.fresh:
+            return self.decodeImage(entry.data)
+
+        if not self.serverAvailable(server):
+            # the server is backing off after failures, a stale tile is better than none, without one the load is deferred
+            return self.decodeImage(entry.data) if entry is not None else None
 
-            # 10_000 images = 80 MB RAM-usage
-            if len(self.tileImageCache) > 10_000:  # delete random tiles if cache is too large
-                # create list with keys to delete
-                keys_to_delete = []
-                for key in self.tileImageCache.keys():
-                    if len(self.tileImageCache) - len(keys_to_delete) > 10_000:
-                        keys_to_delete.append(key)
-
-                # delete keys in list so that len(self.tileImageCache) == 10_000
-                for key in keys_to_delete:
-                    del self.tileImageCache[key]
+        # Попробуем получить тайл с сервера
+        try:
+            # waits politely if the server is requested faster than its rate limit allows
+            with getRateLimiter(server).request():
+                response = getTileClient(server, self.gui.tileSubdomains).get(zoom, x, y, headers=entry and entry.conditionalHeaders())
+        except Exception:
+            return self.requestFailed(key, entry)
+        return self.imageFromResponse(key, response.status_code, response.content, response.headers, entry)
+
+    def serverAvailable(self, server: str) -> bool:
+        """ waits out a backoff of up to maxBackoffWait seconds after failures of the server,
+            returns False if it may not be requested now (its circuit breaker is open) """
+        breaker = getCircuitBreaker(server)
+        delay = breaker.backoff()
+        if delay > self.maxBackoffWait:
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return breaker.allowRequest()
+
+    def requestImageFromDatabase(self, server: str, zoom: int, x: int, y: int, dbCursor=None) -> Union[QImage, QPixmap, None]:
+        """ returns the tile image from the database, emptyTileImage if it cannot be loaded,
+            or None if the tile has to be requested from the server """
+        # a tile archive or MBTiles file holds one tile server
+        store = self.archive if self.archive is not None else self.mbtiles
+        if store is not None and store.servesTileServer(server, legacyServerUrl(server, self.gui.tileSubdomains)):
+            try:
+                # tiles of an archive are views into its memory mapped file, decoded without a copy
+                imageData = store.getTile(zoom, x, y)
+            except sqlite3.Error:
+                imageData = None
+            if imageData is not None:
+                return self.decodeImage(imageData)
+            if self.useDatabaseOnly:
+                self.negativeCache.put((server, zoom, x, y), "notInDatabase")
+                return self.emptyTileImage
+            return None
 
-    def requestImage(self, zoom: int, x: int, y: int, dbCursor=None) -> QPixmap:
         # Если база данных доступна, сначала проверяем, есть ли тайл в базе данных
         if dbCursor is not None:
             try:
-                dbCursor.execute("SELECT t.tile_image FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND t.server=?;",
-                                  (zoom, x, y, self.gui.tileServer))
+                # databases saved before {s} templates store the server with its first subdomain
+                dbCursor.execute("SELECT t.tile_image FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND t.server IN (?, ?);",
+                                  (zoom, x, y, server, legacyServerUrl(server, self.gui.tileSubdomains)))
                 result = dbCursor.fetchone()
 
                 if result is not None:
                     # Загружаем изображение из базы данных
-                    imageData = result[0]
-                    imageQt = QPixmap()
-                    imageQt.loadFromData(imageData)
-                    self.tileImageCache[f"{zoom}{x}{y}"] = imageQt
-                    return imageQt
+                    return self.decodeImage(result[0])
                 elif self.useDatabaseOnly:
+                    self.negativeCache.put((server, zoom, x, y), "notInDatabase")
                     return self.emptyTileImage
                 else:
                     pass
@@ -838,70 +1023,246 @@ class TileManager:
             except Exception:
                 return self.emptyTileImage
 
-        # Попробуем получить тайл с сервера
+        return None
+
+    def imageFromResponse(self, key: tuple, status: int, content: bytes, headers,
+                          entry: Union[CacheEntry, None] = None) -> Union[QImage, QPixmap]:
+        """ decodes a server answer and writes it through to the disk cache,
+            a 304 Not Modified answer reuses the stale tile from the disk cache;
+            failures are remembered in the negative cache and the circuit breaker of the server """
+        breaker = getCircuitBreaker(key[0])
+        if status == 304 and entry is not None:
+            breaker.success()
+            self.diskCache.revalidated(*key, entry, headers)
+            return self.decodeImage(entry.data)
+        if status in (204, 404, 410):
+            # the server works, the tile does not exist
+            breaker.success()
+            self.negativeCache.put(key, "missing")
+            return self.decodeImage(entry.data) if entry is not None else self.emptyTileImage
+        if status != 200:
+            return self.requestFailed(key, entry, retryAfterSeconds(headers))
+
+        breaker.success()
+        image = self.decodeImage(content)
+        if image is self.emptyTileImage:
+            self.negativeCache.put(key, "invalid")
+        elif self.diskCache is not None:
+            self.diskCache.put(*key, content, headers)
+        return image
+
+    def requestFailed(self, key: tuple, entry: Union[CacheEntry, None] = None,
+                      retryAfter: Union[float, None] = None) -> Union[QImage, QPixmap]:
+        """ records a timeout, connection error, 429 or 5xx answer and returns the stale tile if there is one """
+        getCircuitBreaker(key[0]).failure(retryAfter)
+        self.negativeCache.put(key, "error")
+        # a stale tile is better than none when the server cannot be reached
+        return self.decodeImage(entry.data) if entry is not None else self.emptyTileImage
+
+    def decodeImage(self, imageData: bytes) -> Union[QImage, QPixmap]:
+        """ decodes tile image data into a QImage, which unlike QPixmap is safe outside the Qt thread;
+            the image is converted to the format QPixmap.fromImage() can use without another conversion
+            and tagged with the hash of the data, so uploadImage shares the pixmap of identical tiles """
+        digest = tileHash(imageData)
+        image = QImage()
+        if not image.loadFromData(imageData):
+            return self.emptyTileImage  # Если не удалось загрузить изображение
+
+        if image.hasAlphaChannel():
+            image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        else:
+            image = image.convertToFormat(QImage.Format_RGB32)
+        image.setText("tileHash", digest)
+        return image
+    
+    def loadTile(self, zoom: int, x: int, y: int, dbCursor=None) -> Future:
+        """ returns a future of the tile image (QImage, QPixmap from the cache or emptyTileImage, None if the server
+            may not be requested now); if the tile is already being fetched by another thread the pending fetch is
+            shared, otherwise it is fetched in the calling thread """
+        key = self.cacheKey(zoom, x, y)
+        future, owner = self.inFlight.begin(key)
+        if owner:
+            image = self.emptyTileImage
+            pending = False
+            try:
+                # the tile may have arrived between the caller's cache check and begin()
+                image = self.tileImageCache.get(key) if key in self.tileImageCache else self.pendingUploads.get(key)
+                if image is None and key in self.negativeCache:
+                    image = self.emptyTileImage
+                if image is None and self.fetcher is None:
+                    image = self.requestImage(zoom, x, y, dbCursor=dbCursor)
+                elif image is None:
+                    image = self.requestImageFromDatabase(key[0], zoom, x, y, dbCursor)
+                    entry = self.diskCache.get(*key) if image is None and self.diskCache is not None else None
+                    if entry is not None and entry.fresh:
+                        image = self.decodeImage(entry.data)
+                    elif image is None and not self.serverAvailable(key[0]):
+                        image = self.decodeImage(entry.data) if entry is not None else None
+                    elif image is None:
+                        # decoded on the event loop thread by __tileFetched, finished in the Qt thread,
+                        # the rate limiter slot is released when the fetch completes
+                        url = formatTileUrl(key[0], zoom, x, y, self.gui.tileSubdomains)
+                        limiter = getRateLimiter(key[0])
+                        limiter.acquire()
+                        try:
+                            fetch = self.fetcher.submit(url, headers=entry and entry.conditionalHeaders())
+                        except Exception:
+                            # e.g. the fetcher was closed, the request was never sent
+                            limiter.release()
+                            raise
+                        fetch.add_done_callback(partial(self.__tileFetched, key, entry))
+                        pending = True
+            finally:
+                if not pending:
+                    self.__finishTile(key, image)
+        return future
+
+    def __tileFetched(self, key: tuple, entry: Union[CacheEntry, None], fetch: Future):
+        getRateLimiter(key[0]).release()
+        image = self.emptyTileImage
         try:
-            url = self.gui.tileServer.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
-            response = requests.get(url, stream=True, headers={"User-Agent": "PyQtMapView"})
-            response.raise_for_status()  # Проверка на успешный ответ
-
-            imageData = response.content
-            imageQt = QPixmap()
-            if not imageQt.loadFromData(imageData):
-                return self.emptyTileImage  # Если не удалось загрузить изображение
-
-            self.tileImageCache[f"{zoom}{x}{y}"] = imageQt
-            return imageQt
-
-        except requests.exceptions.ConnectionError:
-            return self.emptyTileImage
-
+            response = fetch.result()
         except Exception:
-            return self.emptyTileImage
-    
-    def getTileImageFromCache(self, zoom: int, x: int, y: int):
-        if f"{zoom}{x}{y}" not in self.tileImageCache:
-            return False
+            image = self.requestFailed(key, entry)
         else:
-            return self.tileImageCache[f"{zoom}{x}{y}"]
+            image = self.imageFromResponse(key, response.status, response.content, response.headers, entry)
+        finally:
+            self.signals.signalTileFetched.emit(key, image)
+
+    def __finishTile(self, key: tuple, image: Union[QImage, QPixmap]):
+        # runs outside the Qt thread; a newly decoded image is converted and put into the cache by
+        # updateTileImages, until then it is kept in pendingUploads
+        if isinstance(image, QImage):
+            self.pendingUploads[key] = image
+            self.imageLoadQueueResults.append((key, None, image))
+        self.inFlight.finish(key, image)
+
+    def getTileImageFromCache(self, zoom: int, x: int, y: int):
+        return self.tileImageCache.get(self.cacheKey(zoom, x, y), False)
+
+    def getFallbackImage(self, zoom: int, x: int, y: int) -> QPixmap:
+        """ returns an image to show until the tile is loaded: the matching part of the nearest cached
+            ancestor tile scaled up, or a mosaic of the cached child tiles, otherwise notLoadedTileImage """
+        key = self.cacheKey(zoom, x, y)
+        image = self.fallbackImageCache.get(key)
+        if image is not None:
+            return image
+
+        for depth in range(1, min(zoom, self.fallbackDepth) + 1):
+            ancestorKey = self.cacheKey(zoom - depth, x >> depth, y >> depth)
+            ancestor = self.tileImageCache.get(ancestorKey) if ancestorKey in self.tileImageCache else None
+            if isinstance(ancestor, QPixmap) and ancestor is not self.emptyTileImage and not ancestor.isNull():
+                size = ancestor.width() >> depth
+                if size == 0:
+                    break
+                part = ancestor.copy((x - (x >> depth << depth)) * size, (y - (y >> depth << depth)) * size, size, size)
+                image = part.scaled(ancestor.width(), ancestor.height(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+                self.fallbackImageCache.put(key, image)
+                return image
+
+        children = []
+        for childX, childY in ((2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)):
+            childKey = self.cacheKey(zoom + 1, childX, childY)
+            child = self.tileImageCache.get(childKey) if childKey in self.tileImageCache else None
+            if not isinstance(child, QPixmap) or child is self.emptyTileImage or child.isNull():
+                child = None
+            children.append(child)
+        size = max((child.width() for child in children if child is not None), default=0)
+        if size == 0:
+            return self.notLoadedTileImage
+
+        image = QPixmap(size, size)
+        image.fill(QColor(250, 250, 250))
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        half = size // 2
+        for i, child in enumerate(children):
+            if child is not None:
+                painter.drawPixmap(i % 2 * half, i // 2 * half, half, half, child)
+        painter.end()
+        if all(child is not None for child in children):
+            # a partial mosaic is rebuilt the next time, when more children may be loaded
+            self.fallbackImageCache.put(key, image)
+        return image
     
     def loadImagesBackground(self):
-        if self.dataPath is not None and os.path.exists(self.dataPath):
-            dbConnection = sqlite3.connect(self.dataPath)
+        if self.dataPath is not None and os.path.exists(self.dataPath) and self.archive is None:
+            dbConnection = connectReader(self.dataPath)
             dbCursor = dbConnection.cursor()
         else:
             dbCursor = None
 
         while self.running:
-            if len(self.imageLoadQueueTasks) > 0:
-                # task queue structure: [((zoom, x, y), corresponding canvas tile object), ... ]
-                task = self.imageLoadQueueTasks.pop()
-
-                zoom = task[0][0]
-                x, y = task[0][1], task[0][2]
-                tile = task[1]
-
-                image = self.getTileImageFromCache(zoom, x, y)
-                if image is False:
-                    image = self.requestImage(zoom, x, y, dbCursor=dbCursor)
-                    if image is None:
-                        self.imageLoadQueueTasks.append(task)
-                        continue
+            # task structure: ((zoom, x, y), corresponding canvas tile object), blocks until a task is queued
+            task = self.imageLoadScheduler.get()
+            if task is None:
+                break
 
-                # result queue structure: [((zoom, x, y), corresponding canvas tile object, tile image), ... ]
-                self.imageLoadQueueResults.append(((zoom, x, y), tile, image))
+            zoom = task[0][0]
+            x, y = task[0][1], task[0][2]
+            tile = task[1]
+            key = self.cacheKey(zoom, x, y)
 
+            image = self.tileImageCache.get(key, False)
+            if image is False:
+                # the result is delivered when the fetch completes, even if another thread is doing it
+                self.loadTile(zoom, x, y, dbCursor=dbCursor).add_done_callback(partial(self.__tileLoaded, key, tile))
             else:
-                time.sleep(0.01)        
+                self.imageLoadQueueResults.append((key, tile, image))
+
+    def __tileLoaded(self, key: tuple, tile: Tile, future: Future):
+        # result queue structure: [((server, zoom, x, y), corresponding canvas tile object, tile image), ... ]
+        if future.result() is None:
+            # the tile keeps its fallback image until the server may be requested again
+            self.deferredLoads.append((key, tile))
+            return
+        self.imageLoadQueueResults.append((key, tile, future.result()))
+
+    def __requeueDeferredLoads(self):
+        # tiles scrolled out of view or of another zoom level or server are dropped
+        if not self.deferredLoads or getCircuitBreaker(self.gui.tileServer).isOpen():
+            return
+        while self.deferredLoads:
+            key, tile = self.deferredLoads.popleft()
+            if key[0] == self.gui.tileServer and key[1] == round(self.gui.zoom) and tuple(tile.tile_name_position) == key[2:]:
+                self.queueTile(key[1:], tile)
     
     def updateTileImages(self):
+        """ attaches loaded images to the canvas tiles, converting decoded QImages into cached QPixmaps;
+            stops after uploadBudget milliseconds, the remaining results are handled on the next timer tick """
+        deadline = time.perf_counter() + self.uploadBudget / 1000
+        self.__requeueDeferredLoads()
         while len(self.imageLoadQueueResults) > 0 and self.running:
-            # result queue structure: [((zoom, x, y), corresponding canvas tile object, tile image), ... ]
-            result = self.imageLoadQueueResults.pop(0)
+            # result queue structure: [((server, zoom, x, y), corresponding canvas tile object or None, tile image), ... ]
+            result = self.imageLoadQueueResults.popleft()
 
-            zoom, x, y = result[0][0], result[0][1], result[0][2]
+            server, zoom = result[0][0], result[0][1]
             tile = result[1]
             image = result[2]
 
-            # check if zoom level of result is still up to date, otherwise don't update image
-            if zoom == round(self.gui.zoom):
+            # check if tile server and zoom level of result are still up to date, otherwise don't update image
+            if tile is not None and (server != self.gui.tileServer or zoom != round(self.gui.zoom)):
+                continue
+
+            if isinstance(image, QImage):
+                image = self.uploadImage(result[0], image)
+            if tile is not None:
                 tile.setImage(image)
+
+            if time.perf_counter() >= deadline:
+                break
+
+    def uploadImage(self, key: tuple, image: QImage) -> QPixmap:
+        """ converts a decoded image into a pixmap in the Qt thread and puts it into the cache """
+        pixmap = self.tileImageCache.get(key) if key in self.tileImageCache else None
+        if pixmap is None:
+            digest = image.text("tileHash")
+            pixmap = self.sharedPixmaps.get(digest) if digest else None
+            if pixmap is None:
+                pixmap = QPixmap.fromImage(image)
+                if digest:
+                    self.sharedPixmaps[digest] = pixmap
+            self.tileImageCache.put(key, pixmap)
+        if self.pendingUploads.get(key) is image:
+            del self.pendingUploads[key]
+        return pixmap
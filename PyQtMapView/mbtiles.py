@@ -0,0 +1,308 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, Tuple, Union
+
+from .utility_functions import osm_to_decimal
+from .tile_store import BatchedTileWriter, connectReader, connectWriter, selectLegacyServer, tileHash
+
+INSERT_TILE = "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?);"
+# deduplicated layout: every distinct image is stored once in images, map points the tiles to it;
+# the map rows come first, so an image the map_unused_images trigger deleted while they were
+# written is inserted again if a tile of the same batch still uses it
+INSERT_DEDUPLICATED_TILE = ("INSERT INTO map (zoom_level, tile_column, tile_row, tile_id) "
+                            "VALUES (:zoom_level, :tile_column, :tile_row, :tile_id) "
+                            "ON CONFLICT (zoom_level, tile_column, tile_row) DO UPDATE SET tile_id = excluded.tile_id;",
+                            "INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (:tile_data, :tile_id);")
+SELECT_TILE = "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;"
+
+
+def tmsRow(zoom: int, y: int) -> int:
+    """ MBTiles stores rows in TMS order (origin bottom left), the map uses XYZ (origin top left);
+        the conversion is its own inverse """
+    return (1 << zoom) - 1 - y
+
+
+def imageFormat(data: bytes) -> str:
+    """ returns the MBTiles format name of encoded tile data """
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "png"
+
+
+IMAGE_FORMATS = ("png", "jpg", "webp")  # the format names imageFormat() returns
+
+
+def writeTileFile(directory: str, zoom: int, x: int, y: int, data: bytes):
+    """ writes a tile to directory/zoom/x/y.<format>, the extension follows the encoded data (see imageFormat);
+        a file of the tile in another format is removed """
+    extension = imageFormat(data)
+    tilePath = os.path.join(directory, f"{zoom}", f"{x}", f"{y}.{extension}")
+    os.makedirs(os.path.dirname(tilePath), exist_ok=True)
+    with open(tilePath, "wb") as file:
+        file.write(data)
+    for other in IMAGE_FORMATS:
+        if other != extension:
+            try:
+                os.remove(os.path.join(directory, f"{zoom}", f"{x}", f"{y}.{other}"))
+            except FileNotFoundError:
+                pass
+
+
+def tileFileSize(directory: str, zoom: int, x: int, y: int) -> Union[int, None]:
+    """ size in bytes of the file of a tile written by writeTileFile, None if there is none """
+    for extension in IMAGE_FORMATS:
+        tilePath = os.path.join(directory, f"{zoom}", f"{x}", f"{y}.{extension}")
+        if os.path.exists(tilePath):
+            return os.path.getsize(tilePath)
+    return None
+
+
+def tileFilesInColumns(directory: str, zoom: int, firstX: int, lastX: int) -> Iterator[Tuple[int, int]]:
+    """ (x, y) of the tile files of the columns firstX to lastX, see writeTileFile """
+    for x in range(firstX, lastX + 1):
+        try:
+            names = os.listdir(os.path.join(directory, f"{zoom}", f"{x}"))
+        except FileNotFoundError:
+            continue
+        for name in names:
+            y, extension = os.path.splitext(name)
+            if extension[1:] in IMAGE_FORMATS and y.isdigit():
+                yield x, int(y)
+
+
+def isMBTiles(path: str) -> bool:
+    """ returns True if path is an SQLite file with the MBTiles tiles table """
+    if not os.path.isfile(path):
+        return False
+    try:
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(tiles);")]
+        finally:
+            connection.close()
+    except sqlite3.Error:
+        return False
+    return "tile_row" in columns and "tile_data" in columns
+
+
+class MBTilesStore:
+    """ Tile storage in the MBTiles format (https://github.com/mapbox/mbtiles-spec).
+
+        One file holds one tileset; tiles are addressed with XYZ coordinates like everywhere else
+        in the package and flipped to TMS rows internally. Besides the standard metadata the tile
+        server template the file was seeded from is kept as "tile_server". Every thread reads
+        through its own read-only memory mapped connection. Tiles are written either directly with
+        putTile() and commit(), or through queueTile(), which hands them to a batched writer thread.
+
+        A new file created with deduplicate=True uses the deduplicated layout other MBTiles tools
+        know as well: each distinct image is stored once in the images table under the hash of its
+        bytes, the map table points every tile to its image and tiles is a view joining both. When
+        a tile is replaced, its old image is deleted by a trigger once no other tile uses it. """
+
+    def __init__(self, path: str, readOnly: bool = False, deduplicate: bool = False):
+        self.path = path
+        self.readOnly = readOnly
+        self.__local = threading.local()
+        self.__writer: Union[BatchedTileWriter, None] = None
+
+        if not readOnly:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            connection = self.connection()
+            tables = dict(connection.execute("SELECT name, type FROM sqlite_master WHERE name IN ('tiles', 'map');").fetchall())
+            # the layout of an existing file is kept
+            self.deduplicated = "map" in tables or (deduplicate and "tiles" not in tables)
+            connection.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);")
+            connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name);")
+            if self.deduplicated:
+                connection.execute("CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);")
+                connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);")
+                connection.execute("CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);")
+                connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);")
+                connection.execute("CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id);")
+                connection.execute("""CREATE TRIGGER IF NOT EXISTS map_unused_images
+                                        AFTER UPDATE OF tile_id ON map WHEN OLD.tile_id IS NOT NEW.tile_id
+                                        BEGIN
+                                            DELETE FROM images WHERE tile_id = OLD.tile_id
+                                                AND NOT EXISTS (SELECT 1 FROM map WHERE tile_id = OLD.tile_id);
+                                        END;""")
+                connection.execute("""CREATE VIEW IF NOT EXISTS tiles AS
+                                        SELECT map.zoom_level AS zoom_level,
+                                               map.tile_column AS tile_column,
+                                               map.tile_row AS tile_row,
+                                               images.tile_data AS tile_data
+                                        FROM map JOIN images ON images.tile_id = map.tile_id;""")
+            else:
+                connection.execute("""CREATE TABLE IF NOT EXISTS tiles (
+                                            zoom_level INTEGER,
+                                            tile_column INTEGER,
+                                            tile_row INTEGER,
+                                            tile_data BLOB);""")
+                connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);")
+            connection.commit()
+        else:
+            self.deduplicated = self.readConnection().execute("SELECT 1 FROM sqlite_master WHERE name='map';").fetchone() is not None
+
+        self.tileServer = self.metadata().get("tile_server")
+
+    def connection(self) -> sqlite3.Connection:
+        """ connection of the calling thread used for writing """
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = connectReader(self.path) if self.readOnly else connectWriter(self.path)
+            self.__local.connection = connection
+        return connection
+
+    def readConnection(self) -> sqlite3.Connection:
+        """ connection of the calling thread used for lookups """
+        connection = getattr(self.__local, "reader", None)
+        if connection is None:
+            connection = self.__local.reader = connectReader(self.path)
+        return connection
+
+    def servesTileServer(self, *templates: str) -> bool:
+        """ a file without a "tile_server" entry (e.g. made by another tool) serves every tile server """
+        return self.tileServer is None or self.tileServer in templates
+
+    def getTile(self, zoom: int, x: int, y: int) -> Union[bytes, None]:
+        row = self.readConnection().execute(SELECT_TILE, (zoom, x, tmsRow(zoom, y))).fetchone()
+        return row[0] if row is not None else None
+
+    def hasTile(self, zoom: int, x: int, y: int) -> bool:
+        # the deduplicated layout is checked without joining the images
+        return self.readConnection().execute(f"SELECT 1 FROM {'map' if self.deduplicated else 'tiles'} "
+                                             "WHERE zoom_level=? AND tile_column=? AND tile_row=?;",
+                                             (zoom, x, tmsRow(zoom, y))).fetchone() is not None
+
+    def tilesInColumns(self, zoom: int, firstX: int, lastX: int) -> Iterator[Tuple[int, int]]:
+        """ yields (x, y) of the stored tiles of the columns firstX to lastX of a zoom level, using one range query on the tile index """
+        rows = self.readConnection().execute(f"SELECT tile_column, tile_row FROM {'map' if self.deduplicated else 'tiles'} "
+                                             "WHERE zoom_level=? AND tile_column BETWEEN ? AND ?;", (zoom, firstX, lastX))
+        for x, row in rows:
+            yield x, tmsRow(zoom, row)
+
+    def __row(self, zoom: int, x: int, y: int, data: bytes) -> Union[tuple, dict]:
+        if self.deduplicated:
+            return {"zoom_level": zoom, "tile_column": x, "tile_row": tmsRow(zoom, y), "tile_data": data, "tile_id": tileHash(data)}
+        return zoom, x, tmsRow(zoom, y), data
+
+    def putTile(self, zoom: int, x: int, y: int, data: bytes):
+        self.putTiles([(zoom, x, y, data)])
+
+    def putTiles(self, tiles: Iterable[Tuple[int, int, int, bytes]]):
+        rows = [self.__row(*tile) for tile in tiles]
+        for statement in (INSERT_DEDUPLICATED_TILE if self.deduplicated else [INSERT_TILE]):
+            self.connection().executemany(statement, rows)
+
+    def commit(self):
+        self.connection().commit()
+
+    def queueTile(self, zoom: int, x: int, y: int, data: bytes):
+        """ stores a tile through the batched writer thread, it is committed with the next batch """
+        if self.__writer is None:
+            self.__writer = BatchedTileWriter(self.path, INSERT_DEDUPLICATED_TILE if self.deduplicated else INSERT_TILE)
+        self.__writer.put(self.__row(zoom, x, y, data))
+
+    def flush(self):
+        """ waits until every queued tile is committed """
+        if self.__writer is not None:
+            self.__writer.flush()
+
+    def writerStats(self) -> Dict[str, Union[int, float]]:
+        return self.__writer.stats() if self.__writer is not None else {}
+
+    def metadata(self) -> Dict[str, str]:
+        try:
+            return dict(self.connection().execute("SELECT name, value FROM metadata;").fetchall())
+        except sqlite3.OperationalError:
+            return {}
+
+    def setMetadata(self, values: Dict[str, Union[str, int, float]]):
+        connection = self.connection()
+        connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?);",
+                               [(name, str(value)) for name, value in values.items()])
+        connection.commit()
+        if "tile_server" in values:
+            self.tileServer = str(values["tile_server"])
+
+    def extendMetadata(self, minZoom: int, maxZoom: int, bounds: Union[Tuple[float, float, float, float], None] = None):
+        """ widens minzoom, maxzoom and bounds (left, bottom, right, top in degrees) to include newly stored tiles """
+        metadata = self.metadata()
+        values = {"minzoom": min(minZoom, int(metadata.get("minzoom", minZoom))),
+                  "maxzoom": max(maxZoom, int(metadata.get("maxzoom", maxZoom)))}
+        if bounds is not None:
+            if "bounds" in metadata:
+                old = [float(value) for value in metadata["bounds"].split(",")]
+                bounds = (min(bounds[0], old[0]), min(bounds[1], old[1]), max(bounds[2], old[2]), max(bounds[3], old[3]))
+            values["bounds"] = ",".join(f"{value:.6f}" for value in bounds)
+        self.setMetadata(values)
+
+    def removeUnusedImages(self) -> int:
+        """ deletes images no tile points to any more, e.g. of tiles replaced by another tool
+            (tiles replaced through this class delete their unused images), returns their number """
+        if not self.deduplicated:
+            return 0
+        self.flush()
+        with self.connection() as connection:
+            return connection.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);").rowcount
+
+    def close(self):
+        """ commits queued tiles and closes the connections of the calling thread """
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        for name in ("connection", "reader"):
+            connection = getattr(self.__local, name, None)
+            if connection is not None:
+                connection.close()
+                setattr(self.__local, name, None)
+
+
+def convertDatabaseToMBTiles(sourcePath: str, targetPath: str, server: Union[str, None] = None,
+                             name: Union[str, None] = None, batchSize: int = 1000, deduplicate: bool = False) -> int:
+    """ copies the tiles of one tile server from an offline database of the old format
+        (tables tiles/server keyed by the server URL) into an MBTiles file, returns the number of tiles;
+        server may be omitted if the database contains a single server """
+    source = sqlite3.connect(f"file:{sourcePath}?mode=ro", uri=True)
+    try:
+        server = selectLegacyServer(source, sourcePath, server)
+
+        target = MBTilesStore(targetPath, deduplicate=deduplicate)
+        count = 0
+        tileFormat = None
+        minZoom, maxZoom = None, None
+        extent: Dict[int, list] = {}  # zoom: [min x, min y, max x, max y]
+        rows = source.execute("SELECT zoom, x, y, tile_image FROM tiles WHERE server=?;", (server,))
+        while True:
+            batch = rows.fetchmany(batchSize)
+            if not batch:
+                break
+            target.putTiles(batch)
+            target.commit()
+            for zoom, x, y, data in batch:
+                tileFormat = tileFormat or imageFormat(data)
+                minZoom = zoom if minZoom is None else min(minZoom, zoom)
+                maxZoom = zoom if maxZoom is None else max(maxZoom, zoom)
+                box = extent.setdefault(zoom, [x, y, x, y])
+                box[:] = [min(box[0], x), min(box[1], y), max(box[2], x), max(box[3], y)]
+            count += len(batch)
+    finally:
+        source.close()
+
+    target.setMetadata({"name": name or os.path.splitext(os.path.basename(targetPath))[0],
+                        "format": tileFormat or "png",
+                        "type": "baselayer",
+                        "version": "1.1",
+                        "tile_server": server})
+    if count:
+        box = extent[maxZoom]
+        top, left = osm_to_decimal(box[0], box[1], maxZoom)
+        bottom, right = osm_to_decimal(box[2] + 1, box[3] + 1, maxZoom)
+        target.extendMetadata(minZoom, maxZoom, (left, bottom, right, top))
+    target.close()
+    return count
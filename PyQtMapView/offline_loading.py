@@ -1,34 +1,55 @@
 import os
 import time
+import queue
+import heapq
+import random
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 import sqlite3
 import threading
 import requests
 import sys
 import math
-from PIL import Image, UnidentifiedImageError
 
 from PyQt5.QtCore import QThread, pyqtSignal, QObject
 
 
 from .utility_functions import decimal_to_osm, osm_to_decimal
+from .tile_http import getTileClient, legacyServerUrl
+from .async_fetch import AsyncTileFetcher
+from .tile_rate_limit import getRateLimiter, AimdConcurrencyLimit, STOP_CHECK_INTERVAL
+from .tile_failures import retryAfterSeconds, ServerCircuitBreaker
+from .mbtiles import MBTilesStore, imageFormat, isMBTiles, writeTileFile, tileFileSize, tileFilesInColumns
+from .tile_store import BatchedTileWriter, connectReader, connectWriter, tileHash
+from .tile_ranges import rectangleSpans, circleSpans, polygonSpans, corridorSpans, spanTiles, countSpanTiles, TileRangeSet
+from .tile_journal import SeedJournal, seedJobId
+from .tile_estimate import stratifiedSample, stratumSizes, stratifiedEstimate
+from .tile_metrics import SeedMetrics
+from .tile_recompress import TileRecompressor, checkRecompressionPolicy
+from .tile_freshness import TileFreshnessStore
 
 
 class OfflineLoader (QObject):
     signalDownloadCountTile = pyqtSignal(int)
     signalDownloadCount = pyqtSignal(int)
     signalZoom = pyqtSignal(int)
+    signalStats = pyqtSignal(dict)
     
-    def __init__(self, path=None, tileServer=None, name_server = None, maxZoom=19, storage_mode: int = 0, selection_mode: int = 0, console_output: bool = True):
+    def __init__(self, path=None, tileServer=None, name_server = None, maxZoom=19, storage_mode: int = 0, selection_mode: int = 0, console_output: bool = True,
+                 subdomains: tuple = None, fetcher: AsyncTileFetcher = None,
+                 rate_limit: float = None, burst: int = None, max_concurrent: int = None, job_id: str = None,
+                 recompression: dict = None, refresh_age: float = None):
         super().__init__()
         if tileServer is None:
-            self.tileServer = "https://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+            self.tileServer = "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png"
             self.name_server = "OpenStreetMap"
         else:
             self.tileServer = tileServer
             self.name_server = name_server
+        # {s} in tileServer is replaced by one of the subdomains (default a, b, c)
+        self.subdomains = subdomains
         
-        # 0 - DataBase, 1 - Files
-        if storage_mode > 1:
+        # 0 - DataBase, 1 - Files, 2 - MBTiles, 3 - MBTiles with every distinct image stored once
+        if storage_mode > 3:
             self.storage_mode = 0
         else:
             self.storage_mode = storage_mode
@@ -36,16 +57,36 @@ class OfflineLoader (QObject):
         if path is None:
             if self.storage_mode == 0:
                 self.db_path = os.path.join(os.path.abspath(os.getcwd()), f"{self.name_server}.db")
+            elif self.storage_mode in (2, 3):
+                self.db_path = os.path.join(os.path.abspath(os.getcwd()), f"{self.name_server}.mbtiles")
             else:
                 self.db_path = os.path.join(os.path.abspath(os.getcwd()), f"{self.name_server}")
         else:
             if self.storage_mode == 0:
                 self.db_path = os.path.join(path, f"{self.name_server}.db")
+            elif self.storage_mode in (2, 3):
+                self.db_path = os.path.join(path, f"{self.name_server}.mbtiles")
             else: 
                 self.db_path = os.path.join(path, f"{self.name_server}")
+        self.mbtiles = None
+        self.tile_writer = None
         
-        # 0 - Rectangles, 1 - Circle
-        if selection_mode > 1:
+        # completed tiles are journaled next to the storage, so an interrupted job resumes where it stopped;
+        # without job_id the id is derived from the job parameters
+        self.job_id = job_id
+        self.journal = None
+        self.journal_interval = 5.0 # seconds between journal checkpoints
+        
+        # columns of the selection checked against the storage at once, see __pending_spans
+        self.existence_chunk = 256
+        self.existence_connection = None
+        self.number_of_stored = 0
+        
+        # mean tile size in bytes by zoom level measured by estimate_offline_tiles, otherwise 8 KB are assumed
+        self.estimated_tile_size = {}
+        
+        # 0 - Rectangles, 1 - Circle, 2 - Polygon, 3 - Corridor along a polyline
+        if selection_mode > 3:
             self.selection_mode = 0
         else:
             self.selection_mode = selection_mode
@@ -53,133 +94,272 @@ class OfflineLoader (QObject):
         self.maxZoom = maxZoom
         self.console_output = console_output
         
-        self.task_queue = []
-        self.result_queue = []
+        # tiles are enumerated lazily into the bounded task_queue while they are downloaded,
+        # so memory does not grow with the selected area; failed tiles wait in retry_queue,
+        # a heap ordered by the time they may be requested again; retry_lock guards it and attempts
+        self.task_queue_size = 4096
+        self.task_queue = queue.Queue(maxsize=self.task_queue_size)
+        self.retry_queue = []
+        self.retry_lock = threading.Lock()
+        self.result_queue = queue.Queue()
         self.thread_pool = []
+        self.workers_stop = threading.Event()
         self.lock = threading.Lock()
         self.number_of_threads = 50
         
+        # a failed download is retried after retry_delay * 2 ** (attempt - 1) seconds, at most max_retry_delay
+        # or as long as the server asks with Retry-After; after max_retries retries the tile is given up and
+        # reported in failed_tiles. A tile the server does not have (404, 410, 204) is completed at once, like a stored one
+        self.max_retries = 5
+        self.retry_delay = 1.0
+        self.max_retry_delay = 60.0
+        self.attempts = {}
+        self.failed_tiles = {} # (zoom, x, y): reason
+        
+        # keep-alive connections shared with the map views using the same server
+        self.http_client = getTileClient(self.tileServer, self.subdomains)
+        # requests per second, burst and concurrent requests are limited per server for the whole process,
+        # rate_limit, burst and max_concurrent change the limits of this server
+        self.rate_limiter = getRateLimiter(self.tileServer, rate_limit, burst, max_concurrent)
+        # while the server keeps failing no tile is requested until the circuit breaker of the job lets a probe through,
+        # at least every probe_interval seconds; the job is stopped when the server has not answered for unavailable_timeout
+        # seconds. The breaker is not the one of the map views, so a failing job does not blank the map
+        self.probe_interval = 10.0
+        self.unavailable_timeout = 60.0
+        self.breaker = ServerCircuitBreaker(maxDelay=self.probe_interval)
+        self.last_answer = time.monotonic()
+        
+        # with an asyncio fetcher the threads only dispatch downloads,
+        # up to max_in_flight downloads run concurrently on the fetcher's event loop
+        self.fetcher = fetcher
+        self.max_in_flight = 1000
+        if self.fetcher is not None:
+            self.number_of_threads = 4
+        
+        # the number of concurrent downloads starts at initial_concurrency and follows the measured latency
+        # and errors (AIMD), up to number_of_threads or, with an asyncio fetcher, max_in_flight
+        self.initial_concurrency = 8
+        self.concurrency = None
+        
+        # seconds between two signalDownloadCountTile signals of a running zoom level
+        self.progress_interval = 0.1
+        
+        # rates, latencies, per zoom counters and ETA of the running job, see stats();
+        # signalStats sends them every stats_interval seconds
+        self.metrics = SeedMetrics()
+        self.stats_interval = 1.0
+        self.selected_tiles = {} # zoom: tiles of the selection
+        
+        # downloaded tiles are encoded again before they are stored, e.g. {"format": "png-palette"} or
+        # {"format": "jpeg", "quality": 60}, see tile_recompress.recompressTile; the tiles are recompressed by
+        # recompression_workers processes (default: one per CPU), a tile already in the format is stored unchanged if it does not get smaller;
+        # the processes are spawned, so the script starting the job needs an if __name__ == "__main__": guard
+        if recompression is not None:
+            checkRecompressionPolicy(recompression)
+        self.recompression = recompression
+        self.recompression_workers = None
+        self.recompressor = None
+        # downloaded tiles wait here for the recompressor, whose submit() blocks while the pool is busy;
+        # that must not happen on the fetcher's event loop thread, the downloads wait instead (see save_offline_tiles_thread)
+        self.recompress_queue = queue.Queue()
+        
+        # the fetch time, ETag and Last-Modified of every downloaded tile are recorded in the storage (see TileFreshnessStore);
+        # with refresh_age (seconds) stored tiles fetched longer ago are requested again with conditional requests,
+        # a tile answered with 304 Not Modified or the same bytes is not written again
+        self.refresh_age = refresh_age
+        self.refresh_cutoff = 0.0
+        self.freshness = None
+        self.stale_tiles = TileRangeSet() # stored tiles requested again
+        # (zoom, x, y, headers, hash, previous record, fetch time) of the tiles handled since the last checkpoint; they are only
+        # recorded once their tiles are committed, so a tile is never marked fresh with bytes that were not stored
+        self.fetched_tiles = []
+        
         self.running = True
         
     def save_offline_tiles_thread(self):
-        if self.storage_mode == 0: 
-            dbConnection = sqlite3.connect(self.db_path, timeout=10)
-            dbCursor = dbConnection.cursor()
+        # only tiles missing from the storage are queued, see __pending_spans
+        while not self.workers_stop.is_set():
+            task = self.__next_task()
+            if task is None:
+                continue
+            zoom, x, y = task
+            # a stale stored tile is requested with the validators it was fetched with
+            entry = self.freshness.get(zoom, x, y) if task in self.stale_tiles else None
+            headers = entry.conditionalHeaders() if entry is not None else None
+            # the breaker wakes the waiting workers when a probe may be sent or the probe completed,
+            # the waits end every STOP_CHECK_INTERVAL seconds to see whether the job was stopped
+            while not self.breaker.waitForRequest(STOP_CHECK_INTERVAL):
+                if self.workers_stop.is_set():
+                    return
+            if self.workers_stop.wait(self.breaker.backoff()):
+                return
+            while self.recompressor is not None and self.recompress_queue.qsize() > self.recompressor.workers * 4:
+                if self.workers_stop.wait(0.05):
+                    return
+            if not self.concurrency.acquire(self.workers_stop):
+                return
+            if self.rate_limiter.acquire(self.workers_stop) is None:
+                self.concurrency.cancel()
+                return
+            start = time.monotonic()
+            if self.fetcher is not None:
+                try:
+                    future = self.fetcher.submit(self.http_client.url(zoom, x, y), headers=headers)
+                except Exception as err:
+                    # the request was never sent, the slots are released and the tile retried like a failed one
+                    self.__download_finished(task, start, error=type(err).__name__)
+                    continue
+                future.add_done_callback(lambda future, task=task, start=start, entry=entry: self.__tile_fetched(task, future, start, entry))
+                continue
+            try:
+                response = self.http_client.get(zoom, x, y, headers=headers)
+            except Exception as err:
+                self.__download_finished(task, start, error=type(err).__name__)
+            else:
+                self.__download_finished(task, start, response.status_code, response.content, response.headers, entry=entry)
 
+    def __recompress_thread(self):
+        # hands the downloaded tiles to the recompressor until None is queued
         while True:
-            self.lock.acquire()
-            if len(self.task_queue) > 0:
-                task = self.task_queue.pop()
-                self.lock.release()
-                zoom, x, y = task[0], task[1], task[2]
-                flag = 1
-                if self.storage_mode == 0: 
-                    check_existence_cmd = f"""SELECT t.zoom, t.x, t.y FROM tiles t WHERE t.zoom=? AND t.x=? AND t.y=? AND server=?;"""
-                    try:
-                        dbCursor.execute(check_existence_cmd, (zoom, x, y, self.tileServer))
-                    except sqlite3.OperationalError:
-                        self.lock.acquire()
-                        self.task_queue.append(task)
-                        self.lock.release()
-                        continue
-                    result = dbCursor.fetchall()
-                    flag = len(result)
-                elif self.storage_mode == 1:
-                    tile_path = os.path.join(self.db_path, self.name_server, f"{zoom}", f"{x}", f"{y}.png")
-                    if(not os.path.exists(tile_path)):
-                       flag = 0
-                    
-                if flag == 0:
-
-                    try:
-                        url = self.tileServer.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
-                        imageData = requests.get(url, stream=True, headers={"User-Agent": "PyQtMapView"}).content
-
-                        self.lock.acquire()
-                        self.result_queue.append((zoom, x, y, self.tileServer, imageData))
-                        self.lock.release()
-
-                    except sqlite3.OperationalError:
-                        self.lock.acquire()
-                        self.task_queue.append(task)  # re-append task to task_queue
-                        self.lock.release()
-
-                    except UnidentifiedImageError:
-                        self.lock.acquire()
-                        self.result_queue.append((zoom, x, y, self.tileServer, None))
-                        self.lock.release()
-
-                    except Exception as err:
-                        sys.stderr.write(str(err) + "\n")
-                        self.lock.acquire()
-                        self.task_queue.append(task)
-                        self.lock.release()
-                else:
-                    self.lock.acquire()
-                    self.result_queue.append((zoom, x, y, self.tileServer, None))
-                    self.lock.release()
+            item = self.recompress_queue.get()
+            if item is None:
+                return
+            task, content, fetch = item
+            self.recompressor.submit(content, lambda data, task=task, fetch=fetch: self.result_queue.put((*task, self.tileServer, data, fetch)))
+
+    def __next_task(self):
+        # a failed tile whose retry delay has passed comes first
+        with self.retry_lock:
+            if self.retry_queue and self.retry_queue[0][0] <= time.monotonic():
+                return heapq.heappop(self.retry_queue)[1]
+        try:
+            return self.task_queue.get(timeout=0.1)
+        except queue.Empty:
+            return None
+
+    def __tile_fetched(self, task, future, start, entry):
+        # runs on the fetcher's event loop thread; every outcome goes through __download_finished,
+        # which stores only 200 answers, so an error page is never saved as a tile
+        try:
+            response = future.result()
+        except (Exception, CancelledError) as err:
+            # a request cancelled because the fetcher was closed still releases its slots and completes the tile
+            self.__download_finished(task, start, error=type(err).__name__)
+        else:
+            self.__download_finished(task, start, response.status, response.content, response.headers, entry=entry)
+
+    def __download_finished(self, task, start, status=None, content=None, headers=None, error=None, entry=None):
+        latency = time.monotonic() - start
+        # the time the answer arrived, not the later checkpoint that records it
+        fetched = time.time()
+        self.rate_limiter.release()
+        if status in (200, 204, 304, 404, 410):
+            self.breaker.success()
+            self.last_answer = time.monotonic()
+        if status == 304 and entry is not None:
+            # the stored tile is still current
+            self.concurrency.release(True, latency)
+            self.__tile_unchanged(task, 0, latency, (headers, entry.hash, entry, fetched))
+        elif status == 200:
+            self.concurrency.release(True, latency)
+            # the validators and hash of the download, recorded by the main loop when the tile is stored
+            fetch = (headers, tileHash(content), None, fetched)
+            if entry is not None and entry.hash == fetch[1]:
+                self.__tile_unchanged(task, len(content), latency, (headers, entry.hash, entry, fetched))
+                return
+            self.metrics.tileLoaded(task[0], len(content), latency)
+            self.__forget_attempts(task)
+            if self.recompressor is not None:
+                self.recompress_queue.put((task, content, fetch))
             else:
-                self.lock.release()
+                self.result_queue.put((*task, self.tileServer, content, fetch))
+        elif status in (204, 404, 410):
+            # the server has no such tile, asking again does not help
+            self.concurrency.release(True)
+            self.__forget_attempts(task)
+            self.metrics.tileMissing(task[0])
+            self.result_queue.put((*task, self.tileServer, None, None))
+        else:
+            # timeouts, connection errors, 429 and 5xx slow the download down and are retried later
+            self.concurrency.release(False)
+            self.metrics.requestFailed(task[0])
+            retry_after = retryAfterSeconds(headers) if headers else None
+            self.breaker.failure(retry_after)
+            reason = error if status is None else f"HTTP {status}"
+            with self.retry_lock:
+                attempt = self.attempts.get(task, 0) + 1
+                if attempt <= self.max_retries:
+                    self.attempts[task] = attempt
+                    delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempt - 1))
+                    if retry_after is not None:
+                        delay = max(delay, retry_after)
+                    # jitter, so tiles failed together are not retried together
+                    delay *= random.uniform(1.0, 1.5)
+                    heapq.heappush(self.retry_queue, (time.monotonic() + delay, task))
+                    return
+            self.__tile_failed(task, reason)
 
-            time.sleep(0.01)
+    def __forget_attempts(self, task):
+        # attempts is updated by the workers and the fetcher's event loop thread
+        with self.retry_lock:
+            self.attempts.pop(task, None)
+
+    def __tile_unchanged(self, task, size, latency, fetch):
+        # nothing is stored, the tile counts as completed and gets a new fetch time
+        self.__forget_attempts(task)
+        self.metrics.tileUnchanged(task[0], size, latency)
+        self.result_queue.put((*task, self.tileServer, None, fetch))
+
+    def __tile_failed(self, task, reason):
+        self.__forget_attempts(task)
+        self.failed_tiles[task] = reason
+        self.metrics.tileFailed(task[0])
+        self.result_queue.put((*task, self.tileServer, None, None))
     
     def load_task_queue(self, position_a, position_b = None, zoom: int = 0):
-        
-        self.lock.acquire()
-        # Circle
-        if self.selection_mode == 1:
-            center_circle = position_a
-            lat_offset = self.radius / 111.0
-            lon_offset = self.radius / (111.0 * math.cos(math.radians(center_circle[0])))
-            # Углы квадрата
-            upper_left = (center_circle[0] + lat_offset, center_circle[1] - lon_offset)
-            lower_right = (center_circle[0] - lat_offset, center_circle[1] + lon_offset)
-        
-            center = decimal_to_osm(*center_circle, zoom)
-            upperLeftTilePos = decimal_to_osm(*upper_left, zoom)
-            lowerRightTilePos = decimal_to_osm(*lower_right, zoom)
-            # Проходим по всем точкам в квадрате, ограниченном кругом
-            for x in range(math.floor(upperLeftTilePos[0]), math.ceil(lowerRightTilePos[0]) + 1):
-                for y in range(math.floor(upperLeftTilePos[1]), math.ceil(lowerRightTilePos[1]) + 1):
-                    # Проверяем, находится ли точка (x, y) внутри круга
-                    if ((x - round(center[0])) ** 2 + 
-                        (y - round(center[1])) ** 2 <= 
-                        round(upperLeftTilePos[0] - center[0]) ** 2 and x >= 0 and y >= 0):
-                        
-                        element = (zoom, x, y)
-                        if element not in self.task_queue:
-                            self.task_queue.append(element)
-        # Rectangles
-        else:
-            upperLeftTilePos = decimal_to_osm(*position_a, zoom)
-            lowerRightTilePos = decimal_to_osm(*position_b, zoom)
-            for x in range(math.floor(upperLeftTilePos[0]), math.ceil(lowerRightTilePos[0]) + 1):
-                for y in range(math.floor(upperLeftTilePos[1]), math.ceil(lowerRightTilePos[1]) + 1):
-                    self.task_queue.append((zoom, x, y))
-        self.number_of_tasks = len(self.task_queue)
-        self.lock.release()
+        # only the columns of the missing tiles are computed here, the tiles themselves are
+        # produced by the feeding thread while the first ones are already being downloaded
+        pending = self.__pending_spans(position_a, position_b, zoom)
+        self.number_of_tasks = countSpanTiles(pending)
+        self.metrics.skipped(zoom, self.selected_tiles.get(zoom, self.number_of_tasks) - self.number_of_tasks)
+        feeder = threading.Thread(daemon=True, target=self.__feed_task_queue, args=(spanTiles(zoom, pending),))
+        feeder.start()
         
         if self.console_output == True:
-            print(f"[save_offline_tiles] zoom: {zoom:<2}  tiles: {self.number_of_tasks:<8}  storage: {math.ceil(self.number_of_tasks * 8 / 1024):>6} MB", end="")
-            print(f"  progress: ", end="")
+            print(f"[save_offline_tiles] zoom: {zoom:<2}  tiles: {self.number_of_tasks:<8}  stored: {self.number_of_stored:<8}  storage: {math.ceil(self.number_of_tasks * self.estimated_tile_size.get(zoom, 8 * 1024) / 1024 ** 2):>6} MB", end="")
+            print("  progress: ", end="")
         
         self.signalZoom.emit(zoom)
         self.signalDownloadCount.emit(self.number_of_tasks)
     
     def save_offline_tiles(self, position_a, position_b = None, zoom_a = 0, zoom_b = 12, radius: int = None):
+        """ rectangle: position_a and position_b are the upper left and lower right corner (lat, lon)
+            circle: position_a is the center, radius in km
+            polygon: position_a is the list of corners (lat, lon)
+            corridor: position_a is the list of points (lat, lon) or a Path, radius is the distance from the line in km """
+        selection = self.__prepare_selection(position_a, position_b, radius)
+        if selection is None:
+            return
+        position_a, radius = selection
         
-        if self.selection_mode == 0:
-            if position_b is None:
-                sys.stderr.write("position_b is None" + "\n")
+        job = {"tile_server": self.tileServer, "path": self.db_path, "storage_mode": self.storage_mode,
+               "selection_mode": self.selection_mode, "position_a": position_a, "position_b": position_b,
+               "zoom_a": zoom_a, "zoom_b": zoom_b, "radius": radius if self.selection_mode in (1, 3) else None}
+        job_id = self.job_id or seedJobId(job)
+        # a refresh needs no journal, the tiles an interrupted refresh requested are fresh when it runs again
+        self.journal = None
+        if self.refresh_age is None:
+            try:
+                self.journal = SeedJournal(f"{self.db_path}.{job_id}.journal", job)
+            except ValueError as err:
+                sys.stderr.write(str(err) + "\n")
                 return
-        else:
-            if radius <= 0:
-                radius = 100 # km
-            self.radius = radius
+            if self.journal.resumed > 0 and self.console_output is True:
+                print(f"[save_offline_tiles] resuming job {job_id}: {self.journal.resumed} tiles already loaded")
             
         if self.storage_mode == 0:
             # connect to database
-            dbConnection = sqlite3.connect(self.db_path)
+            dbConnection = connectWriter(self.db_path)
             dbCursor = dbConnection.cursor()
 
             # create tables if it not exists
@@ -203,10 +383,55 @@ class OfflineLoader (QObject):
             # insert tileServer if not in database
             dbCursor.execute(f"SELECT * FROM server s WHERE s.url='{self.tileServer}';")
             if len(dbCursor.fetchall()) == 0:
-                dbCursor.execute(f"INSERT INTO server (url, maxZoom) VALUES (?, ?);", (self.tileServer, self.maxZoom))
+                dbCursor.execute("INSERT INTO server (url, maxZoom) VALUES (?, ?);", (self.tileServer, self.maxZoom))
                 dbConnection.commit()
 
-        # create threads
+            # tiles are committed in batches by one writer thread instead of one transaction per tile
+            self.tile_writer = BatchedTileWriter(self.db_path, """INSERT OR REPLACE INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);""")
+            self.existence_connection = connectReader(self.db_path)
+        elif self.storage_mode in (2, 3):
+            self.mbtiles = MBTilesStore(self.db_path, deduplicate=self.storage_mode == 3)
+            if "name" not in self.mbtiles.metadata():
+                self.mbtiles.setMetadata({"name": self.name_server, "type": "baselayer", "version": "1.1",
+                                          "tile_server": self.tileServer})
+            format_known = "format" in self.mbtiles.metadata()
+
+        self.recompressor = None
+        recompress_thread = None
+        if self.recompression is not None:
+            self.recompressor = TileRecompressor(self.recompression, self.recompression_workers)
+            self.recompress_queue = queue.Queue()
+            recompress_thread = threading.Thread(daemon=True, target=self.__recompress_thread)
+            recompress_thread.start()
+        self.freshness = TileFreshnessStore(self.__freshness_path(), self.tileServer)
+        self.fetched_tiles = []
+        self.refresh_cutoff = time.time() - self.refresh_age if self.refresh_age is not None else 0.0
+        self.stale_tiles = TileRangeSet()
+
+        # one pooled connection per thread
+        if self.fetcher is None:
+            self.http_client.growPoolSize(self.number_of_threads)
+
+        self.concurrency = AimdConcurrencyLimit(self.initial_concurrency,
+                                                maximum=self.max_in_flight if self.fetcher is not None else self.number_of_threads)
+        self.failed_tiles = {}
+        self.attempts = {}
+        self.breaker = ServerCircuitBreaker(maxDelay=self.probe_interval)
+        self.last_answer = time.monotonic()
+        server_available = True
+        # the whole selection is planned up front, so the ETA covers the zoom levels not started yet
+        self.metrics.reset()
+        self.selected_tiles = {}
+        for zoom in range(round(zoom_a), round(zoom_b + 1)):
+            self.selected_tiles[zoom] = countSpanTiles(self.__selection_spans(position_a, position_b, zoom))
+            self.metrics.plan(zoom, self.selected_tiles[zoom])
+        # results of downloads that were still running when a previous job stopped
+        while not self.result_queue.empty():
+            self.result_queue.get_nowait()
+
+        # create threads, they are stopped when the job ends
+        self.workers_stop.clear()
+        self.thread_pool = []
         for i in range(self.number_of_threads):
             thread = threading.Thread(daemon=True, target=self.save_offline_tiles_thread, args=())
             self.thread_pool.append(thread)
@@ -215,38 +440,69 @@ class OfflineLoader (QObject):
         for thread in self.thread_pool:
             thread.start()
         self.running = True
+        next_stats = time.monotonic() + self.stats_interval
         
         # loop through all zoom levels
         for zoom in range(round(zoom_a), round(zoom_b + 1)):
             self.load_task_queue(position_a = position_a, position_b = position_b,zoom = zoom)
             
             result_counter = 0
+            reported_counter = 0
+            next_report = 0.0
             loading_bar_length = 0
+            next_checkpoint = time.monotonic() + self.journal_interval
             while result_counter < self.number_of_tasks:
+                if (self.breaker.state == self.breaker.CLOSED) != server_available:
+                    server_available = not server_available
+                    sys.stderr.write(f"{self.tileServer} is available again" + "\n" if server_available else
+                                     f"{self.tileServer} is not answering, it is probed every {self.probe_interval:g} s at most" + "\n")
+                if not server_available and time.monotonic() - self.last_answer > self.unavailable_timeout:
+                    sys.stderr.write(f"{self.tileServer} has not answered for {self.unavailable_timeout:g} s, the job is stopped" + "\n")
+                    self.running = False
                 if self.running is False:
-                    zoom = zoom - 1
                     break
-                self.lock.acquire()
-                if len(self.result_queue) > 0:
-                    loading_result = self.result_queue.pop()
-                    self.lock.release()
+                try:
+                    loading_result = self.result_queue.get(timeout=0.1)
+                except queue.Empty:
+                    loading_result = None
+                if loading_result is not None:
                     result_counter += 1
+                    # (zoom, x, y, server, tile data or None) and the fetch recorded in the freshness store or None
+                    loading_result, fetch = loading_result[:5], loading_result[5]
+                    # failed tiles are requested again when the job is resumed
+                    if self.journal is not None and loading_result[:3] not in self.failed_tiles:
+                        self.journal.markDone(*loading_result[:3])
+                    if fetch is not None:
+                        self.fetched_tiles.append((*loading_result[:3], *fetch))
 
                     if loading_result[-1] is not None:
                         if self.storage_mode == 0:
-                            insert_tile_cmd = """INSERT INTO tiles (zoom, x, y, server, tile_image) VALUES (?, ?, ?, ?, ?);"""
-                            dbCursor.execute(insert_tile_cmd, loading_result)
-                            dbConnection.commit()
+                            self.tile_writer.put(loading_result)
+                        elif self.storage_mode in (2, 3):
+                            self.mbtiles.queueTile(*loading_result[:3], loading_result[4])
+                            if not format_known:
+                                self.mbtiles.setMetadata({"format": imageFormat(loading_result[4])})
+                                format_known = True
                         else:
+                            # the extension follows the format of the tile, e.g. of recompressed tiles
+                            writeTileFile(os.path.join(self.db_path, self.name_server), *loading_result[:3], loading_result[4])
+
+                if time.monotonic() >= next_checkpoint:
+                    self.__checkpoint()
+                    next_checkpoint = time.monotonic() + self.journal_interval
 
-                            tile_path = os.path.join(self.db_path, self.name_server, f"{loading_result[0]}", f"{loading_result[1]}", f"{loading_result[2]}.png")
-                            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
-                            with open(tile_path, 'wb') as tile_file:
-                                tile_file.write(loading_result[4])
-                else:
-                    self.lock.release()
+                if time.monotonic() >= next_stats:
+                    self.signalStats.emit(self.stats())
+                    next_stats = time.monotonic() + self.stats_interval
 
-                # update loading bar to current progress (percent)
+                # update loading bar to current progress (percent), only when it changed and
+                # at most every progress_interval seconds or when the zoom level is complete
+                if result_counter == reported_counter:
+                    continue
+                if result_counter < self.number_of_tasks and time.monotonic() < next_report:
+                    continue
+                reported_counter = result_counter
+                next_report = time.monotonic() + self.progress_interval
                 self.signalDownloadCountTile.emit(result_counter)
                 
                 if self.console_output is True:
@@ -256,15 +512,390 @@ class OfflineLoader (QObject):
                         print("█", end="")
                         loading_bar_length += 1
                     
+            # an interrupted zoom level counts too, its tiles loaded so far are stored
+            if self.storage_mode in (2, 3):
+                self.mbtiles.extendMetadata(zoom, zoom, self.__selection_bounds(position_a, position_b))
             if self.running is False: 
+                # tiles of the interrupted zoom level that were not started yet are dropped
+                self.__clear_task_queue()
                 break
             if self.console_output is True:
                 print(f" {result_counter:>8} tiles loaded")
+        # stop the workers, a download still running ends within the timeout of the tile client
+        self.workers_stop.set()
+        for thread in self.thread_pool:
+            thread.join()
+        self.thread_pool = []
+        if self.recompressor is not None:
+            self.recompress_queue.put(None)
+            recompress_thread.join()
+            self.recompressor.shutdown()
+        self.signalStats.emit(self.stats())
         if self.console_output is True:
+            if self.refresh_age is not None:
+                metrics = self.metrics.stats()
+                print(f"[save_offline_tiles] refresh: {len(self.stale_tiles)} stale tiles requested again, {metrics['unchanged']} of them unchanged")
+            if self.recompressor is not None:
+                recompression = self.recompressor.stats()
+                print(f"[save_offline_tiles] {recompression['recompressed']} of {recompression['tiles']} tiles recompressed: "
+                      f"{recompression['bytesIn'] / 1024 ** 2:.1f} MB -> {recompression['bytesOut'] / 1024 ** 2:.1f} MB")
+            if len(self.failed_tiles) > 0:
+                reasons = {}
+                for reason in self.failed_tiles.values():
+                    reasons[reason] = reasons.get(reason, 0) + 1
+                print(f"[save_offline_tiles] {len(self.failed_tiles)} tiles failed: " +
+                      ", ".join(f"{reason}: {count}" for reason, count in sorted(reasons.items(), key=lambda item: -item[1])))
+            missing = self.metrics.stats()["missing"]
+            if missing > 0:
+                print(f"[save_offline_tiles] {missing} tiles are not on the server")
             print("", end="\n\n")
+        # wait until all tiles are committed
         if self.storage_mode == 0:
+            self.tile_writer.close()
+            self.existence_connection.close()
             dbConnection.close()
+        elif self.storage_mode in (2, 3):
+            self.mbtiles.close()
+        self.__record_fetched_tiles()
+        self.freshness.close()
+        # the journal of a finished job is not needed any more, failed tiles are retried when the job is run again
+        if self.journal is None:
+            return
+        if self.running is False or len(self.failed_tiles) > 0:
+            self.journal.save()
+        else:
+            self.journal.remove()
         return
 
+    def estimate_offline_tiles(self, position_a, position_b = None, zoom_a = 0, zoom_b = 12, radius: int = None,
+                               samples_per_zoom: int = 32) -> dict:
+        """ dry run of save_offline_tiles with the same arguments: counts the tiles and requests of every zoom level
+            and projects the bytes to download, the size of the complete selection in the storage and the time the
+            download takes at the rate limit, with 95% confidence bounds. The download is projected from a stratified sample of
+            samples_per_zoom tiles the job would request, requested from the server; the size of the tiles already stored from
+            a sample of the selection read from the storage. If no sampled request is answered the upper bounds are infinite
+            and server_samples is 0. Nothing is stored. """
+        selection = self.__prepare_selection(position_a, position_b, radius)
+        if selection is None:
+            return None
+        position_a, radius = selection
+        self.journal = None
+
+        self.__open_storage_for_reading()
+        try:
+            zooms = {zoom: self.__estimate_zoom(position_a, position_b, zoom, samples_per_zoom)
+                     for zoom in range(round(zoom_a), round(zoom_b + 1))}
+        finally:
+            self.__close_storage_for_reading()
+
+        estimate = {"zooms": zooms}
+        for name in ("tiles", "stored", "requests", "bytes", "storage_bytes", "bytes_low", "bytes_high", "seconds", "seconds_low", "seconds_high"):
+            estimate[name] = sum(zoom_estimate[name] for zoom_estimate in zooms.values())
+        # the zoom levels are sampled independently, so their errors add up as variances
+        bytes_error = math.sqrt(sum((zoom_estimate["bytes_high"] - zoom_estimate["bytes"]) ** 2 for zoom_estimate in zooms.values()))
+        estimate["bytes_low"] = max(0.0, estimate["bytes"] - bytes_error)
+        estimate["bytes_high"] = estimate["bytes"] + bytes_error
+        self.estimated_tile_size.update({zoom: zoom_estimate["tile_bytes"] for zoom, zoom_estimate in zooms.items()
+                                         if zoom_estimate["samples"] > 0})
+
+        if self.console_output is True:
+            for zoom, zoom_estimate in zooms.items():
+                print(f"[estimate_offline_tiles] zoom: {zoom:<2}  tiles: {zoom_estimate['tiles']:<8}  requests: {zoom_estimate['requests']:<8}"
+                      f"  tile: {zoom_estimate['tile_bytes'] / 1024:>6.1f} KB  download: {self.__format_range(zoom_estimate, 'bytes', 1024 ** 2):>22} MB"
+                      f"  time: {self.__format_range(zoom_estimate, 'seconds', 1):>22} s" +
+                      ("  (no server samples)" if zoom_estimate["requests"] > 0 and zoom_estimate["server_samples"] == 0 else ""))
+            print(f"[estimate_offline_tiles] total     tiles: {estimate['tiles']:<8}  requests: {estimate['requests']:<8}"
+                  f"                    download: {self.__format_range(estimate, 'bytes', 1024 ** 2):>22} MB"
+                  f"  time: {self.__format_range(estimate, 'seconds', 1):>22} s"
+                  f"  storage: {estimate['storage_bytes'] / 1024 ** 2:.1f} MB", end="\n\n")
+        return estimate
+
+    @staticmethod
+    def __format_range(estimate: dict, name: str, unit: float) -> str:
+        return f"{estimate[name] / unit:.1f} ({estimate[name + '_low'] / unit:.1f} - {estimate[name + '_high'] / unit:.1f})"
+
+    def __estimate_zoom(self, position_a, position_b, zoom: int, samples: int) -> dict:
+        spans = list(self.__selection_spans(position_a, position_b, zoom))
+        pending = self.__pending_spans(position_a, position_b, zoom)
+        tiles = countSpanTiles(spans)
+        request_count = countSpanTiles(pending)
+        # two tiles of every stratum, so the variance within the strata can be estimated
+        strata = max(1, samples // 2)
+
+        # the download is projected from tiles the job would request, requested from the server a few at a time
+        sample = stratifiedSample(pending, samples, strata, random.Random(zoom))
+        sizes, latencies = {}, {}
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = executor.map(lambda tile: self.__sample_tile(zoom, tile[1], tile[2]), sample)
+            for (stratum, _, _), result in zip(sample, results):
+                if result is not None:
+                    sizes.setdefault(stratum, []).append(result[0])
+                    latencies.setdefault(stratum, []).append(result[1])
+        pending_sizes = stratumSizes(request_count, strata, samples)
+        tile_bytes, tile_bytes_error = stratifiedEstimate(sizes, pending_sizes)
+        latency, latency_error = stratifiedEstimate(latencies, pending_sizes)
+
+        # the stored part of the selection is measured in the storage
+        stored_sizes = {}
+        for stratum, x, y in stratifiedSample(spans, samples, strata, random.Random(zoom)):
+            size = self.__stored_tile_size(zoom, x, y)
+            if size is not None:
+                stored_sizes.setdefault(stratum, []).append(size)
+        stored_tile_bytes = stratifiedEstimate(stored_sizes, stratumSizes(tiles, strata, samples))[0] if stored_sizes else tile_bytes
+
+        server_samples = sum(len(values) for values in latencies.values())
+        estimate = {"tiles": tiles,
+                    "stored": tiles - request_count,
+                    "requests": request_count,
+                    "samples": sum(len(values) for values in sizes.values()),
+                    "server_samples": server_samples,
+                    "tile_bytes": tile_bytes,
+                    "bytes": request_count * tile_bytes,
+                    "storage_bytes": (tiles - request_count) * stored_tile_bytes + request_count * tile_bytes,
+                    "bytes_low": request_count * max(0.0, tile_bytes - tile_bytes_error),
+                    "bytes_high": request_count * (tile_bytes + tile_bytes_error),
+                    "latency": latency,
+                    "seconds": self.__download_seconds(request_count, latency),
+                    "seconds_low": self.__download_seconds(request_count, max(0.0, latency - latency_error)),
+                    "seconds_high": self.__download_seconds(request_count, latency + latency_error)}
+        if request_count > 0 and server_samples == 0:
+            # no sampled request was answered, the download cannot be bounded from above
+            estimate["bytes_high"] = estimate["seconds_high"] = math.inf
+        return estimate
+
+    def __download_seconds(self, request_count: int, latency: float) -> float:
+        # the download is limited by the rate limit or by the number of concurrent requests, which starts
+        # at initial_concurrency and only grows while the server keeps up (see AimdConcurrencyLimit)
+        concurrency = min(self.initial_concurrency, self.max_in_flight if self.fetcher is not None else self.number_of_threads)
+        if self.rate_limiter.maxConcurrent:
+            concurrency = min(concurrency, self.rate_limiter.maxConcurrent)
+        seconds = request_count * latency / concurrency
+        if self.rate_limiter.rate:
+            seconds = max(seconds, request_count / self.rate_limiter.rate)
+        return seconds
+
+    def __sample_tile(self, zoom: int, x: int, y: int):
+        # size in bytes and latency of a tile requested from the server, None if it failed
+        try:
+            with self.rate_limiter.request():
+                start = time.monotonic()
+                response = self.http_client.get(zoom, x, y)
+                latency = time.monotonic() - start
+        except Exception:
+            return None
+        if response.status_code == 200:
+            return len(response.content), latency
+        if response.status_code in (204, 404, 410):
+            return 0, latency
+        return None
+
+    def __stored_tile_size(self, zoom: int, x: int, y: int):
+        # size in bytes of a stored tile, None if it is not stored
+        if self.storage_mode == 0:
+            if self.existence_connection is None:
+                return None
+            row = self.existence_connection.execute(
+                "SELECT length(tile_image) FROM tiles WHERE zoom=? AND x=? AND y=? AND server IN (?, ?);",
+                (zoom, x, y, self.tileServer, legacyServerUrl(self.tileServer, self.http_client.subdomains))).fetchone()
+            return row[0] if row is not None else None
+        elif self.storage_mode in (2, 3):
+            data = self.mbtiles.getTile(zoom, x, y) if self.mbtiles is not None else None
+            return len(data) if data is not None else None
+        return tileFileSize(os.path.join(self.db_path, self.name_server), zoom, x, y)
+
+    def __open_storage_for_reading(self):
+        if self.storage_mode == 0 and os.path.exists(self.db_path):
+            self.existence_connection = connectReader(self.db_path)
+            try:
+                self.existence_connection.execute("SELECT 1 FROM tiles LIMIT 1;")
+            except sqlite3.Error:
+                self.existence_connection.close()
+                self.existence_connection = None
+        elif self.storage_mode in (2, 3) and isMBTiles(self.db_path):
+            self.mbtiles = MBTilesStore(self.db_path, readOnly=True)
+        self.stale_tiles = TileRangeSet()
+        if self.refresh_age is not None:
+            self.refresh_cutoff = time.time() - self.refresh_age
+            if os.path.exists(self.__freshness_path()):
+                self.freshness = TileFreshnessStore(self.__freshness_path(), self.tileServer, readOnly=True)
+
+    def __close_storage_for_reading(self):
+        if self.existence_connection is not None:
+            self.existence_connection.close()
+            self.existence_connection = None
+        if self.mbtiles is not None:
+            self.mbtiles.close()
+            self.mbtiles = None
+        if self.freshness is not None:
+            self.freshness.close()
+            self.freshness = None
+
+    def __prepare_selection(self, position_a, position_b, radius):
+        # checks the selection and returns position_a and radius with their defaults, or None
+        if self.selection_mode == 0:
+            if position_b is None:
+                sys.stderr.write("position_b is None" + "\n")
+                return None
+        elif self.selection_mode == 1:
+            if radius <= 0:
+                radius = 100 # km
+            self.radius = radius
+        else:
+            if hasattr(position_a, "getPositions"):
+                position_a = position_a.getPositions()
+            position_a = [tuple(position) for position in position_a]
+            if len(position_a) < (3 if self.selection_mode == 2 else 1):
+                sys.stderr.write(f"{len(position_a)} positions are not enough for the selection" + "\n")
+                return None
+            if self.selection_mode == 3:
+                if radius is None or radius <= 0:
+                    radius = 1 # km
+                self.radius = radius
+        return position_a, radius
+
+    def __selection_spans(self, position_a, position_b, zoom: int):
+        # columns of the selected tiles, see tile_ranges
+        if self.selection_mode == 1:
+            return circleSpans(position_a, self.radius, zoom)
+        if self.selection_mode == 2:
+            return polygonSpans(position_a, zoom)
+        if self.selection_mode == 3:
+            return corridorSpans(position_a, self.radius, zoom)
+        return rectangleSpans(position_a, position_b, zoom)
+
+    def __pending_spans(self, position_a, position_b, zoom: int) -> list:
+        # tiles completed by an earlier run of the job are skipped, tiles already in the storage are
+        # filtered out in bulk with one range query or directory listing per existence_chunk columns
+        self.number_of_stored = 0
+        pending = []
+        chunk = []
+        spans = self.__selection_spans(position_a, position_b, zoom)
+        if self.journal is not None:
+            spans = self.journal.remaining(zoom, spans)
+        for span in spans:
+            chunk.append(span)
+            if len(chunk) == self.existence_chunk:
+                pending.extend(self.__missing_spans(zoom, chunk))
+                chunk = []
+        if chunk:
+            pending.extend(self.__missing_spans(zoom, chunk))
+        return pending
+
+    def __missing_spans(self, zoom: int, spans: list) -> list:
+        stored = TileRangeSet()
+        rows = self.__stored_tiles(zoom, spans[0][0], spans[-1][0])
+        if self.refresh_age is not None:
+            # stored tiles fetched before the cutoff, or at an unknown time, are requested again
+            fresh = TileRangeSet()
+            if self.freshness is not None:
+                for x, y in self.freshness.freshTiles(zoom, spans[0][0], spans[-1][0], self.refresh_cutoff):
+                    fresh.add(zoom, x, y)
+            columns = {}
+            for x, first, final in spans:
+                columns.setdefault(x, []).append((first, final))
+            for x, y in rows:
+                if (zoom, x, y) in fresh:
+                    stored.add(zoom, x, y)
+                elif any(first <= y <= final for first, final in columns.get(x, ())):
+                    self.stale_tiles.add(zoom, x, y)
+        else:
+            for x, y in rows:
+                stored.add(zoom, x, y)
+        missing = list(stored.subtract(zoom, spans))
+        self.number_of_stored += countSpanTiles(spans) - countSpanTiles(missing)
+        return missing
+
+    def __stored_tiles(self, zoom: int, first_x: int, last_x: int):
+        # (x, y) of the tiles of the columns first_x to last_x in the storage
+        if self.storage_mode == 0:
+            if self.existence_connection is None:
+                return
+            # range scan of the primary key (zoom, x, y, server)
+            yield from self.existence_connection.execute(
+                "SELECT x, y FROM tiles WHERE zoom=? AND x BETWEEN ? AND ? AND server IN (?, ?);",
+                (zoom, first_x, last_x, self.tileServer, legacyServerUrl(self.tileServer, self.http_client.subdomains)))
+        elif self.storage_mode in (2, 3):
+            if self.mbtiles is not None:
+                yield from self.mbtiles.tilesInColumns(zoom, first_x, last_x)
+        else:
+            yield from tileFilesInColumns(os.path.join(self.db_path, self.name_server), zoom, first_x, last_x)
+
+    def __checkpoint(self):
+        # the journal may only list tiles that are committed to the storage
+        if self.storage_mode == 0:
+            self.tile_writer.flush()
+        elif self.storage_mode in (2, 3):
+            self.mbtiles.flush()
+        self.__record_fetched_tiles()
+        self.freshness.flush()
+        if self.journal is not None:
+            self.journal.save()
+
+    def __record_fetched_tiles(self):
+        # called once the tiles of the fetches are committed
+        for zoom, x, y, headers, content_hash, previous, fetched in self.fetched_tiles:
+            self.freshness.record(zoom, x, y, headers, content_hash, previous, fetched)
+        self.fetched_tiles = []
+
+    def __freshness_path(self) -> str:
+        # the fetch times are kept in the database of the tiles, next to the directory of tile files
+        return f"{self.db_path}.freshness.db" if self.storage_mode == 1 else self.db_path
+
+    def __feed_task_queue(self, tiles):
+        # blocks while the task_queue is full, so at most task_queue_size tiles wait in memory
+        for task in tiles:
+            while True:
+                if self.running is False:
+                    return
+                try:
+                    self.task_queue.put(task, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def __clear_task_queue(self):
+        with self.retry_lock:
+            self.retry_queue.clear()
+            self.attempts.clear()
+        while True:
+            try:
+                self.task_queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def __selection_bounds(self, position_a, position_b=None) -> tuple:
+        # left, bottom, right, top in degrees, as used by the MBTiles bounds metadata
+        if self.selection_mode == 1:
+            lat_offset = self.radius / 111.0
+            lon_offset = self.radius / (111.0 * math.cos(math.radians(position_a[0])))
+            position_b = (position_a[0] - lat_offset, position_a[1] + lon_offset)
+            position_a = (position_a[0] + lat_offset, position_a[1] - lon_offset)
+        elif self.selection_mode in (2, 3):
+            lat_offset = self.radius / 111.0 if self.selection_mode == 3 else 0.0
+            lon_offset = max(lat_offset / math.cos(math.radians(lat)) for lat, _ in position_a)
+            position_b = (min(lat for lat, _ in position_a) - lat_offset, max(lon for _, lon in position_a) + lon_offset)
+            position_a = (max(lat for lat, _ in position_a) + lat_offset, min(lon for _, lon in position_a) - lon_offset)
+        return (min(position_a[1], position_b[1]), min(position_a[0], position_b[0]),
+                max(position_a[1], position_b[1]), max(position_a[0], position_b[0]))
+
+    def stats(self) -> dict:
+        """ snapshot of the metrics of the running or last job (see SeedMetrics.stats) with the depths of
+            the queues: tiles waiting to be requested or retried, results waiting to be stored and requests in flight """
+        stats = self.metrics.stats()
+        with self.retry_lock:
+            retries = len(self.retry_queue)
+        stats["queues"] = {"tasks": self.task_queue.qsize(),
+                           "retries": retries,
+                           "results": self.result_queue.qsize(),
+                           "inFlight": self.concurrency.stats()["active"] if self.concurrency is not None else 0}
+        stats["server"] = dict(self.breaker.stats(), unansweredFor=time.monotonic() - self.last_answer)
+        if self.recompressor is not None:
+            stats["recompression"] = self.recompressor.stats()
+        return stats
+
+    def failed_tiles_report(self) -> list:
+        """ returns (zoom, x, y, reason) of every tile the last job gave up on """
+        return [(*tile, reason) for tile, reason in sorted(self.failed_tiles.items())]
+
     def stop_download(self):
         self.running = False
\ No newline at end of file
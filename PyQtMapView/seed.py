@@ -0,0 +1,511 @@
+""" Headless tile seeding, without PyQt5:
+
+    python -m PyQtMapView.seed job.json [--workers 4] [--threads 8] [--progress jsonl|none] [--interval 1]
+
+The job file lists the layers to seed and the regions to seed them in:
+
+    {"path": "tiles",
+     "layers": [{"name": "OpenStreetMap",
+                 "tile_server": "https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
+                 "subdomains": ["a", "b", "c"],
+                 "storage": "mbtiles",
+                 "rate_limit": 20,
+                 "recompress": {"format": "png-palette"}}],
+     "regions": [{"name": "Tomsk", "rectangle": [[56.6, 84.6], [56.3, 85.2]], "zooms": [0, 14]},
+                 {"circle": {"center": [56.48, 84.95], "radius": 20}, "zooms": [15, 16], "layers": ["OpenStreetMap"]},
+                 {"polygon": [[56.6, 84.6], [56.3, 84.9], [56.6, 85.2]], "zooms": 12},
+                 {"corridor": {"points": [[56.5, 84.9], [55.0, 82.9]], "width": 2}, "zooms": [10, 15]}]}
+
+storage is "mbtiles" (default), "mbtiles-deduplicated" or "files", stored like OfflineLoader does with
+storage_mode 2, 3 and 1. rate_limit, burst and max_concurrent limit the whole job and are shared by the
+worker processes. "recompress" encodes the tiles of a layer again in the worker processes before they are
+stored, see tile_recompress.recompressTile for the formats. A region without "layers" is seeded in every layer. Progress is written to stdout as
+one JSON object per line. An interrupted job (SIGINT, SIGTERM) resumes from its journal when run again. """
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+
+from .utility_functions import osm_to_decimal
+from .tile_http import getTileClient
+from .tile_rate_limit import getRateLimiter, DEFAULT_RATE, DEFAULT_BURST, DEFAULT_MAX_CONCURRENT
+from .tile_failures import retryAfterSeconds, ServerCircuitBreaker
+from .mbtiles import MBTilesStore, imageFormat, writeTileFile, tileFilesInColumns
+from .tile_ranges import Span, rectangleSpans, circleSpans, polygonSpans, corridorSpans, countSpanTiles, TileRangeSet
+from .tile_journal import SeedJournal, seedJobId
+from .tile_metrics import SeedMetrics
+from .tile_recompress import recompressTile, checkRecompressionPolicy
+
+
+STORAGES = ("mbtiles", "mbtiles-deduplicated", "files")
+SELECTIONS = ("rectangle", "circle", "polygon", "corridor")
+UNIT_TILES = 64  # tiles downloaded by a worker process per task
+UNAVAILABLE = "server not available"  # reason of the tiles given up when the server kept failing
+MISSING = "missing"  # reason of the tiles the server does not have (404, 410, 204), completed like stored ones
+PROBE_INTERVAL = 10.0  # longest seconds between two probes of a failing server
+UNAVAILABLE_TIMEOUT = 60.0  # seconds without an answer after which a worker gives the server up
+
+
+def loadSeedJob(path: str) -> Dict:
+    """ reads and checks a job file, raises ValueError if it is not a valid job """
+    with open(path, "r", encoding="utf-8") as file:
+        try:
+            job = json.load(file)
+        except json.JSONDecodeError as err:
+            raise ValueError(f"{path}: {err}")
+    checkSeedJob(job)
+    return job
+
+
+def checkSeedJob(job: Dict):
+    layers = job.get("layers")
+    if not layers:
+        raise ValueError("the job has no layers")
+    names = set()
+    for layer in layers:
+        if "tile_server" not in layer or "name" not in layer:
+            raise ValueError("every layer needs a name and a tile_server")
+        if layer["name"] in names:
+            raise ValueError(f"layer {layer['name']} is listed twice")
+        names.add(layer["name"])
+        if layer.get("storage", "mbtiles") not in STORAGES:
+            raise ValueError(f"unknown storage {layer['storage']}, use one of: {', '.join(STORAGES)}")
+        if "recompress" in layer:
+            checkRecompressionPolicy(layer["recompress"])
+    if not job.get("regions"):
+        raise ValueError("the job has no regions")
+    for index, region in enumerate(job["regions"]):
+        name = region.get("name", index)
+        if sum(selection in region for selection in SELECTIONS) != 1:
+            raise ValueError(f"region {name} needs exactly one of: {', '.join(SELECTIONS)}")
+        if "zooms" not in region:
+            raise ValueError(f"region {name} has no zooms")
+        for layer in region.get("layers", ()):
+            if layer not in names:
+                raise ValueError(f"region {name} uses the unknown layer {layer}")
+
+
+def regionZooms(region: Dict) -> range:
+    """ "zooms" is a zoom level or [first, last], both included """
+    zooms = region["zooms"]
+    if isinstance(zooms, int):
+        return range(zooms, zooms + 1)
+    return range(zooms[0], zooms[-1] + 1)
+
+
+def regionSpans(region: Dict, zoom: int) -> Iterator[Span]:
+    """ columns of the tiles of a job region, see tile_ranges """
+    if "rectangle" in region:
+        return rectangleSpans(*region["rectangle"], zoom)
+    if "circle" in region:
+        return circleSpans(region["circle"]["center"], region["circle"]["radius"], zoom)
+    if "polygon" in region:
+        return polygonSpans(region["polygon"], zoom)
+    return corridorSpans(region["corridor"]["points"], region["corridor"]["width"], zoom)
+
+
+def spanBounds(spans: List[Span], zoom: int) -> Tuple[float, float, float, float]:
+    """ left, bottom, right, top in degrees of the tiles of the spans """
+    top, left = osm_to_decimal(min(x for x, _, _ in spans), min(first for _, first, _ in spans), zoom)
+    bottom, right = osm_to_decimal(max(x for x, _, _ in spans) + 1, max(final for _, _, final in spans) + 1, zoom)
+    return left, bottom, right, top
+
+
+def workUnits(spans: Iterable[Span], size: int) -> Iterator[List[Span]]:
+    """ splits spans into lists of at most size tiles, columns longer than that are split too """
+    unit, count = [], 0
+    for x, first, final in spans:
+        while first <= final:
+            end = min(final, first + size - count - 1)
+            unit.append((x, first, end))
+            count += end - first + 1
+            first = end + 1
+            if count == size:
+                yield unit
+                unit, count = [], 0
+    if unit:
+        yield unit
+
+
+class _SeedWorker:
+    """ Downloads of one worker process: a thread per concurrent download, each tile is retried with
+        exponential backoff like OfflineLoader does, the process' share of the rate limit is shared by its threads """
+
+    def __init__(self, layer: Dict, share: float, threads: int, retries: int, retryDelay: float, maxRetryDelay: float):
+        self.template = layer["tile_server"]
+        self.client = getTileClient(self.template, layer.get("subdomains"), threads)
+        self.limiter = getRateLimiter(self.template,
+                                      layer.get("rate_limit", DEFAULT_RATE) * share,
+                                      max(1, round(layer.get("burst", DEFAULT_BURST) * share)),
+                                      max(1, round(layer.get("max_concurrent", DEFAULT_MAX_CONCURRENT) * share)))
+        # probes of a failing server are at most PROBE_INTERVAL apart, after UNAVAILABLE_TIMEOUT
+        # seconds without an answer its tiles are given up and the job is stopped
+        self.breaker = ServerCircuitBreaker(maxDelay=PROBE_INTERVAL)
+        self.lastAnswer = time.monotonic()
+        self.threads = ThreadPoolExecutor(threads)
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.recompression = layer.get("recompress")
+
+    def fetchUnit(self, zoom: int, spans: List[Span]) -> List[tuple]:
+        """ returns (x, y, tile data to store or None, reason of the failure or None, latency of the successful
+            request or None, failed requests, downloaded bytes) of every tile of the spans """
+        tiles = [(x, y) for x, first, final in spans for y in range(first, final + 1)]
+        return list(self.threads.map(lambda tile: self.fetchTile(zoom, *tile), tiles))
+
+    def fetchTile(self, zoom: int, x: int, y: int):
+        errors = 0
+        for attempt in range(self.retries + 1):
+            # woken by the breaker when a probe may be sent or the probe of another thread completed
+            while not self.breaker.waitForRequest(max(0.0, self.lastAnswer + UNAVAILABLE_TIMEOUT - time.monotonic())):
+                if time.monotonic() - self.lastAnswer >= UNAVAILABLE_TIMEOUT:
+                    return x, y, None, UNAVAILABLE, None, errors, 0
+            time.sleep(self.breaker.backoff())
+            self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.client.get(zoom, x, y)
+            except Exception as err:
+                status, headers, reason = None, None, type(err).__name__
+            else:
+                status, headers, reason = response.status_code, response.headers, f"HTTP {response.status_code}"
+            finally:
+                self.limiter.release()
+
+            if status in (200, 204, 404, 410):
+                self.breaker.success()
+                self.lastAnswer = time.monotonic()
+                # the server has no such tile if it is not 200, asking again does not help
+                if status == 200:
+                    latency = time.monotonic() - start
+                    data = response.content
+                    if self.recompression is not None:
+                        data = recompressTile(data, self.recompression)
+                    return x, y, data, None, latency, errors, len(response.content)
+                return x, y, None, MISSING, None, errors, 0
+            # timeouts, connection errors, 429 and 5xx are retried later
+            errors += 1
+            retryAfter = retryAfterSeconds(headers) if headers else None
+            self.breaker.failure(retryAfter)
+            if attempt == self.retries:
+                break
+            delay = min(self.maxRetryDelay, self.retryDelay * 2 ** attempt)
+            if retryAfter is not None:
+                delay = max(delay, retryAfter)
+            time.sleep(delay * random.uniform(1.0, 1.5))
+        return x, y, None, reason, None, errors, 0
+
+
+_worker: Union[_SeedWorker, None] = None
+
+
+def _initWorker(*args):
+    # the parent process decides when to stop, an interrupted worker would lose its downloads
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    global _worker
+    _worker = _SeedWorker(*args)
+
+
+def _fetchUnit(zoom: int, spans: List[Span]):
+    return _worker.fetchUnit(zoom, spans)
+
+
+class SeedProgress:
+    """ Throttled progress reporting: report() passes an event to the callback at most once every
+        interval seconds, events reported with force=True always. """
+
+    def __init__(self, callback: Union[Callable[[Dict], None], None], interval: float = 1.0):
+        self.callback = callback
+        self.interval = interval
+        self.__last = 0.0
+
+    def due(self) -> bool:
+        """ True if the next event would be reported, so it only has to be built then """
+        return self.callback is not None and time.monotonic() - self.__last >= self.interval
+
+    def report(self, event: Dict, force: bool = False):
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        if force or now - self.__last >= self.interval:
+            self.__last = now
+            self.callback(event)
+
+
+def jsonLinesProgress(stream=sys.stdout) -> Callable[[Dict], None]:
+    """ progress callback writing every event as a line of JSON """
+    def write(event: Dict):
+        stream.write(json.dumps(event) + "\n")
+        stream.flush()
+    return write
+
+
+class TileSeeder:
+    """ Seeds the layers of a job (see loadSeedJob) with a pool of worker processes.
+
+        The tiles of a zoom level are cut into work units of unitTiles tiles that the worker processes
+        download with threads threads each, while this process stores the results and keeps a journal
+        of the completed tiles (see SeedJournal). Only a few units per worker are handed out at a time,
+        so memory does not grow with the area. stop() ends the job after the running units. """
+
+    def __init__(self, job: Dict, progress: Union[Callable[[Dict], None], None] = None, interval: float = 1.0,
+                 workers: Union[int, None] = None, threads: Union[int, None] = None):
+        checkSeedJob(job)
+        self.job = job
+        self.path = os.path.abspath(job.get("path", os.getcwd()))
+        self.workers = max(1, workers or job.get("workers", 4))
+        self.threads = max(1, threads or job.get("threads", 8))
+        self.progress = SeedProgress(progress, interval)
+        self.interval = interval
+        self.unitTiles = UNIT_TILES
+        self.maxRetries = 5
+        self.retryDelay = 1.0
+        self.maxRetryDelay = 60.0
+        self.journalInterval = 5.0
+
+        self.stopped = threading.Event()
+        self.failedTiles: Dict[Tuple[str, int, int, int], str] = {}  # (layer, zoom, x, y): reason
+        self.loaded = 0
+        self.missing = 0
+        self.stored = 0
+        self.storedBytes = 0
+        # rates, latencies, per zoom counters and ETA of the job, see stats()
+        self.metrics = SeedMetrics()
+        self.runningUnits = 0
+
+    def stop(self):
+        self.stopped.set()
+
+    def storagePath(self, layer: Dict) -> str:
+        if layer.get("storage", "mbtiles") == "files":
+            return os.path.join(self.path, layer["name"])
+        return os.path.join(self.path, f"{layer['name']}.mbtiles")
+
+    def run(self) -> Dict:
+        """ seeds every layer, returns the number of loaded, already stored, missing and failed tiles, the downloaded
+            and stored bytes and whether the job was stopped before it was complete """
+        start = time.monotonic()
+        # the whole job is planned up front, so the ETA covers the layers and regions not started yet
+        self.metrics.reset()
+        for layer, regions in self.__layerRegions():
+            for region in regions:
+                for zoom in regionZooms(region):
+                    self.metrics.plan(zoom, countSpanTiles(regionSpans(region, zoom)))
+        for layer, regions in self.__layerRegions():
+            if not self.stopped.is_set():
+                self.__seedLayer(layer, regions)
+        summary = {"event": "finished", "loaded": self.loaded, "stored": self.stored, "missing": self.missing,
+                   "failed": len(self.failedTiles),
+                   "downloadedBytes": self.metrics.stats()["bytes"], "storedBytes": self.storedBytes,
+                   "stopped": self.stopped.is_set(), "seconds": round(time.monotonic() - start, 3)}
+        self.progress.report(summary, force=True)
+        return summary
+
+    def stats(self) -> Dict:
+        """ snapshot of the metrics of the job (see SeedMetrics.stats) with the number of work units handed to the workers """
+        stats = self.metrics.stats()
+        stats["queues"] = {"units": self.runningUnits, "unitTiles": self.unitTiles}
+        return stats
+
+    def __layerRegions(self) -> Iterator[Tuple[Dict, List[Dict]]]:
+        for layer in self.job["layers"]:
+            regions = [region for region in self.job["regions"] if layer["name"] in region.get("layers", (layer["name"],))]
+            if regions:
+                yield layer, regions
+
+    def __progressEvent(self, layer: Dict, region: str, zoom: int, done: int, total: int, failed: int) -> Dict:
+        stats = self.metrics.stats()
+        rates = stats["rates"][f"{max(self.metrics.windows)}s"]
+        return {"event": "progress", "layer": layer["name"], "region": region, "zoom": zoom,
+                "done": done, "tiles": total, "failed": failed,
+                "tilesPerSecond": round(rates["tilesPerSecond"], 2), "bytesPerSecond": round(rates["bytesPerSecond"]),
+                "errorRate": round(stats["errorRate"], 4),
+                "eta": round(stats["eta"], 1) if stats["eta"] is not None else None}
+
+    def __seedLayer(self, layer: Dict, regions: List[Dict]):
+        storage = layer.get("storage", "mbtiles")
+        store = None
+        if storage != "files":
+            store = MBTilesStore(self.storagePath(layer), deduplicate=storage == "mbtiles-deduplicated")
+            if "name" not in store.metadata():
+                store.setMetadata({"name": layer["name"], "type": "baselayer", "version": "1.1",
+                                   "tile_server": layer["tile_server"]})
+        # every worker process gets an equal share of the limits of the layer
+        share = 1 / self.workers
+        # spawned workers do not inherit the locks of this process' threads (e.g. the batched writer)
+        pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"), _initWorker,
+                                   (layer, share, self.threads, self.maxRetries, self.retryDelay, self.maxRetryDelay))
+        try:
+            for region in regions:
+                if self.stopped.is_set():
+                    break
+                self.__seedRegion(pool, layer, store, region)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            if store is not None:
+                store.close()
+
+    def __seedRegion(self, pool: ProcessPoolExecutor, layer: Dict, store: Union[MBTilesStore, None], region: Dict):
+        job = {"tile_server": layer["tile_server"], "path": self.storagePath(layer),
+               "storage": layer.get("storage", "mbtiles"), "region": region}
+        name = region.get("name", seedJobId(region))
+        try:
+            journal = SeedJournal(f"{self.storagePath(layer)}.{seedJobId(job)}.journal", job)
+        except ValueError as err:
+            sys.stderr.write(str(err) + "\n")
+            return
+        failed = len(self.failedTiles)
+        formatKnown = store is None or "format" in store.metadata()
+        nextCheckpoint = time.monotonic() + self.journalInterval
+
+        for zoom in regionZooms(region):
+            pending, stored = self.__pendingSpans(layer, store, journal, region, zoom)
+            total = countSpanTiles(pending)
+            self.stored += stored
+            self.metrics.skipped(zoom, countSpanTiles(regionSpans(region, zoom)) - total)
+            event = {"event": "zoom", "layer": layer["name"], "region": name, "zoom": zoom,
+                     "tiles": total, "stored": stored, "resumed": journal.resumed}
+            self.progress.report(event, force=True)
+
+            units = workUnits(pending, self.unitTiles)
+            running = set()
+            done = 0
+            while True:
+                # a few units per worker are queued, the rest is produced when they are taken
+                while not self.stopped.is_set() and len(running) < 2 * self.workers:
+                    unit = next(units, None)
+                    if unit is None:
+                        break
+                    running.add(pool.submit(_fetchUnit, zoom, unit))
+                self.runningUnits = len(running)
+                if not running:
+                    break
+                finished, running = wait(running, timeout=self.interval, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for x, y, data, reason, latency, errors, size in future.result():
+                        done += 1
+                        for _ in range(errors):
+                            self.metrics.requestFailed(zoom)
+                        if reason == MISSING:
+                            self.metrics.tileMissing(zoom)
+                            journal.markDone(zoom, x, y)
+                            self.missing += 1
+                            continue
+                        if data is None:
+                            self.metrics.tileFailed(zoom)
+                            self.failedTiles[(layer["name"], zoom, x, y)] = reason
+                            if reason == UNAVAILABLE and not self.stopped.is_set():
+                                sys.stderr.write(f"{layer['tile_server']} is not available, the job is stopped" + "\n")
+                                self.stop()
+                            continue
+                        self.__storeTile(layer, store, zoom, x, y, data)
+                        if not formatKnown:
+                            store.setMetadata({"format": imageFormat(data)})
+                            formatKnown = True
+                        journal.markDone(zoom, x, y)
+                        self.metrics.tileLoaded(zoom, size, latency)
+                        self.loaded += 1
+                        self.storedBytes += len(data)
+                if time.monotonic() >= nextCheckpoint:
+                    self.__checkpoint(store, journal)
+                    nextCheckpoint = time.monotonic() + self.journalInterval
+                if self.progress.due():
+                    self.progress.report(self.__progressEvent(layer, name, zoom, done, total, len(self.failedTiles) - failed))
+
+            if store is not None and pending:
+                store.extendMetadata(zoom, zoom, spanBounds(pending, zoom))
+            self.progress.report(self.__progressEvent(layer, name, zoom, done, total, len(self.failedTiles) - failed), force=True)
+            if self.stopped.is_set():
+                break
+
+        # the journal of a finished region is not needed any more, failed tiles are retried when the job is run again
+        if self.stopped.is_set() or len(self.failedTiles) > failed:
+            self.__checkpoint(store, journal)
+        else:
+            journal.remove()
+
+    def __pendingSpans(self, layer: Dict, store: Union[MBTilesStore, None], journal: SeedJournal,
+                       region: Dict, zoom: int) -> Tuple[List[Span], int]:
+        # tiles completed by an earlier run are skipped, tiles in the storage are filtered
+        # out with one range query or directory listing per 256 columns
+        pending, chunk, stored = [], [], 0
+        for span in journal.remaining(zoom, regionSpans(region, zoom)):
+            chunk.append(span)
+            if len(chunk) == 256:
+                missing = self.__missingSpans(layer, store, zoom, chunk)
+                stored += countSpanTiles(chunk) - countSpanTiles(missing)
+                pending.extend(missing)
+                chunk = []
+        if chunk:
+            missing = self.__missingSpans(layer, store, zoom, chunk)
+            stored += countSpanTiles(chunk) - countSpanTiles(missing)
+            pending.extend(missing)
+        return pending, stored
+
+    def __missingSpans(self, layer: Dict, store: Union[MBTilesStore, None], zoom: int, spans: List[Span]) -> List[Span]:
+        existing = TileRangeSet()
+        if store is not None:
+            for x, y in store.tilesInColumns(zoom, spans[0][0], spans[-1][0]):
+                existing.add(zoom, x, y)
+        else:
+            for x, y in tileFilesInColumns(os.path.join(self.storagePath(layer), layer["name"]), zoom, spans[0][0], spans[-1][0]):
+                existing.add(zoom, x, y)
+        return list(existing.subtract(zoom, spans))
+
+    def __storeTile(self, layer: Dict, store: Union[MBTilesStore, None], zoom: int, x: int, y: int, data: bytes):
+        if store is not None:
+            store.queueTile(zoom, x, y, data)
+            return
+        # the layout of OfflineLoader's storage_mode 1
+        writeTileFile(os.path.join(self.storagePath(layer), layer["name"]), zoom, x, y, data)
+
+    @staticmethod
+    def __checkpoint(store: Union[MBTilesStore, None], journal: SeedJournal):
+        # the journal may only list tiles that are committed to the storage
+        if store is not None:
+            store.flush()
+        journal.save()
+
+    def failedTilesReport(self) -> List[Tuple[str, int, int, int, str]]:
+        """ returns (layer, zoom, x, y, reason) of every tile the job gave up on """
+        return [(*tile, reason) for tile, reason in sorted(self.failedTiles.items())]
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m PyQtMapView.seed", description="Seeds map tiles without a GUI.",
+                                     epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("job", help="job file (JSON) listing the layers and regions to seed")
+    parser.add_argument("--workers", type=int, help="worker processes (default: job \"workers\" or 4)")
+    parser.add_argument("--threads", type=int, help="downloads per worker process (default: job \"threads\" or 8)")
+    parser.add_argument("--progress", choices=("jsonl", "none"), default="jsonl", help="progress on stdout")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between progress lines")
+    arguments = parser.parse_args(argv)
+
+    try:
+        job = loadSeedJob(arguments.job)
+    except (OSError, ValueError) as err:
+        sys.stderr.write(str(err) + "\n")
+        return 2
+    seeder = TileSeeder(job, jsonLinesProgress() if arguments.progress == "jsonl" else None,
+                        arguments.interval, arguments.workers, arguments.threads)
+    # an interrupted job keeps its journal and resumes when it is run again
+    signal.signal(signal.SIGINT, lambda *args: seeder.stop())
+    signal.signal(signal.SIGTERM, lambda *args: seeder.stop())
+    summary = seeder.run()
+    for layer, zoom, x, y, reason in seeder.failedTilesReport()[:20]:
+        sys.stderr.write(f"failed: {layer} {zoom}/{x}/{y} {reason}" + "\n")
+    return 1 if summary["stopped"] or summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
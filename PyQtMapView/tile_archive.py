@@ -0,0 +1,269 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterator, Tuple, Union
+
+from .mbtiles import MBTilesStore, imageFormat, isMBTiles, tmsRow
+from .tile_store import selectLegacyServer, tileHash
+
+
+ARCHIVE_EXTENSION = ".tilepack"
+MAGIC = b"PQMVTILE"
+VERSION = 1
+# magic, version, reserved, tile count, directory offset, metadata offset, metadata length; all little endian
+HEADER = struct.Struct("<8sIIQQQQ")
+
+
+def tileId(zoom: int, x: int, y: int) -> int:
+    """ sort key of a tile in the archive directory: by zoom, then column, then row """
+    return (zoom << 58) | (x << 29) | y
+
+
+def tileFromId(tile: int) -> Tuple[int, int, int]:
+    return tile >> 58, (tile >> 29) & 0x1FFFFFFF, tile & 0x1FFFFFFF
+
+
+class TileArchive:
+    """ Read-only single-file tile archive, memory mapped.
+
+        The file holds the tile data, a directory sorted by tile id (three arrays of ids, offsets and
+        lengths) and JSON metadata. A lookup is a binary search in the mapped id array; the tile data
+        is returned as a memoryview of the mapping, so reading a tile copies nothing and costs no
+        system call once the pages are in the page cache. Safe to share between threads. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__file = open(path, "rb")
+        try:
+            self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self.__file.close()
+            raise ValueError(f"{path} is not a tile archive")
+        magic, version, _, count, directoryOffset, metadataOffset, metadataLength = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a tile archive")
+
+        view = memoryview(self.__map)
+        self.__ids = view[directoryOffset:directoryOffset + 8 * count].cast("Q")
+        self.__offsets = view[directoryOffset + 8 * count:directoryOffset + 16 * count].cast("Q")
+        self.__lengths = view[directoryOffset + 16 * count:directoryOffset + 20 * count].cast("I")
+        if sys.byteorder != "little":
+            self.__ids, self.__offsets, self.__lengths = (self.__swapped(values) for values in
+                                                          (self.__ids, self.__offsets, self.__lengths))
+        self.__data = view
+        self.__metadata: Dict[str, Union[str, int, float]] = json.loads(bytes(view[metadataOffset:metadataOffset + metadataLength]))
+        self.tileServer = self.__metadata.get("tile_server")
+
+    @staticmethod
+    def __swapped(values: memoryview) -> array:
+        values = array(values.format, values)
+        values.byteswap()
+        return values
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+    def __index(self, zoom: int, x: int, y: int) -> int:
+        tile = tileId(zoom, x, y)
+        index = bisect_left(self.__ids, tile)
+        return index if index < len(self.__ids) and self.__ids[index] == tile else -1
+
+    def servesTileServer(self, *templates: str) -> bool:
+        """ an archive without a "tile_server" entry serves every tile server """
+        return self.tileServer is None or self.tileServer in templates
+
+    def getTile(self, zoom: int, x: int, y: int) -> Union[memoryview, None]:
+        """ returns the tile data as a view into the mapped file, or None """
+        index = self.__index(zoom, x, y)
+        if index < 0:
+            return None
+        offset = self.__offsets[index]
+        return self.__data[offset:offset + self.__lengths[index]]
+
+    def hasTile(self, zoom: int, x: int, y: int) -> bool:
+        return self.__index(zoom, x, y) >= 0
+
+    def tiles(self) -> Iterator[Tuple[int, int, int, memoryview]]:
+        """ yields (zoom, x, y, data) of every tile in directory order """
+        for index in range(len(self.__ids)):
+            offset = self.__offsets[index]
+            yield (*tileFromId(self.__ids[index]), self.__data[offset:offset + self.__lengths[index]])
+
+    def metadata(self) -> Dict[str, Union[str, int, float]]:
+        return dict(self.__metadata)
+
+    def close(self):
+        # views into the mapping must be released before it can be closed
+        for name in ("_TileArchive__ids", "_TileArchive__offsets", "_TileArchive__lengths", "_TileArchive__data"):
+            value = self.__dict__.pop(name, None)
+            if isinstance(value, memoryview):
+                value.release()
+        if not self.__map.closed:
+            try:
+                self.__map.close()
+            except BufferError:
+                pass  # a tile view is still referenced, the mapping is closed when it is collected
+        self.__file.close()
+
+    def __enter__(self) -> "TileArchive":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TileArchiveWriter:
+    """ Writes a tile archive in one pass; identical tiles are stored once.
+
+        The file is written next to the target and renamed when finish() is called,
+        so readers never see a partial archive. """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__temporaryPath = path + ".part"
+        self.__file = open(self.__temporaryPath, "wb")
+        self.__file.write(b"\0" * HEADER.size)
+        self.__offset = HEADER.size
+        self.__ids = array("Q")
+        self.__offsets = array("Q")
+        self.__lengths = array("I")
+        self.__stored: Dict[str, Tuple[int, int]] = {}  # tile hash: (offset, length)
+        self.format = None
+        self.minZoom, self.maxZoom = None, None
+
+    def addTile(self, zoom: int, x: int, y: int, data: bytes):
+        digest = tileHash(data)
+        stored = self.__stored.get(digest)
+        if stored is None:
+            self.__file.write(data)
+            stored = self.__stored[digest] = (self.__offset, len(data))
+            self.__offset += len(data)
+        self.__ids.append(tileId(zoom, x, y))
+        self.__offsets.append(stored[0])
+        self.__lengths.append(stored[1])
+        self.format = self.format or imageFormat(bytes(data[:12]))
+        self.minZoom = zoom if self.minZoom is None else min(self.minZoom, zoom)
+        self.maxZoom = zoom if self.maxZoom is None else max(self.maxZoom, zoom)
+
+    def finish(self, metadata: Union[Dict[str, Union[str, int, float]], None] = None) -> int:
+        """ writes the directory and the metadata and moves the archive into place, returns the number of tiles """
+        # sort the directory by tile id, a tile added twice keeps its last data
+        order = sorted(range(len(self.__ids)), key=self.__ids.__getitem__)
+        ids, offsets, lengths = array("Q"), array("Q"), array("I")
+        for index in order:
+            if ids and ids[-1] == self.__ids[index]:
+                offsets[-1], lengths[-1] = self.__offsets[index], self.__lengths[index]
+            else:
+                ids.append(self.__ids[index])
+                offsets.append(self.__offsets[index])
+                lengths.append(self.__lengths[index])
+        if sys.byteorder != "little":
+            for values in (ids, offsets, lengths):
+                values.byteswap()
+
+        padding = -self.__offset % 8
+        self.__file.write(b"\0" * padding)
+        directoryOffset = self.__offset + padding
+        for values in (ids, offsets, lengths):
+            values.tofile(self.__file)
+
+        metadata = dict(metadata or {})
+        metadata.setdefault("format", self.format or "png")
+        if self.minZoom is not None:
+            metadata.setdefault("minzoom", self.minZoom)
+            metadata.setdefault("maxzoom", self.maxZoom)
+        encoded = json.dumps(metadata).encode()
+        metadataOffset = directoryOffset + 20 * len(ids)
+        self.__file.write(encoded)
+
+        self.__file.seek(0)
+        self.__file.write(HEADER.pack(MAGIC, VERSION, 0, len(ids), directoryOffset, metadataOffset, len(encoded)))
+        self.__file.close()
+        os.replace(self.__temporaryPath, self.path)
+        return len(ids)
+
+    def abort(self):
+        self.__file.close()
+        os.remove(self.__temporaryPath)
+
+    def __enter__(self) -> "TileArchiveWriter":
+        return self
+
+    def __exit__(self, excType, *exc):
+        if excType is not None and not self.__file.closed:
+            self.abort()
+
+
+def isTileArchive(path: str) -> bool:
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def exportToArchive(sourcePath: str, targetPath: str, server: Union[str, None] = None) -> int:
+    """ writes the tiles of an offline store into a tile archive, returns the number of tiles.
+        The source may be an MBTiles file, an offline database of the old format (server may be omitted
+        if it contains a single server) or a directory of {zoom}/{x}/{y}.png files """
+    with TileArchiveWriter(targetPath) as writer:
+        if os.path.isdir(sourcePath):
+            metadata = {"name": os.path.basename(os.path.normpath(sourcePath))}
+            for zoomName in os.listdir(sourcePath):
+                if not zoomName.isdigit():
+                    continue
+                for xName in os.listdir(os.path.join(sourcePath, zoomName)):
+                    if not xName.isdigit():
+                        continue
+                    for fileName in os.listdir(os.path.join(sourcePath, zoomName, xName)):
+                        yName = os.path.splitext(fileName)[0]
+                        if yName.isdigit():
+                            with open(os.path.join(sourcePath, zoomName, xName, fileName), "rb") as file:
+                                writer.addTile(int(zoomName), int(xName), int(yName), file.read())
+
+        elif isMBTiles(sourcePath):
+            store = MBTilesStore(sourcePath, readOnly=True)
+            metadata = store.metadata()
+            for zoom, x, row, data in store.readConnection().execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles;"):
+                writer.addTile(zoom, x, tmsRow(zoom, row), data)
+            store.close()
+
+        else:
+            connection = sqlite3.connect(f"file:{sourcePath}?mode=ro", uri=True)
+            try:
+                server = selectLegacyServer(connection, sourcePath, server)
+                metadata = {"name": os.path.splitext(os.path.basename(sourcePath))[0], "tile_server": server}
+                for zoom, x, y, data in connection.execute("SELECT zoom, x, y, tile_image FROM tiles WHERE server=?;", (server,)):
+                    writer.addTile(zoom, x, y, data)
+            finally:
+                connection.close()
+
+        return writer.finish(metadata)
+
+
+def importFromArchive(archivePath: str, targetPath: str, deduplicate: bool = False) -> int:
+    """ writes the tiles of an archive into an MBTiles file (targetPath ending with .mbtiles)
+        or a directory of {zoom}/{x}/{y}.{format} files, returns the number of tiles """
+    with TileArchive(archivePath) as archive:
+        metadata = archive.metadata()
+        if targetPath.endswith(".mbtiles"):
+            store = MBTilesStore(targetPath, deduplicate=deduplicate)
+            store.setMetadata({name: value for name, value in metadata.items() if value is not None})
+            for zoom, x, y, data in archive.tiles():
+                store.queueTile(zoom, x, y, bytes(data))
+            store.close()
+        else:
+            extension = metadata.get("format", "png")
+            for zoom, x, y, data in archive.tiles():
+                tilePath = os.path.join(targetPath, f"{zoom}", f"{x}", f"{y}.{extension}")
+                os.makedirs(os.path.dirname(tilePath), exist_ok=True)
+                with open(tilePath, "wb") as file:
+                    file.write(data)
+        return len(archive)
@@ -0,0 +1,131 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, Set, Union
+
+
+# a 256x256 32-bit tile takes 256 KB once decoded, so 256 MB is about 1000 tiles
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+def imageSize(image) -> int:
+    """ returns the approximate number of bytes used by a QImage, QPixmap or raw bytes """
+    if hasattr(image, "sizeInBytes"):
+        return image.sizeInBytes()
+    if hasattr(image, "depth"):
+        return image.width() * image.height() * max(image.depth(), 8) // 8
+    try:
+        return len(image)
+    except TypeError:
+        return 0
+
+
+class TileCache:
+    """ Thread-safe LRU cache of tile images limited by a memory budget in bytes.
+
+        Keys are (server, zoom, x, y) tuples. Pinned keys (the tiles currently visible
+        on the map) are never evicted, even if the cache goes over its budget. An image object
+        stored under several keys (identical tiles) is counted once against the budget. """
+
+    def __init__(self, maxBytes: int = DEFAULT_CACHE_SIZE, sizeOf: Callable = imageSize):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+
+        self.__lock = threading.Lock()
+        self.__entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key: (image, size)
+        self.__pinned: Set[Hashable] = set()
+        self.__references: Dict[int, int] = {}  # id(image): number of keys holding it
+        self.__bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key) -> bool:
+        with self.__lock:
+            return key in self.__entries
+
+    def get(self, key, default=None):
+        """ Returns the cached image and marks it as recently used """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, image):
+        """ Adds an image to the cache and evicts the least recently used tiles if over budget """
+        size = self.sizeOf(image)
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__release(old)
+            self.__entries[key] = (image, size)
+            references = self.__references.get(id(image), 0)
+            self.__references[id(image)] = references + 1
+            if references == 0:
+                self.__bytes += size
+            self.__evict()
+
+    def remove(self, key) -> bool:
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None:
+                return False
+            self.__release(entry)
+            return True
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__references.clear()
+            self.__bytes = 0
+
+    def setPinned(self, keys: Iterable):
+        """ Replaces the set of keys that must not be evicted """
+        with self.__lock:
+            self.__pinned = set(keys)
+            self.__evict()
+
+    def setMaxBytes(self, maxBytes: int):
+        with self.__lock:
+            self.maxBytes = maxBytes
+            self.__evict()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """ Returns cache counters: hits, misses, evictions, hitRate, entries, pinned, bytes, maxBytes """
+        with self.__lock:
+            requests = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hitRate": self.hits / requests if requests else 0.0,
+                    "entries": len(self.__entries),
+                    "pinned": len(self.__pinned),
+                    "bytes": self.__bytes,
+                    "maxBytes": self.maxBytes}
+
+    def __release(self, entry: tuple):
+        # the lock must be held
+        references = self.__references.pop(id(entry[0])) - 1
+        if references > 0:
+            self.__references[id(entry[0])] = references
+        else:
+            self.__bytes -= entry[1]
+
+    def __evict(self):
+        # the lock must be held; pinned tiles met on the way are moved to the recent end
+        skipped = 0
+        while self.__bytes > self.maxBytes and len(self.__entries) > skipped:
+            key = next(iter(self.__entries))
+            if key in self.__pinned:
+                self.__entries.move_to_end(key)
+                skipped += 1
+                continue
+            self.__release(self.__entries.pop(key))
+            self.evictions += 1
@@ -0,0 +1,76 @@
+import math
+import random
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Dict, List, Sequence, Tuple
+
+from .tile_ranges import Span
+
+
+Z_95 = 1.96  # two-sided 95% quantile of the normal distribution
+
+
+def stratifiedSample(spans: Sequence[Span], samples: int, strata: int,
+                     generator: random.Random = random) -> List[Tuple[int, int, int]]:
+    """ draws about samples tiles as (stratum, x, y). The tiles of the spans are cut, in their order
+        (column by column), into strata of neighbouring tiles and the same number of tiles is drawn
+        without replacement from every stratum, so every part of the area is represented; if there are
+        no more tiles than samples every tile is returned """
+    counts = [final - first + 1 for _, first, final in spans]
+    ends = list(accumulate(counts))
+    total = ends[-1] if ends else 0
+    if total == 0:
+        return []
+    if total <= samples:
+        indices = [(0, index) for index in range(total)]
+    else:
+        strata = max(1, min(strata, samples, total))
+        perStratum = max(1, samples // strata)
+        indices = []
+        for stratum in range(strata):
+            first, final = total * stratum // strata, total * (stratum + 1) // strata
+            indices.extend((stratum, index) for index in generator.sample(range(first, final), min(perStratum, final - first)))
+
+    result = []
+    for stratum, index in indices:
+        span = bisect_right(ends, index)
+        x, first, _ = spans[span]
+        result.append((stratum, x, first + index - (ends[span] - counts[span])))
+    return result
+
+
+def stratumSizes(total: int, strata: int, samples: int) -> Dict[int, int]:
+    """ number of tiles of every stratum used by stratifiedSample() """
+    if total <= samples:
+        return {0: total}
+    strata = max(1, min(strata, samples, total))
+    return {stratum: total * (stratum + 1) // strata - total * stratum // strata for stratum in range(strata)}
+
+
+def stratifiedEstimate(values: Dict[int, List[float]], sizes: Dict[int, int]) -> Tuple[float, float]:
+    """ returns the estimated mean of a population split into strata of the given sizes from the values
+        sampled in every stratum, and the half width of its 95% confidence interval; strata with a single
+        value use the variance of all values """
+    total = sum(sizes[stratum] for stratum in values if values[stratum])
+    everything = [value for stratumValues in values.values() for value in stratumValues]
+    if total == 0 or not everything:
+        return 0.0, 0.0
+    overall = sum(everything) / len(everything)
+    pooledVariance = (sum((value - overall) ** 2 for value in everything) / (len(everything) - 1)
+                      if len(everything) > 1 else 0.0)
+
+    mean, variance = 0.0, 0.0
+    for stratum, stratumValues in values.items():
+        if not stratumValues:
+            continue
+        weight = sizes[stratum] / total
+        count = len(stratumValues)
+        stratumMean = sum(stratumValues) / count
+        if count > 1:
+            stratumVariance = sum((value - stratumMean) ** 2 for value in stratumValues) / (count - 1)
+        else:
+            stratumVariance = pooledVariance
+        mean += weight * stratumMean
+        # finite population correction, a stratum sampled completely adds no uncertainty
+        variance += weight ** 2 * stratumVariance / count * max(0.0, 1 - count / sizes[stratum])
+    return mean, Z_95 * math.sqrt(variance)
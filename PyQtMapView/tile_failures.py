@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Union
+
+
+# seconds a failed tile is not requested again, by reason of the failure
+DEFAULT_NEGATIVE_TTLS = {"missing": 3600,         # 404, 410 or 204 from the server
+                         "invalid": 3600,         # the data is not an image
+                         "error": 30,             # timeout, connection error, 429 or 5xx
+                         "notInDatabase": 60}     # useDatabaseOnly and the tile is not in the offline database
+
+
+class NegativeTileCache:
+    """ Thread-safe cache of tiles that could not be loaded, so they are not requested again
+        until the time to live of the failure reason has passed. """
+
+    def __init__(self, ttls: Union[Dict[str, float], None] = None, maxEntries: int = 100000):
+        self.ttls = dict(DEFAULT_NEGATIVE_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+        self.maxEntries = maxEntries
+
+        self.__lock = threading.Lock()
+        self.__entries: "OrderedDict[tuple, tuple]" = OrderedDict()  # key: (reason, expires)
+
+        self.hits = 0
+        self.stored = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key) -> Union[str, None]:
+        """ returns the reason the tile failed, or None if it may be requested """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.__entries[key]
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, reason: str):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (reason, time.monotonic() + self.ttls.get(reason, self.ttls["error"]))
+            self.stored += 1
+            while len(self.__entries) > self.maxEntries:
+                self.__entries.popitem(last=False)
+
+    def remove(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self) -> Dict[str, Union[int, Dict[str, int]]]:
+        """ Returns hits, stored failures and the number of entries by reason """
+        with self.__lock:
+            reasons: Dict[str, int] = {}
+            for reason, _ in self.__entries.values():
+                reasons[reason] = reasons.get(reason, 0) + 1
+            return {"hits": self.hits,
+                    "stored": self.stored,
+                    "entries": len(self.__entries),
+                    "reasons": reasons}
+
+
+class ServerCircuitBreaker:
+    """ Exponential backoff and circuit breaker of one tile server.
+
+        Every failed request delays the next one by baseDelay * 2 ** (failures - 1) seconds, at most
+        maxDelay, or longer if the server asked so with Retry-After. While the circuit is closed the delay
+        is only advice (see backoff()), requests are still allowed. After failureThreshold consecutive
+        failures the circuit opens and no requests are sent until the delay has passed; then a single
+        probe request is let through, which closes the circuit on success or opens it again on failure.
+        waitForRequest() blocks until a request is allowed, woken when the state changes. """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, failureThreshold: int = 5, baseDelay: float = 0.5, maxDelay: float = 300.0):
+        self.failureThreshold = failureThreshold
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)  # notified when a request completes
+        self.state = self.CLOSED
+        self.failures = 0
+        self.retryTime = 0.0
+
+        self.rejected = 0
+        self.opened = 0
+
+    def __allow(self) -> bool:
+        if self.state == self.OPEN and time.monotonic() >= self.retryTime:
+            self.state = self.HALF_OPEN
+            return True
+        return self.state == self.CLOSED
+
+    def allowRequest(self) -> bool:
+        """ returns True if a request may be sent to the server now """
+        with self.__lock:
+            if self.__allow():
+                return True
+            self.rejected += 1
+            return False
+
+    def waitForRequest(self, timeout: Union[float, None] = None) -> bool:
+        """ blocks until a request may be sent to the server, like allowRequest() returning True,
+            returns False if that did not happen within timeout seconds """
+        with self.__changed:
+            end = None if timeout is None else time.monotonic() + timeout
+            if self.__allow():
+                return True
+            self.rejected += 1
+            while not self.__allow():
+                now = time.monotonic()
+                # an open circuit may be probed at retryTime, a half-open one waits for the probe to complete
+                wait = self.retryTime - now if self.state == self.OPEN else None
+                if end is not None:
+                    if now >= end:
+                        return False
+                    wait = end - now if wait is None else min(wait, end - now)
+                self.__changed.wait(wait)
+            return True
+
+    def isOpen(self) -> bool:
+        """ True while requests are rejected: the circuit is open and may not be probed yet, or a probe is running """
+        with self.__lock:
+            return self.state == self.HALF_OPEN or (self.state == self.OPEN and time.monotonic() < self.retryTime)
+
+    def backoff(self) -> float:
+        """ seconds a request should be delayed after failures while the circuit is closed """
+        with self.__lock:
+            if self.state != self.CLOSED:
+                return 0.0
+            return max(0.0, self.retryTime - time.monotonic())
+
+    def success(self):
+        with self.__lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.retryTime = 0.0
+            self.__changed.notify_all()
+
+    def failure(self, retryAfter: Union[float, None] = None):
+        with self.__lock:
+            if self.state == self.OPEN:
+                # a request sent before the circuit opened, only failed probes make the delay longer
+                return
+            self.failures += 1
+            delay = min(self.maxDelay, self.baseDelay * 2 ** (self.failures - 1))
+            if retryAfter is not None:
+                delay = max(delay, retryAfter)
+            self.retryTime = time.monotonic() + delay
+            if self.state != self.OPEN and (self.state == self.HALF_OPEN or self.failures >= self.failureThreshold):
+                self.state = self.OPEN
+                self.opened += 1
+            self.__changed.notify_all()
+
+    def stats(self) -> Dict[str, Union[str, int, float]]:
+        """ Returns the state, consecutive failures, seconds until the next request, rejected requests and
+            how often the circuit was opened """
+        with self.__lock:
+            return {"state": self.state,
+                    "failures": self.failures,
+                    "retryIn": max(0.0, self.retryTime - time.monotonic()),
+                    "rejected": self.rejected,
+                    "opened": self.opened}
+
+
+def retryAfterSeconds(headers) -> Union[float, None]:
+    """ returns the delay asked for by a Retry-After header given in seconds """
+    for name, value in headers.items():
+        if name.lower() == "retry-after":
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+_breakers: Dict[str, ServerCircuitBreaker] = {}
+_breakersLock = threading.Lock()
+
+
+def getCircuitBreaker(server: str) -> ServerCircuitBreaker:
+    """ returns the circuit breaker shared by every map view and loader using this tile server """
+    with _breakersLock:
+        breaker = _breakers.get(server)
+        if breaker is None:
+            breaker = _breakers[server] = ServerCircuitBreaker()
+        return breaker
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, Mapping, NamedTuple, Tuple, Union
+
+from .tile_store import BatchedTileWriter, connectReader, connectWriter
+
+
+FRESHNESS_TABLE = """CREATE TABLE IF NOT EXISTS tile_freshness (
+                            server TEXT NOT NULL,
+                            zoom INTEGER NOT NULL,
+                            x INTEGER NOT NULL,
+                            y INTEGER NOT NULL,
+                            fetched REAL NOT NULL,
+                            etag TEXT,
+                            last_modified TEXT,
+                            hash TEXT,
+                            PRIMARY KEY (server, zoom, x, y)) WITHOUT ROWID;"""
+RECORD_FRESHNESS = """INSERT OR REPLACE INTO tile_freshness (server, zoom, x, y, fetched, etag, last_modified, hash)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?);"""
+
+
+class TileFreshness(NamedTuple):
+    fetched: float
+    etag: Union[str, None]
+    lastModified: Union[str, None]
+    hash: Union[str, None]
+
+    def conditionalHeaders(self) -> Dict[str, str]:
+        """ request headers that let the server answer 304 Not Modified if the tile did not change """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified:
+            headers["If-Modified-Since"] = self.lastModified
+        return headers
+
+
+def responseValidators(headers: Union[Mapping[str, str], None]) -> Tuple[Union[str, None], Union[str, None]]:
+    """ ETag and Last-Modified of a response, header names in any case """
+    etag = lastModified = None
+    for name, value in (headers or {}).items():
+        if name.lower() == "etag":
+            etag = value
+        elif name.lower() == "last-modified":
+            lastModified = value
+    return etag, lastModified
+
+
+class TileFreshnessStore:
+    """ When every seeded tile of a tile server was fetched, with its validators (ETag, Last-Modified)
+        and the hash of the downloaded bytes.
+
+        The records are kept in the table tile_freshness of an SQLite file, normally the file the tiles
+        are stored in, by XYZ coordinates. A refresh requests the tiles fetched before a cutoff again
+        with conditional requests; a tile the server answers with 304 Not Modified or with the same
+        bytes only gets a new fetch time. Records are written in batches by a writer thread, flush()
+        waits until they are committed. """
+
+    def __init__(self, path: str, server: str, readOnly: bool = False):
+        self.path = path
+        self.server = server
+        self.readOnly = readOnly
+        self.__local = threading.local()
+        self.__writer: Union[BatchedTileWriter, None] = None
+        if not readOnly:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            connection = connectWriter(path)
+            connection.execute(FRESHNESS_TABLE)
+            connection.commit()
+            connection.close()
+            self.__writer = BatchedTileWriter(path, RECORD_FRESHNESS)
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = self.__local.connection = connectReader(self.path)
+        return connection
+
+    def get(self, zoom: int, x: int, y: int) -> Union[TileFreshness, None]:
+        try:
+            row = self.__connection().execute(
+                "SELECT fetched, etag, last_modified, hash FROM tile_freshness WHERE server=? AND zoom=? AND x=? AND y=?;",
+                (self.server, zoom, x, y)).fetchone()
+        except sqlite3.Error:
+            # a file seeded before fetch times were recorded
+            return None
+        return TileFreshness(*row) if row is not None else None
+
+    def freshTiles(self, zoom: int, firstX: int, lastX: int, cutoff: float) -> Iterator[Tuple[int, int]]:
+        """ (x, y) of the tiles of the columns firstX to lastX fetched at or after cutoff (time.time()) """
+        try:
+            rows = self.__connection().execute(
+                "SELECT x, y FROM tile_freshness WHERE server=? AND zoom=? AND x BETWEEN ? AND ? AND fetched>=?;",
+                (self.server, zoom, firstX, lastX, cutoff)).fetchall()
+        except sqlite3.Error:
+            return iter(())
+        return iter(rows)
+
+    def record(self, zoom: int, x: int, y: int, headers: Union[Mapping[str, str], None], hash: Union[str, None],
+               previous: Union[TileFreshness, None] = None, fetched: Union[float, None] = None):
+        """ records a tile fetched at fetched (time.time(), default now); validators the response
+            does not repeat (e.g. in a 304) are kept from previous """
+        if self.__writer is None:
+            # closed or read-only
+            return
+        etag, lastModified = responseValidators(headers)
+        if previous is not None:
+            etag = etag or previous.etag
+            lastModified = lastModified or previous.lastModified
+        self.__writer.put((self.server, zoom, x, y, time.time() if fetched is None else fetched, etag, lastModified, hash))
+
+    def flush(self):
+        if self.__writer is not None:
+            self.__writer.flush()
+
+    def close(self):
+        """ commits the queued records and closes the connection of the calling thread """
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        connection = getattr(self.__local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.__local.connection = None
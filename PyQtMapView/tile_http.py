@@ -0,0 +1,158 @@
+import threading
+from typing import Dict, List, Sequence, Union
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+USER_AGENT = "PyQtMapView"
+DEFAULT_SUBDOMAINS = ("a", "b", "c")
+DEFAULT_POOL_SIZE = 10  # keep-alive connections per host
+
+
+def formatTileUrl(template: str, zoom: int, x: int, y: int, subdomains: Sequence[str] = DEFAULT_SUBDOMAINS) -> str:
+    """ fills a tile server template; {s} is replaced by one of the subdomains,
+        always the same one for a given tile so that HTTP caches keep working """
+    url = template.replace("{x}", str(x)).replace("{y}", str(y)).replace("{z}", str(zoom))
+    if "{s}" in url:
+        url = url.replace("{s}", subdomains[(x + y) % len(subdomains)])
+    return url
+
+
+def legacyServerUrl(template: str, subdomains: Sequence[str] = DEFAULT_SUBDOMAINS) -> str:
+    """ template with {s} replaced by the first subdomain, the way servers were stored in
+        offline databases before subdomain templates were supported """
+    return template.replace("{s}", subdomains[0])
+
+
+class TileHttpClient:
+    """ Connection-pooled keep-alive HTTP client of one tile server template.
+
+        Every host the template expands to ({s} subdomains) gets its own connection pool,
+        whose size can be set per host with setHostPoolSize(). """
+
+    def __init__(self, template: str, subdomains: Union[Sequence[str], None] = None,
+                 poolSize: int = DEFAULT_POOL_SIZE, timeout: float = 10):
+        self.template = template
+        self.subdomains = tuple(subdomains) if subdomains else DEFAULT_SUBDOMAINS
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+
+        self.__lock = threading.Lock()
+        self.__adapters: Dict[str, HTTPAdapter] = {}
+        self.__poolSizes: Dict[str, int] = {}
+        self.__hostRequests: Dict[str, int] = {}
+
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+
+        for host in self.hosts():
+            self.setHostPoolSize(host, poolSize)
+
+    def hosts(self) -> List[str]:
+        """ returns the "scheme://host" prefixes used by the template """
+        templates = [self.template.replace("{s}", subdomain) for subdomain in self.subdomains] \
+            if "{s}" in self.template else [self.template]
+        hosts = []
+        for template in templates:
+            parts = urlsplit(template)
+            host = f"{parts.scheme}://{parts.netloc}"
+            if host not in hosts:
+                hosts.append(host)
+        return hosts
+
+    def setHostPoolSize(self, host: str, poolSize: int):
+        """ sets the number of keep-alive connections kept open to one host """
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+        with self.__lock:
+            old = self.__adapters.get(host)
+            self.__adapters[host] = adapter
+            self.__poolSizes[host] = poolSize
+            self.__hostRequests.setdefault(host, 0)
+            self.session.mount(host + "/", adapter)
+        if old is not None:
+            old.close()
+
+    def growPoolSize(self, poolSize: int):
+        """ raises the pool size of every host to at least poolSize """
+        for host in self.hosts():
+            if self.__poolSizes.get(host, 0) < poolSize:
+                self.setHostPoolSize(host, poolSize)
+
+    def url(self, zoom: int, x: int, y: int) -> str:
+        return formatTileUrl(self.template, zoom, x, y, self.subdomains)
+
+    def get(self, zoom: int, x: int, y: int, headers: Union[Dict[str, str], None] = None) -> requests.Response:
+        """ requests one tile over a pooled connection """
+        url = self.url(zoom, x, y)
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except Exception:
+            with self.__lock:
+                self.requests += 1
+                self.errors += 1
+            raise
+        with self.__lock:
+            self.requests += 1
+            self.bytes += len(response.content)
+            self.__hostRequests[host] = self.__hostRequests.get(host, 0) + 1
+        return response
+
+    def stats(self) -> Dict[str, Union[int, dict]]:
+        """ Returns request counters and the state of the connection pool of every host """
+        with self.__lock:
+            hosts = {}
+            for host, adapter in self.__adapters.items():
+                connections, idle, poolRequests = 0, 0, 0
+                poolManager = adapter.poolmanager
+                for key in list(poolManager.pools.keys()):
+                    pool = poolManager.pools.get(key)
+                    if pool is None:
+                        continue
+                    connections += pool.num_connections
+                    poolRequests += pool.num_requests
+                    idle += pool.pool.qsize() if pool.pool is not None else 0
+                hosts[host] = {"poolSize": self.__poolSizes[host],
+                               "requests": self.__hostRequests.get(host, 0),
+                               "connectionsOpened": connections,
+                               "connectionRequests": poolRequests,
+                               "idleSlots": idle}
+            return {"requests": self.requests,
+                    "errors": self.errors,
+                    "bytes": self.bytes,
+                    "hosts": hosts}
+
+    def close(self):
+        self.session.close()
+
+
+_clients: Dict[str, TileHttpClient] = {}
+_clientsLock = threading.Lock()
+
+
+def getTileClient(template: str, subdomains: Union[Sequence[str], None] = None,
+                  poolSize: Union[int, None] = None) -> TileHttpClient:
+    """ returns the HTTP client shared by all map views and loaders using this tile server template,
+        poolSize raises the number of connections per host if the client needs more """
+    with _clientsLock:
+        client = _clients.get(template)
+        if client is None:
+            client = TileHttpClient(template, subdomains, poolSize or DEFAULT_POOL_SIZE)
+            _clients[template] = client
+            return client
+    if poolSize is not None:
+        client.growPoolSize(poolSize)
+    return client
+
+
+def tileClientStats() -> Dict[str, dict]:
+    """ returns the stats of every shared tile server client """
+    with _clientsLock:
+        clients = dict(_clients)
+    return {template: client.stats() for template, client in clients.items()}
@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import Future
+from typing import Dict, Hashable, Tuple
+
+
+class InFlightTable:
+    """ Table of tile fetches in progress, shared by every thread that loads tiles.
+
+        The first caller of begin() for a key becomes the owner and must call finish() or fail();
+        later callers get the same future and attach to the pending fetch instead of starting another.
+        Completion is delivered to everyone through the future and its done callbacks. """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pending: Dict[Hashable, Future] = {}
+
+        self.started = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self.__pending)
+
+    def __contains__(self, key) -> bool:
+        return key in self.__pending
+
+    def begin(self, key) -> Tuple[Future, bool]:
+        """ Returns (future, owner), owner is True if the caller has to perform the fetch """
+        with self.__lock:
+            future = self.__pending.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self.__pending[key] = future
+            self.started += 1
+            return future, True
+
+    def finish(self, key, result):
+        """ Completes the fetch of key and wakes up every waiting requester """
+        with self.__lock:
+            future = self.__pending.pop(key)
+        future.set_result(result)
+
+    def fail(self, key, error: BaseException):
+        with self.__lock:
+            future = self.__pending.pop(key)
+        future.set_exception(error)
+
+    def stats(self) -> Dict[str, int]:
+        """ Returns the number of fetches started, requests attached to a pending fetch and fetches in flight """
+        with self.__lock:
+            return {"started": self.started,
+                    "coalesced": self.coalesced,
+                    "inFlight": len(self.__pending)}
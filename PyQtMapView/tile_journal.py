@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, Iterator
+
+from .tile_ranges import Span, TileRangeSet
+
+
+JOURNAL_VERSION = 1
+
+
+def seedJobId(job: Dict) -> str:
+    """ id of a seeding job derived from its parameters, so running the same job again resumes it """
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class SeedJournal:
+    """ On-disk journal of a seeding job.
+
+        The tiles a job has completed are kept as run-length ranges (see TileRangeSet) and written
+        to a JSON file by save(), which replaces the file atomically. A job started again with the
+        same journal skips every completed tile without looking at the tile storage. The caller has
+        to make sure the tiles are committed to the storage before save() is called. """
+
+    def __init__(self, path: str, job: Dict):
+        self.path = path
+        # compared after a JSON round trip, tuples are stored as lists
+        self.job = json.loads(json.dumps(job))
+        self.done = TileRangeSet()
+        self.resumed = 0
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            if data.get("version") != JOURNAL_VERSION or data.get("job") != self.job:
+                raise ValueError(f"{path} is the journal of another seeding job")
+            self.done = TileRangeSet.fromDict(data["done"])
+            self.resumed = len(self.done)
+
+    def __len__(self) -> int:
+        return len(self.done)
+
+    def markDone(self, zoom: int, x: int, y: int):
+        self.done.add(zoom, x, y)
+
+    def remaining(self, zoom: int, spans: Iterable[Span]) -> Iterator[Span]:
+        """ the parts of the spans the job has not completed yet """
+        return self.done.subtract(zoom, spans)
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporaryPath = self.path + ".part"
+        with open(temporaryPath, "w", encoding="utf-8") as file:
+            json.dump({"version": JOURNAL_VERSION, "job": self.job, "done": self.done.toDict()}, file, separators=(",", ":"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporaryPath, self.path)
+
+    def remove(self):
+        """ deletes the journal of a finished job """
+        if os.path.exists(self.path):
+            os.remove(self.path)
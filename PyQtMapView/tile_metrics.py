@@ -0,0 +1,185 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, Sequence, Union
+
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # upper bounds in seconds
+RATE_WINDOWS = (10, 60)  # seconds of the sliding windows of the rates
+
+
+class LatencyHistogram:
+    """ Histogram of request latencies with fixed buckets (LATENCY_BUCKETS and one for longer requests),
+        percentiles are the upper bound of the bucket they fall in """
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, latency: float):
+        self.counts[bisect_left(self.bounds, latency)] += 1
+        self.count += 1
+        self.total += latency
+
+    def percentile(self, fraction: float) -> Union[float, None]:
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        for index, count in enumerate(self.counts):
+            rank -= count
+            if rank <= 0:
+                return self.bounds[index] if index < len(self.bounds) else math.inf
+        return math.inf
+
+    def stats(self) -> Dict[str, Union[int, float, None, Dict[str, int]]]:
+        """ Returns the number and mean of the latencies, p50, p90 and p99 and the count of every bucket """
+        names = [f"<={bound:g}s" for bound in self.bounds] + [f">{self.bounds[-1]:g}s"]
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count else None,
+                "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9),
+                "p99": self.percentile(0.99),
+                "buckets": dict(zip(names, self.counts))}
+
+
+class SeedMetrics:
+    """ Progress metrics of a seeding job, updated by the download threads.
+
+        Completed tiles and loaded bytes are counted in buckets of one second, so their rates are
+        available over sliding windows of RATE_WINDOWS seconds. Per zoom level the planned tiles,
+        tiles skipped because they were stored, loaded, unchanged (refreshed), missing on the server and failed tiles, requests and failed requests
+        (which may be retried) are counted, and the latency of every successful request goes into a
+        histogram per zoom level. The time to completion is estimated from the remaining planned tiles
+        and the tile rate of the longest window; tiles of zoom levels not started yet may still turn
+        out to be stored, so it is an upper bound. """
+
+    def __init__(self, windows: Sequence[int] = RATE_WINDOWS):
+        self.windows = tuple(windows)
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.start = time.monotonic()
+            self.__seconds = deque()  # [second, tiles, bytes]
+            self.zooms: Dict[int, Dict[str, int]] = {}
+            self.latencies: Dict[int, LatencyHistogram] = {}
+
+    def __zoom(self, zoom: int) -> Dict[str, int]:
+        counters = self.zooms.get(zoom)
+        if counters is None:
+            counters = self.zooms[zoom] = {"planned": 0, "skipped": 0, "loaded": 0, "unchanged": 0, "missing": 0, "failed": 0,
+                                           "requests": 0, "errors": 0, "bytes": 0}
+            self.latencies[zoom] = LatencyHistogram()
+        return counters
+
+    def __count(self, tiles: int, size: int):
+        second = int(time.monotonic())
+        if self.__seconds and self.__seconds[-1][0] == second:
+            self.__seconds[-1][1] += tiles
+            self.__seconds[-1][2] += size
+        else:
+            self.__seconds.append([second, tiles, size])
+        while self.__seconds and self.__seconds[0][0] <= second - max(self.windows):
+            self.__seconds.popleft()
+
+    def plan(self, zoom: int, tiles: int):
+        """ tiles selected at a zoom level, stored ones included """
+        with self.__lock:
+            self.__zoom(zoom)["planned"] += tiles
+
+    def skipped(self, zoom: int, tiles: int):
+        """ tiles not requested because they were stored or loaded by an earlier run of the job """
+        with self.__lock:
+            self.__zoom(zoom)["skipped"] += tiles
+
+    def tileLoaded(self, zoom: int, size: int, latency: Union[float, None] = None):
+        with self.__lock:
+            counters = self.__zoom(zoom)
+            counters["loaded"] += 1
+            counters["requests"] += 1
+            counters["bytes"] += size
+            if latency is not None:
+                self.latencies[zoom].add(latency)
+            self.__count(1, size)
+
+    def tileUnchanged(self, zoom: int, size: int, latency: Union[float, None] = None):
+        """ a stored tile requested again that did not change (304 Not Modified or the same bytes) """
+        with self.__lock:
+            counters = self.__zoom(zoom)
+            counters["unchanged"] += 1
+            counters["requests"] += 1
+            counters["bytes"] += size
+            if latency is not None:
+                self.latencies[zoom].add(latency)
+            self.__count(1, size)
+
+    def tileMissing(self, zoom: int):
+        """ a tile the server does not have (404, 410 or 204), asking again does not help """
+        with self.__lock:
+            counters = self.__zoom(zoom)
+            counters["missing"] += 1
+            counters["requests"] += 1
+            self.__count(1, 0)
+
+    def requestFailed(self, zoom: int):
+        """ a request that failed and is retried or given up, see tileFailed """
+        with self.__lock:
+            counters = self.__zoom(zoom)
+            counters["requests"] += 1
+            counters["errors"] += 1
+
+    def tileFailed(self, zoom: int):
+        """ a tile given up, its last request is counted by requestFailed """
+        with self.__lock:
+            self.__zoom(zoom)["failed"] += 1
+            self.__count(1, 0)
+
+    def rates(self) -> Dict[str, Dict[str, float]]:
+        """ completed tiles and loaded bytes per second over every window """
+        with self.__lock:
+            return self.__rates(time.monotonic())
+
+    def __rates(self, now: float) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for window in self.windows:
+            tiles = size = 0
+            for second, secondTiles, secondBytes in self.__seconds:
+                if second > now - window:
+                    tiles += secondTiles
+                    size += secondBytes
+            # a job running shorter than the window is measured over its run time
+            duration = max(1e-3, min(window, now - self.start))
+            result[f"{window}s"] = {"tilesPerSecond": tiles / duration, "bytesPerSecond": size / duration}
+        return result
+
+    def stats(self) -> Dict:
+        """ Returns the run time, the totals of the per zoom counters, the skip and error rate, the rates over
+            every window, the estimated seconds to completion and the counters and latencies of every zoom level """
+        with self.__lock:
+            now = time.monotonic()
+            rates = self.__rates(now)
+            totals = {name: sum(counters[name] for counters in self.zooms.values())
+                      for name in ("planned", "skipped", "loaded", "unchanged", "missing", "failed", "requests", "errors", "bytes")}
+            zooms = {}
+            for zoom, counters in sorted(self.zooms.items()):
+                zooms[zoom] = dict(counters,
+                                   skipRate=counters["skipped"] / counters["planned"] if counters["planned"] else 0.0,
+                                   errorRate=counters["errors"] / counters["requests"] if counters["requests"] else 0.0,
+                                   latency=self.latencies[zoom].stats())
+
+        remaining = max(0, totals["planned"] - totals["skipped"] - totals["loaded"] - totals["unchanged"]
+                        - totals["missing"] - totals["failed"])
+        tileRate = rates[f"{max(self.windows)}s"]["tilesPerSecond"]
+        return dict(totals,
+                    seconds=now - self.start,
+                    remaining=remaining,
+                    skipRate=totals["skipped"] / totals["planned"] if totals["planned"] else 0.0,
+                    errorRate=totals["errors"] / totals["requests"] if totals["requests"] else 0.0,
+                    rates=rates,
+                    eta=0.0 if remaining == 0 else remaining / tileRate if tileRate > 0 else None,
+                    zooms=zooms)
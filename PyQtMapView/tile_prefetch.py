@@ -0,0 +1,117 @@
+import math
+import threading
+import time
+from typing import Iterator, Set, Tuple, Union
+
+
+class PrefetchPlanner:
+    """ Decides which tiles are pre-cached next, most likely needed first.
+
+        The map view reports its center, size, pan velocity and zoom direction with update().
+        plan() then yields tile keys (zoom, x, y): first the views along the extrapolated pan
+        trajectory, then the next zoom level if the user is zooming and it is within minZoom and
+        maxZoom of the map, then rings around the center.
+        throttle() spaces the fetches so that prefetching uses at most `rate` tiles per second. """
+
+    def __init__(self, rate: float = 20, lookahead: float = 1.0, maxRadius: int = 8, zoomDirectionTimeout: float = 2.0):
+        self.rate = rate  # tiles per second, 0 disables prefetching
+        self.lookahead = lookahead  # seconds of pan trajectory that are prefetched
+        self.maxRadius = maxRadius
+        self.zoomDirectionTimeout = zoomDirectionTimeout  # seconds a wheel direction is remembered
+
+        self.__lock = threading.Lock()
+        self.__nextFetchTime = 0.0
+        self.generation = 0  # changes with every update(), running plans should be restarted
+
+        self.center: Union[Tuple[float, float], None] = None
+        self.zoom = 0
+        self.viewSize: Tuple[float, float] = (0, 0)
+        self.velocity: Tuple[float, float] = (0, 0)  # tiles per second
+        self.zoomDirection = 0
+        self.zoomDirectionTime = 0.0
+        self.minZoom = 0
+        self.maxZoom: Union[int, None] = None
+
+        self.planned = 0
+
+    def update(self, center: Tuple[float, float], zoom: int, viewSize: Tuple[float, float],
+               velocity: Tuple[float, float] = (0, 0), zoomDirection: int = 0, zoomDirectionTime: float = 0.0,
+               minZoom: int = 0, maxZoom: Union[int, None] = None):
+        """ center and viewSize in tile coordinates of the zoom level, velocity in tiles per second,
+            minZoom and maxZoom the zoom levels the map shows (and the server serves) """
+        with self.__lock:
+            self.center = center
+            self.zoom = zoom
+            self.viewSize = viewSize
+            self.velocity = velocity
+            self.zoomDirection = zoomDirection
+            self.zoomDirectionTime = zoomDirectionTime
+            self.minZoom = minZoom
+            self.maxZoom = maxZoom
+            self.generation += 1
+
+    def plan(self) -> Tuple[int, Iterator[Tuple[int, int, int]]]:
+        """ returns (generation, tile keys in prefetch order) for the last reported view """
+        with self.__lock:
+            generation = self.generation
+            center, zoom, viewSize, velocity = self.center, self.zoom, self.viewSize, self.velocity
+            zoomDirection = self.zoomDirection if time.time() - self.zoomDirectionTime < self.zoomDirectionTimeout else 0
+            # the zoom level the user is moving to, if the map can show it
+            if zoomDirection > 0 and self.maxZoom is not None and zoom >= self.maxZoom:
+                zoomDirection = 0
+            elif zoomDirection < 0 and zoom <= max(0, self.minZoom):
+                zoomDirection = 0
+        if center is None or self.rate <= 0:
+            return generation, iter(())
+        return generation, self.__plan(center, zoom, viewSize, velocity, zoomDirection)
+
+    def __plan(self, center, zoom, viewSize, velocity, zoomDirection) -> Iterator[Tuple[int, int, int]]:
+        seen: Set[Tuple[int, int, int]] = set()
+
+        def view(zoom: int, centerX: float, centerY: float, width: float, height: float):
+            # tiles of a view rectangle, nearest to its center first
+            tiles = [(zoom, x, y)
+                     for x in range(math.floor(centerX - width / 2), math.ceil(centerX + width / 2))
+                     for y in range(math.floor(centerY - height / 2), math.ceil(centerY + height / 2))]
+            tiles.sort(key=lambda tile: (tile[1] + 0.5 - centerX) ** 2 + (tile[2] + 0.5 - centerY) ** 2)
+            for tile in tiles:
+                if tile not in seen and 0 <= tile[1] < 2 ** zoom and 0 <= tile[2] < 2 ** zoom:
+                    seen.add(tile)
+                    self.planned += 1
+                    yield tile
+
+        # the visible tiles are loaded by the foreground loader
+        seen.update((zoom, x, y)
+                    for x in range(math.floor(center[0] - viewSize[0] / 2), math.ceil(center[0] + viewSize[0] / 2))
+                    for y in range(math.floor(center[1] - viewSize[1] / 2), math.ceil(center[1] + viewSize[1] / 2)))
+
+        # views along the pan trajectory, in steps of half a view
+        speed = math.hypot(*velocity)
+        if speed > 0:
+            distance = speed * self.lookahead
+            steps = max(1, math.ceil(distance / (max(min(viewSize), 1) / 2)))
+            for step in range(1, steps + 1):
+                t = self.lookahead * step / steps
+                yield from view(zoom, center[0] + velocity[0] * t, center[1] + velocity[1] * t, *viewSize)
+
+        # the view at the zoom level the user is moving to
+        if zoomDirection > 0:
+            yield from view(zoom + 1, center[0] * 2, center[1] * 2, viewSize[0] * 2, viewSize[1] * 2)
+        elif zoomDirection < 0:
+            yield from view(zoom - 1, center[0] / 2, center[1] / 2, viewSize[0] / 2 + 1, viewSize[1] / 2 + 1)
+
+        # rings around the view
+        for radius in range(1, self.maxRadius + 1):
+            yield from view(zoom, center[0], center[1], viewSize[0] + 2 * radius, viewSize[1] + 2 * radius)
+
+    def throttle(self, stop: Union[threading.Event, None] = None) -> bool:
+        """ blocks until the budget allows the next prefetch, returns False if stop was set meanwhile """
+        with self.__lock:
+            now = time.monotonic()
+            start = max(now, self.__nextFetchTime)
+            self.__nextFetchTime = start + 1 / self.rate
+        if start > now:
+            if stop is not None:
+                return not stop.wait(start - now)
+            time.sleep(start - now)
+        return True
@@ -0,0 +1,203 @@
+import math
+from bisect import bisect_right
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from .utility_functions import decimal_to_osm
+
+
+# a span is one column of a selection: (x, first y, last y), both rows included
+Span = Tuple[int, int, int]
+
+
+def rectangleSpans(positionA: Tuple[float, float], positionB: Tuple[float, float], zoom: int) -> Iterator[Span]:
+    """ columns of the tiles covering the rectangle between the upper left and lower right corner (lat, lon) """
+    upperLeft = decimal_to_osm(*positionA, zoom)
+    lowerRight = decimal_to_osm(*positionB, zoom)
+    for x in range(math.floor(upperLeft[0]), math.ceil(lowerRight[0]) + 1):
+        yield x, math.floor(upperLeft[1]), math.ceil(lowerRight[1])
+
+
+def circleSpans(center: Tuple[float, float], radius: float, zoom: int) -> Iterator[Span]:
+    """ columns of the tiles inside a circle of radius km around center (lat, lon); every column is
+        computed from the circle equation, so no tile is tested or produced twice """
+    latOffset = radius / 111.0
+    lonOffset = radius / (111.0 * math.cos(math.radians(center[0])))
+    upperLeft = decimal_to_osm(center[0] + latOffset, center[1] - lonOffset, zoom)
+    lowerRight = decimal_to_osm(center[0] - latOffset, center[1] + lonOffset, zoom)
+    centerTile = decimal_to_osm(*center, zoom)
+
+    centerX, centerY = round(centerTile[0]), round(centerTile[1])
+    radiusSquared = round(upperLeft[0] - centerTile[0]) ** 2
+    last = (1 << zoom) - 1
+    top, bottom = max(0, math.floor(upperLeft[1])), min(last, math.ceil(lowerRight[1]))
+    for x in range(max(0, math.floor(upperLeft[0])), min(last, math.ceil(lowerRight[0])) + 1):
+        remaining = radiusSquared - (x - centerX) ** 2
+        if remaining < 0:
+            continue
+        height = math.isqrt(remaining)
+        first, final = max(top, centerY - height), min(bottom, centerY + height)
+        if first <= final:
+            yield x, first, final
+
+
+EARTH_CIRCUMFERENCE = 40075.016686  # km at the equator
+
+
+def _addPolygonCover(tilePoints: Sequence[Tuple[float, float]], zoom: int, columns: Dict[int, List[Tuple[int, int]]]):
+    # rasterised cover of a polygon given in tile coordinates: for every column the rows crossed by the
+    # edges inside the column plus the rows between the edge crossings of the column's center line
+    # (even-odd rule); each edge only visits the columns it spans, no tile is tested against the polygon
+    last = (1 << zoom) - 1
+    crossings: Dict[int, List[float]] = {}
+    for index in range(len(tilePoints)):
+        (x0, y0), (x1, y1) = tilePoints[index - 1], tilePoints[index]
+        if x0 > x1:
+            (x0, y0), (x1, y1) = (x1, y1), (x0, y0)
+        slope = (y1 - y0) / (x1 - x0) if x1 > x0 else 0.0
+        for column in range(max(0, math.floor(x0)), min(last, math.floor(x1)) + 1):
+            if x1 > x0:
+                top = y0 + (max(x0, column) - x0) * slope
+                bottom = y0 + (min(x1, column + 1) - x0) * slope
+            else:
+                top, bottom = y0, y1
+            columns.setdefault(column, []).append((math.floor(min(top, bottom)), math.floor(max(top, bottom))))
+        for column in range(max(0, math.ceil(x0 - 0.5)), min(last + 1, math.ceil(x1 - 0.5))):
+            crossings.setdefault(column, []).append(y0 + (column + 0.5 - x0) * slope)
+
+    for column, rows in crossings.items():
+        rows.sort()
+        for index in range(0, len(rows) - 1, 2):
+            columns.setdefault(column, []).append((math.floor(rows[index]), math.floor(rows[index + 1])))
+
+
+def _mergedSpans(columns: Dict[int, List[Tuple[int, int]]], zoom: int) -> Iterator[Span]:
+    last = (1 << zoom) - 1
+    for x in sorted(columns):
+        first = final = None
+        for start, end in sorted(columns[x]):
+            start, end = max(0, start), min(last, end)
+            if start > end:
+                continue
+            if first is not None and start <= final + 1:
+                final = max(final, end)
+                continue
+            if first is not None:
+                yield x, first, final
+            first, final = start, end
+        if first is not None:
+            yield x, first, final
+
+
+def polygonSpans(points: Sequence[Tuple[float, float]], zoom: int) -> Iterator[Span]:
+    """ columns of the tiles intersecting the polygon with the corners points (lat, lon) """
+    columns: Dict[int, List[Tuple[int, int]]] = {}
+    if len(points) >= 3:
+        _addPolygonCover([decimal_to_osm(*point, zoom) for point in points], zoom, columns)
+    return _mergedSpans(columns, zoom)
+
+
+def corridorSpans(points: Sequence[Tuple[float, float]], width: float, zoom: int) -> Iterator[Span]:
+    """ columns of the tiles within width km of the polyline through points (lat, lon), e.g. a route;
+        the corridor is covered segment by segment, so its cost grows with its length and not with its bounding box """
+    columns: Dict[int, List[Tuple[int, int]]] = {}
+    tilePoints = [decimal_to_osm(*point, zoom) for point in points]
+    # width in tiles at the latitude of a point, web mercator has the same scale in both directions
+    tileWidths = [width * (1 << zoom) / (EARTH_CIRCUMFERENCE * math.cos(math.radians(point[0]))) for point in points]
+
+    for (x, y), offset in zip(tilePoints, tileWidths):
+        # an octagon around every point contains the circle of the joint
+        offset /= math.cos(math.pi / 8)
+        _addPolygonCover([(x + offset * math.cos(angle), y + offset * math.sin(angle))
+                          for angle in (math.pi * (2 * index + 1) / 8 for index in range(8))], zoom, columns)
+
+    for index in range(1, len(tilePoints)):
+        (x0, y0), (x1, y1) = tilePoints[index - 1], tilePoints[index]
+        length = math.hypot(x1 - x0, y1 - y0)
+        if length == 0:
+            continue
+        offset = max(tileWidths[index - 1], tileWidths[index])
+        normalX, normalY = -(y1 - y0) / length * offset, (x1 - x0) / length * offset
+        _addPolygonCover([(x0 + normalX, y0 + normalY), (x1 + normalX, y1 + normalY),
+                          (x1 - normalX, y1 - normalY), (x0 - normalX, y0 - normalY)], zoom, columns)
+    return _mergedSpans(columns, zoom)
+
+
+def spanTiles(zoom: int, spans: Iterable[Span]) -> Iterator[Tuple[int, int, int]]:
+    """ yields (zoom, x, y) of every tile of the spans, one at a time """
+    for x, first, final in spans:
+        for y in range(first, final + 1):
+            yield zoom, x, y
+
+
+def countSpanTiles(spans: Iterable[Span]) -> int:
+    """ number of tiles of the spans, without enumerating them """
+    return sum(final - first + 1 for _, first, final in spans)
+
+
+class TileRangeSet:
+    """ Set of tiles stored as sorted run-length ranges of rows per column and zoom level,
+        so a seeded area of millions of tiles takes a few numbers per column. """
+
+    def __init__(self):
+        self.__columns: Dict[Tuple[int, int], List[List[int]]] = {}  # (zoom, x): [[first y, last y], ...]
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, tile: Tuple[int, int, int]) -> bool:
+        zoom, x, y = tile
+        ranges = self.__columns.get((zoom, x), ())
+        index = bisect_right(ranges, [y, math.inf])
+        return index > 0 and ranges[index - 1][1] >= y
+
+    def add(self, zoom: int, x: int, y: int):
+        ranges = self.__columns.setdefault((zoom, x), [])
+        # ranges[index - 1] is the last range starting at or before y
+        index = bisect_right(ranges, [y, math.inf])
+        if index and ranges[index - 1][1] >= y - 1:
+            previous = ranges[index - 1]
+            if previous[1] >= y:
+                return
+            previous[1] = y
+            if index < len(ranges) and ranges[index][0] == y + 1:
+                previous[1] = ranges.pop(index)[1]
+        elif index < len(ranges) and ranges[index][0] == y + 1:
+            ranges[index][0] = y
+        else:
+            ranges.insert(index, [y, y])
+        self.count += 1
+
+    def subtract(self, zoom: int, spans: Iterable[Span]) -> Iterator[Span]:
+        """ yields the parts of the spans that are not in the set """
+        for x, first, final in spans:
+            for start, end in self.__columns.get((zoom, x), ()):
+                if end < first:
+                    continue
+                if start > final:
+                    break
+                if start > first:
+                    yield x, first, start - 1
+                first = max(first, end + 1)
+                if first > final:
+                    break
+            if first <= final:
+                yield x, first, final
+
+    def toDict(self) -> Dict[str, Dict[str, List[int]]]:
+        """ {zoom: {x: [first y, last y, first y, last y, ...]}}, as stored in JSON """
+        result: Dict[str, Dict[str, List[int]]] = {}
+        for (zoom, x), ranges in self.__columns.items():
+            if ranges:
+                result.setdefault(str(zoom), {})[str(x)] = [y for bounds in ranges for y in bounds]
+        return result
+
+    @classmethod
+    def fromDict(cls, values: Dict[str, Dict[str, List[int]]]) -> "TileRangeSet":
+        rangeSet = cls()
+        for zoom, columns in values.items():
+            for x, flat in columns.items():
+                ranges = [[flat[index], flat[index + 1]] for index in range(0, len(flat), 2)]
+                rangeSet.__columns[(int(zoom), int(x))] = ranges
+                rangeSet.count += sum(end - start + 1 for start, end in ranges)
+        return rangeSet
@@ -0,0 +1,237 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Union
+
+
+DEFAULT_RATE = 50            # sustained requests per second
+DEFAULT_BURST = 100          # requests that may be sent at once after an idle period
+DEFAULT_MAX_CONCURRENT = 32  # requests in flight at the same time
+STOP_CHECK_INTERVAL = 0.1    # seconds between checks of the stop event of a waiting acquire()
+
+
+class TokenBucketLimiter:
+    """ Token bucket rate limiter of one tile server, shared by every thread of the process.
+
+        acquire() blocks until a token is available and fewer than maxConcurrent requests are in
+        flight, then returns the number of seconds the caller waited, or None if its stop event was
+        set first; release() has to be called when the request completed. Requests are never rejected,
+        they are only delayed, so the server sees a steady rate of at most `rate` requests per second
+        after a burst of `burst`. """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST, maxConcurrent: int = DEFAULT_MAX_CONCURRENT):
+        self.rate = rate  # 0 or None disables the rate limit
+        self.burst = burst
+        self.maxConcurrent = maxConcurrent  # 0 or None disables the concurrency limit
+
+        self.__condition = threading.Condition()
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__active = 0
+
+        self.requests = 0
+        self.delayed = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def configure(self, rate: Union[float, None] = None, burst: Union[int, None] = None,
+                  maxConcurrent: Union[int, None] = None):
+        """ changes the limits, arguments left at None keep their value """
+        with self.__condition:
+            self.__refill()
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self.__tokens = min(self.__tokens, burst)
+            if maxConcurrent is not None:
+                self.maxConcurrent = maxConcurrent
+            self.__condition.notify_all()
+
+    def __refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def acquire(self, stop: Union[threading.Event, None] = None) -> Union[float, None]:
+        """ blocks until the request may be sent, returns the seconds waited
+            or None without a slot if stop is set while waiting """
+        start = time.monotonic()
+        with self.__condition:
+            while self.maxConcurrent and self.__active >= self.maxConcurrent:
+                if stop is not None and stop.is_set():
+                    return None
+                self.__condition.wait(STOP_CHECK_INTERVAL if stop is not None else None)
+            self.__active += 1
+            # the token is reserved now, so waiting callers are served in order
+            self.__refill()
+            delay = 0.0
+            if self.rate:
+                self.__tokens -= 1
+                if self.__tokens < 0:
+                    delay = -self.__tokens / self.rate
+        if delay > 0:
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                # the token stays used, the server may have seen it already
+                self.release()
+                return None
+
+        waited = time.monotonic() - start
+        with self.__condition:
+            self.requests += 1
+            if waited > 0.001:
+                self.delayed += 1
+            self.totalWait += waited
+            self.maxWait = max(self.maxWait, waited)
+        return waited
+
+    def release(self):
+        with self.__condition:
+            self.__active -= 1
+            self.__condition.notify()
+
+    @contextmanager
+    def request(self) -> Iterator[float]:
+        """ with limiter.request() as waited: ... """
+        waited = self.acquire()
+        try:
+            yield waited
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """ Returns the limits, the number of requests, how many of them were delayed
+            and the total, mean and longest wait in seconds """
+        with self.__condition:
+            self.__refill()
+            return {"rate": self.rate,
+                    "burst": self.burst,
+                    "maxConcurrent": self.maxConcurrent,
+                    "active": self.__active,
+                    "tokens": self.__tokens,
+                    "requests": self.requests,
+                    "delayed": self.delayed,
+                    "totalWait": self.totalWait,
+                    "meanWait": self.totalWait / self.requests if self.requests else 0.0,
+                    "maxWait": self.maxWait}
+
+
+class AimdConcurrencyLimit:
+    """ Number of concurrent requests adjusted to the link and the server by additive increase and
+        multiplicative decrease (AIMD), as TCP does with its congestion window.
+
+        Every request that succeeds while the smoothed latency stays below latencyTolerance times the
+        base latency raises the limit by 1 / limit, i.e. by one per round of `limit` requests. A failed
+        request or a smoothed latency above the tolerance multiplies the limit by decreaseFactor, at most
+        once per smoothed latency, so the requests already in flight when the limit was cut do not cut it
+        again. The base latency is the lowest smoothed latency seen once a few requests completed, slowly
+        following the measured latency upwards when the route changes; it is compared with the smoothed and
+        not the single latency, as responses served from a cache and rendered ones differ a lot. """
+
+    def __init__(self, initial: float = 8, minimum: int = 1, maximum: int = 50,
+                 decreaseFactor: float = 0.5, latencyTolerance: float = 2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decreaseFactor = decreaseFactor
+        self.latencyTolerance = latencyTolerance
+        self.limit = float(min(maximum, max(minimum, initial)))
+
+        self.__condition = threading.Condition()
+        self.__active = 0
+        self.__lastDecrease = 0.0
+        self.baseLatency: Union[float, None] = None
+        self.latency: Union[float, None] = None  # exponentially smoothed
+        self.__samples = 0
+
+        self.successes = 0
+        self.failures = 0
+        self.decreases = 0
+        self.maxLimit = self.limit
+
+    def acquire(self, stop: Union[threading.Event, None] = None) -> bool:
+        """ blocks until fewer than limit requests are in flight, returns False
+            without a slot if stop is set while waiting """
+        with self.__condition:
+            while self.__active >= int(self.limit):
+                if stop is not None and stop.is_set():
+                    return False
+                self.__condition.wait(STOP_CHECK_INTERVAL if stop is not None else None)
+            self.__active += 1
+            return True
+
+    def cancel(self):
+        """ gives back a slot whose request was not sent, without adjusting the limit """
+        with self.__condition:
+            self.__active -= 1
+            self.__condition.notify_all()
+
+    def release(self, success: bool, latency: Union[float, None] = None):
+        """ has to be called when a request completed, with the seconds it took if it is representative
+            of the server's load (e.g. not for an error page answered at once) """
+        with self.__condition:
+            self.__active -= 1
+            now = time.monotonic()
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+                self.__samples += 1
+                if self.__samples < 10:
+                    pass
+                elif self.baseLatency is None or self.latency < self.baseLatency:
+                    self.baseLatency = self.latency
+                else:
+                    self.baseLatency += (self.latency - self.baseLatency) * 0.001
+
+            congested = (self.latency is not None and self.baseLatency is not None
+                         and self.latency > self.latencyTolerance * self.baseLatency)
+            if success:
+                self.successes += 1
+            else:
+                self.failures += 1
+            if success and not congested:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self.maxLimit = max(self.maxLimit, self.limit)
+            elif now - self.__lastDecrease >= (self.latency or 0.0):
+                self.limit = max(self.minimum, self.limit * self.decreaseFactor)
+                self.__lastDecrease = now
+                self.decreases += 1
+            self.__condition.notify_all()
+
+    def stats(self) -> Dict[str, Union[int, float, None]]:
+        """ Returns the current and highest limit, requests in flight, the smoothed and base latency in seconds,
+            successful and failed requests and how often the limit was cut """
+        with self.__condition:
+            return {"limit": self.limit,
+                    "maxLimit": self.maxLimit,
+                    "active": self.__active,
+                    "latency": self.latency,
+                    "baseLatency": self.baseLatency,
+                    "successes": self.successes,
+                    "failures": self.failures,
+                    "decreases": self.decreases}
+
+
+_limiters: Dict[str, TokenBucketLimiter] = {}
+_limitersLock = threading.Lock()
+
+
+def getRateLimiter(template: str, rate: Union[float, None] = None, burst: Union[int, None] = None,
+                   maxConcurrent: Union[int, None] = None) -> TokenBucketLimiter:
+    """ returns the rate limiter shared by all map views and loaders using this tile server template,
+        limits that are given replace the current ones """
+    with _limitersLock:
+        limiter = _limiters.get(template)
+        if limiter is None:
+            limiter = _limiters[template] = TokenBucketLimiter()
+    if rate is not None or burst is not None or maxConcurrent is not None:
+        limiter.configure(rate, burst, maxConcurrent)
+    return limiter
+
+
+def rateLimiterStats() -> Dict[str, dict]:
+    """ returns the stats of every shared rate limiter """
+    with _limitersLock:
+        limiters = dict(_limiters)
+    return {template: limiter.stats() for template, limiter in limiters.items()}
@@ -0,0 +1,149 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Dict, Union
+
+from PIL import Image, UnidentifiedImageError
+
+
+FORMATS = ("png", "png-palette", "webp", "webp-lossless", "jpeg")
+DEFAULT_QUALITY = 80
+DEFAULT_COLORS = 256
+DEFAULT_MIN_SAVING = 0.05  # a tile encoded again in its own format is only kept if it is at least 5% smaller
+CONTAINERS = {"png": "PNG", "png-palette": "PNG", "webp": "WEBP", "webp-lossless": "WEBP", "jpeg": "JPEG"}
+
+
+def checkRecompressionPolicy(policy: Dict):
+    """ raises ValueError if the policy is not valid, see recompressTile """
+    if policy.get("format") not in FORMATS:
+        raise ValueError(f"unknown recompression format {policy.get('format')}, use one of: {', '.join(FORMATS)}")
+    if not 1 <= policy.get("quality", DEFAULT_QUALITY) <= 100:
+        raise ValueError("the recompression quality has to be between 1 and 100")
+    if not 2 <= policy.get("colors", DEFAULT_COLORS) <= 256:
+        raise ValueError("a palette has 2 to 256 colors")
+
+
+def recompressTile(data: bytes, policy: Dict) -> bytes:
+    """ encodes a tile again as policy["format"]:
+
+        png            lossless PNG with the best compression, opaque RGBA tiles are stored as RGB
+        png-palette    PNG with a palette of policy["colors"] colors (default 256), alpha is kept
+        webp           WebP of policy["quality"] (default 80)
+        webp-lossless  lossless WebP
+        jpeg           JPEG of policy["quality"] (default 80), transparent pixels are blended onto white
+
+        A tile in another format is always converted, so a layer is stored in one format. A tile already
+        in the format is only encoded again if that makes it at least policy["min_saving"] (default 5%)
+        smaller. The original data is returned if it cannot be decoded. """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError, ValueError):
+        return data
+
+    source = image.format
+    image = _withoutPalette(image)
+    if image.mode == "RGBA" and image.getextrema()[3][0] == 255:
+        image = image.convert("RGB")
+
+    target = policy["format"]
+    output = io.BytesIO()
+    if target == "png":
+        image.save(output, "PNG", optimize=True)
+    elif target == "png-palette":
+        colors = policy.get("colors", DEFAULT_COLORS)
+        # median cut gives the better palette, but only the octree quantizer handles alpha
+        method = Image.Quantize.FASTOCTREE if image.mode == "RGBA" else Image.Quantize.MEDIANCUT
+        image.quantize(colors, method=method).save(output, "PNG", optimize=True)
+    elif target in ("webp", "webp-lossless"):
+        image.save(output, "WEBP", quality=policy.get("quality", DEFAULT_QUALITY), lossless=target == "webp-lossless", method=4)
+    else:
+        if image.mode == "RGBA":
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        image.convert("RGB").save(output, "JPEG", quality=policy.get("quality", DEFAULT_QUALITY), optimize=True)
+
+    result = output.getvalue()
+    if source == CONTAINERS[target] and len(result) > len(data) * (1 - policy.get("min_saving", DEFAULT_MIN_SAVING)):
+        return data
+    return result
+
+
+def _withoutPalette(image: Image.Image) -> Image.Image:
+    # decoded tiles are worked on as RGB or RGBA
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    if image.mode in ("P", "PA", "LA") or "transparency" in image.info:
+        return image.convert("RGBA")
+    return image.convert("RGB")
+
+
+class TileRecompressor:
+    """ Pool of worker processes recompressing tiles with one policy (see recompressTile).
+
+        submit() hands a tile to the pool and calls the callback with the bytes to store, the original
+        ones if recompressing failed. At most workers * 4 tiles wait for the pool, submit() blocks
+        until there is room, so downloads cannot run ahead of the pool. """
+
+    def __init__(self, policy: Dict, workers: Union[int, None] = None):
+        checkRecompressionPolicy(policy)
+        self.policy = dict(policy)
+        self.workers = workers or multiprocessing.cpu_count()
+        # spawned workers do not inherit the state of the download and writer threads
+        self.__pool = ProcessPoolExecutor(self.workers, multiprocessing.get_context("spawn"))
+        self.__slots = threading.BoundedSemaphore(self.workers * 4)
+        self.__lock = threading.Lock()
+
+        self.tiles = 0
+        self.recompressed = 0
+        self.errors = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def submit(self, data: bytes, callback: Callable[[bytes], None]):
+        self.__slots.acquire()
+        try:
+            future = self.__pool.submit(recompressTile, data, self.policy)
+        except RuntimeError:
+            # the pool was shut down
+            self.__slots.release()
+            callback(data)
+            return
+        future.add_done_callback(lambda future: self.__finished(data, future, callback))
+
+    def __finished(self, data: bytes, future: Future, callback: Callable[[bytes], None]):
+        self.__slots.release()
+        if future.cancelled():
+            callback(data)
+            return
+        try:
+            result = future.result()
+        except Exception:
+            result = None
+        with self.__lock:
+            self.tiles += 1
+            self.bytesIn += len(data)
+            if result is None:
+                self.errors += 1
+                result = data
+            elif result != data:
+                self.recompressed += 1
+            self.bytesOut += len(result)
+        callback(result)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """ Returns the number of tiles, how many of them were stored recompressed and failed,
+            the bytes before and after and the ratio of both """
+        with self.__lock:
+            return {"tiles": self.tiles,
+                    "recompressed": self.recompressed,
+                    "errors": self.errors,
+                    "bytesIn": self.bytesIn,
+                    "bytesOut": self.bytesOut,
+                    "ratio": self.bytesOut / self.bytesIn if self.bytesIn else 1.0}
+
+    def shutdown(self, wait: bool = True):
+        """ tiles that were not started yet are given to their callbacks unchanged """
+        self.__pool.shutdown(wait=wait, cancel_futures=True)
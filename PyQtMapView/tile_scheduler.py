@@ -0,0 +1,91 @@
+import heapq
+import itertools
+import threading
+from typing import Callable, Dict, Hashable, List, Tuple, Union
+
+
+class TileLoadScheduler:
+    """ Thread-safe priority queue of tile load tasks.
+
+        A task is a tile key (zoom, x, y) with the canvas tile waiting for it, ordered by a
+        priority where lower values are loaded first. Queuing a key that is already waiting
+        replaces its tile. Worker threads block in get() until a task is available or the
+        scheduler is closed. """
+
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__heap: List[list] = []  # entry: [priority, sequence, key, tile, valid]
+        self.__entries: Dict[Hashable, list] = {}
+        self.__sequence = itertools.count()
+        self.__closed = False
+
+        self.cancelled = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def put(self, key: Tuple[int, int, int], tile, priority):
+        """ Queues a tile key, a better priority of an already queued key is kept """
+        with self.__condition:
+            old = self.__entries.get(key)
+            if old is not None:
+                if old[0] <= priority:
+                    old[3] = tile
+                    return
+                old[4] = False
+            entry = [priority, next(self.__sequence), key, tile, True]
+            self.__entries[key] = entry
+            heapq.heappush(self.__heap, entry)
+            self.__condition.notify()
+
+    def get(self, timeout: Union[float, None] = None) -> Union[Tuple[Tuple[int, int, int], object], None]:
+        """ Blocks until a task is available and returns (key, tile),
+            returns None if the scheduler was closed or the timeout expired """
+        with self.__condition:
+            while True:
+                while self.__heap and not self.__heap[0][4]:
+                    heapq.heappop(self.__heap)
+                if self.__closed:
+                    return None
+                if self.__heap:
+                    entry = heapq.heappop(self.__heap)
+                    del self.__entries[entry[2]]
+                    return entry[2], entry[3]
+                if not self.__condition.wait(timeout):
+                    return None
+
+    def cancel(self, predicate: Callable[[Tuple[int, int, int]], bool]) -> int:
+        """ Drops every queued task whose key matches the predicate, returns the number of dropped tasks """
+        with self.__condition:
+            keys = [key for key in self.__entries if predicate(key)]
+            for key in keys:
+                self.__entries.pop(key)[4] = False
+            self.cancelled += len(keys)
+            if len(self.__heap) > 2 * len(self.__entries) + 64:
+                self.__compact()
+            return len(keys)
+
+    def cancelStaleZoom(self, zoom: int) -> int:
+        """ Drops all tasks that do not belong to the given zoom level """
+        return self.cancel(lambda key: key[0] != zoom)
+
+    def clear(self) -> int:
+        return self.cancel(lambda key: True)
+
+    def reprioritize(self, priority: Callable[[Tuple[int, int, int]], object]):
+        """ Recomputes the priority of every queued task, e.g. after the view center moved """
+        with self.__condition:
+            self.__heap = [entry for entry in self.__heap if entry[4]]
+            for entry in self.__heap:
+                entry[0] = priority(entry[2])
+            heapq.heapify(self.__heap)
+
+    def close(self):
+        """ Wakes up all waiting workers, get() returns None from now on """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+    def __compact(self):
+        self.__heap = [entry for entry in self.__heap if entry[4]]
+        heapq.heapify(self.__heap)
@@ -0,0 +1,146 @@
+import hashlib
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Mapping, Sequence, Union
+
+
+READ_MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file mapped into memory by every reader
+STATEMENT_CACHE_SIZE = 64  # prepared statements kept per connection
+
+
+def tileHash(data: bytes) -> str:
+    """ content address of encoded tile data, identical tiles get the same hash """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def selectLegacyServer(connection: sqlite3.Connection, path: str, server: Union[str, None] = None) -> str:
+    """ returns the tile server to export from an offline database of the old format (tables tiles/server),
+        server may be omitted if the database contains a single server """
+    servers = [row[0] for row in connection.execute("SELECT DISTINCT server FROM tiles;")]
+    if server is None:
+        if len(servers) != 1:
+            raise ValueError(f"{path} contains {len(servers)} tile servers, choose one of: {', '.join(servers)}")
+        return servers[0]
+    if server not in servers:
+        raise ValueError(f"{path} contains no tiles of {server}")
+    return server
+
+
+def connectReader(path: str) -> sqlite3.Connection:
+    """ read-only connection for tile lookups: the file is memory mapped and the lookup statements
+        stay prepared in the connection's statement cache, so repeated lookups only bind parameters """
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=10, cached_statements=STATEMENT_CACHE_SIZE)
+    try:
+        connection.execute(f"PRAGMA mmap_size={READ_MMAP_SIZE};")
+    except sqlite3.DatabaseError:
+        pass  # not a database, lookups will fail the same way
+    return connection
+
+
+def connectWriter(path: str) -> sqlite3.Connection:
+    """ connection in WAL mode, readers are not blocked while it writes and a commit needs no fsync of the database """
+    connection = sqlite3.connect(path, timeout=30, cached_statements=STATEMENT_CACHE_SIZE)
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.execute("PRAGMA synchronous=NORMAL;")
+    return connection
+
+
+class BatchedTileWriter:
+    """ Single writer thread of a tile database.
+
+        Rows given to put() are inserted with the statement, or with each of several statements
+        taking named parameters from mapping rows, and committed in a transaction per batch once
+        batchSize rows are queued or flushInterval seconds have passed. put() never blocks on the
+        database, flush() waits until everything queued is committed. """
+
+    def __init__(self, path: str, statement: Union[str, Sequence[str]], batchSize: int = 500, flushInterval: float = 0.5):
+        self.path = path
+        self.statements = [statement] if isinstance(statement, str) else list(statement)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+
+        self.__queue: "queue.Queue[Union[tuple, None]]" = queue.Queue()
+        self.__lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.commitTime = 0.0
+
+        self.__thread = threading.Thread(daemon=True, target=self.__writeLoop, name="BatchedTileWriter")
+        self.__thread.start()
+
+    def put(self, row: Union[Sequence, Mapping]):
+        self.__queue.put(("row", row))
+
+    def flush(self, timeout: Union[float, None] = None) -> bool:
+        """ waits until every queued row is committed """
+        event = threading.Event()
+        self.__queue.put(("flush", event))
+        return event.wait(timeout)
+
+    def close(self):
+        if self.__thread.is_alive():
+            self.flush()
+            self.__queue.put(None)
+            self.__thread.join()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """ Returns rows written and queued, the number of committed batches, failed batches and seconds spent committing """
+        with self.__lock:
+            return {"written": self.written,
+                    "queued": self.__queue.qsize(),
+                    "batches": self.batches,
+                    "errors": self.errors,
+                    "commitTime": self.commitTime}
+
+    def __writeLoop(self):
+        connection = connectWriter(self.path)
+        running = True
+        while running:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < self.batchSize and batch[-1] is not None and batch[-1][0] != "flush":
+                try:
+                    batch.append(self.__queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+
+            rows = [operation[1] for operation in batch if operation[0] == "row"]
+            if rows:
+                self.__commit(connection, rows)
+            for operation in batch:
+                if operation[0] == "flush":
+                    operation[1].set()
+        connection.close()
+
+    def __commit(self, connection: sqlite3.Connection, rows: list):
+        start = time.monotonic()
+        for attempt in range(5):
+            try:
+                with connection:
+                    for statement in self.statements:
+                        connection.executemany(statement, rows)
+                break
+            except sqlite3.OperationalError as err:
+                # another process holds the write lock
+                if attempt == 4:
+                    sys.stderr.write(f"{self.path}: {len(rows)} tiles not written: {err}\n")
+                    with self.__lock:
+                        self.errors += 1
+                    return
+                time.sleep(0.1 * 2 ** attempt)
+            except sqlite3.Error as err:
+                sys.stderr.write(f"{self.path}: {len(rows)} tiles not written: {err}\n")
+                with self.__lock:
+                    self.errors += 1
+                return
+        with self.__lock:
+            self.written += len(rows)
+            self.batches += 1
+            self.commitTime += time.monotonic() - start
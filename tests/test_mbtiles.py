@@ -0,0 +1,109 @@
+import sqlite3
+
+from PyQtMapView.mbtiles import MBTilesStore, imageFormat, isMBTiles, tmsRow
+
+PNG = b"\x89PNG\r\n\x1a\n"
+
+
+def tile(name: bytes) -> bytes:
+    return PNG + name
+
+
+def test_tms_row_flip():
+    assert tmsRow(0, 0) == 0
+    assert tmsRow(1, 0) == 1
+    assert tmsRow(3, 2) == 5
+    for y in range(16):
+        assert tmsRow(4, tmsRow(4, y)) == y
+
+
+def test_rows_are_stored_in_tms_order(tmp_path):
+    path = str(tmp_path / "tiles.mbtiles")
+    store = MBTilesStore(path)
+    store.putTile(3, 1, 2, tile(b"a"))
+    store.commit()
+    assert store.getTile(3, 1, 2) == tile(b"a")
+    assert store.hasTile(3, 1, 2) and not store.hasTile(3, 1, 5)
+    assert list(store.tilesInColumns(3, 0, 7)) == [(1, 2)]
+    store.close()
+
+    assert isMBTiles(path)
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT zoom_level, tile_column, tile_row FROM tiles;").fetchall() == [(3, 1, 5)]
+    connection.close()
+
+
+def test_deduplicated_writes(tmp_path):
+    path = str(tmp_path / "tiles.mbtiles")
+    store = MBTilesStore(path, deduplicate=True)
+    store.putTiles([(5, 0, y, tile(b"sea")) for y in range(10)] + [(5, 1, 0, tile(b"land"))])
+    store.commit()
+    connection = store.connection()
+    assert connection.execute("SELECT COUNT(*) FROM images;").fetchone()[0] == 2
+    assert connection.execute("SELECT COUNT(*) FROM map;").fetchone()[0] == 11
+    assert store.getTile(5, 0, 9) == tile(b"sea")
+    assert store.getTile(5, 1, 0) == tile(b"land")
+    assert store.hasTile(5, 0, 3)
+    store.close()
+
+    # the layout of an existing file is kept
+    store = MBTilesStore(path)
+    assert store.deduplicated
+    store.close()
+
+
+def test_replaced_tiles_release_their_images(tmp_path):
+    store = MBTilesStore(str(tmp_path / "tiles.mbtiles"), deduplicate=True)
+    store.putTiles([(2, 0, 0, tile(b"a")), (2, 0, 1, tile(b"a")), (2, 1, 0, tile(b"b"))])
+    store.commit()
+    connection = store.connection()
+
+    def images():
+        return {row[0] for row in connection.execute("SELECT tile_data FROM images;")}
+
+    # still used by another tile
+    store.putTile(2, 0, 0, tile(b"c"))
+    store.commit()
+    assert images() == {tile(b"a"), tile(b"b"), tile(b"c")}
+
+    store.putTile(2, 0, 1, tile(b"c"))
+    store.commit()
+    assert images() == {tile(b"b"), tile(b"c")}
+
+    # an image released and used again in the same batch is kept
+    store.putTiles([(2, 1, 0, tile(b"c")), (2, 1, 1, tile(b"b"))])
+    store.commit()
+    assert images() == {tile(b"b"), tile(b"c")}
+    assert store.getTile(2, 1, 1) == tile(b"b")
+    assert store.removeUnusedImages() == 0
+    store.close()
+
+
+def test_queued_tiles(tmp_path):
+    store = MBTilesStore(str(tmp_path / "tiles.mbtiles"), deduplicate=True)
+    for y in range(100):
+        store.queueTile(8, 3, y, tile(bytes([y % 7])))
+    store.flush()
+    assert store.writerStats()["written"] == 100
+    assert store.connection().execute("SELECT COUNT(*) FROM images;").fetchone()[0] == 7
+    assert sorted(y for _, y in store.tilesInColumns(8, 3, 3)) == list(range(100))
+    store.close()
+
+
+def test_metadata(tmp_path):
+    store = MBTilesStore(str(tmp_path / "tiles.mbtiles"))
+    store.setMetadata({"name": "test", "tile_server": "http://example/{z}/{x}/{y}.png"})
+    store.extendMetadata(5, 7, (1.0, 2.0, 3.0, 4.0))
+    store.extendMetadata(3, 6, (0.5, 2.5, 3.5, 3.0))
+    metadata = store.metadata()
+    assert (metadata["minzoom"], metadata["maxzoom"]) == ("3", "7")
+    assert [float(value) for value in metadata["bounds"].split(",")] == [0.5, 2.0, 3.5, 4.0]
+    assert store.servesTileServer("http://example/{z}/{x}/{y}.png")
+    assert not store.servesTileServer("http://other/{z}/{x}/{y}.png")
+    store.close()
+
+
+def test_image_format():
+    assert imageFormat(tile(b"")) == "png"
+    assert imageFormat(b"\xff\xd8\xff\xe0") == "jpg"
+    assert imageFormat(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "webp"
@@ -0,0 +1,81 @@
+from PyQtMapView.tile_cache import TileCache
+
+
+def key(y):
+    return "server", 10, 0, y
+
+
+def test_evicts_least_recently_used_over_budget():
+    cache = TileCache(maxBytes=30, sizeOf=len)
+    for y in range(3):
+        cache.put(key(y), bytes(10))
+    assert cache.get(key(0)) is not None  # key(1) is now the least recently used
+    cache.put(key(3), bytes(10))
+    assert key(1) not in cache
+    assert all(key(y) in cache for y in (0, 2, 3))
+    stats = cache.stats()
+    assert stats["bytes"] == 30 and stats["entries"] == 3 and stats["evictions"] == 1
+
+
+def test_replacing_a_key_updates_the_size():
+    cache = TileCache(maxBytes=100, sizeOf=len)
+    cache.put(key(0), bytes(40))
+    cache.put(key(0), bytes(10))
+    assert cache.stats()["bytes"] == 10
+    assert len(cache) == 1
+
+
+def test_pinned_tiles_are_not_evicted():
+    cache = TileCache(maxBytes=20, sizeOf=len)
+    for y in range(2):
+        cache.put(key(y), bytes(10))
+    cache.setPinned([key(0), key(1)])
+    cache.put(key(2), bytes(10))
+    assert key(0) in cache and key(1) in cache
+    assert key(2) not in cache
+
+    # over budget while everything is pinned, evicted once unpinned
+    cache.setPinned([key(0), key(1), key(2)])
+    cache.put(key(2), bytes(10))
+    assert cache.stats()["bytes"] == 30
+    cache.setPinned([key(2)])
+    assert key(2) in cache
+    assert cache.stats()["bytes"] <= 20
+
+
+def test_shared_image_is_counted_once():
+    cache = TileCache(maxBytes=25, sizeOf=len)
+    image = bytearray(10)
+    for y in range(4):
+        cache.put(key(y), image)
+    assert cache.stats()["bytes"] == 10
+    assert len(cache) == 4
+
+    cache.remove(key(0))
+    assert cache.stats()["bytes"] == 10
+    for y in range(1, 4):
+        cache.remove(key(y))
+    assert cache.stats()["bytes"] == 0
+
+
+def test_shared_image_is_freed_with_its_last_key():
+    cache = TileCache(maxBytes=20, sizeOf=len)
+    image = bytearray(10)
+    cache.put(key(0), image)
+    cache.put(key(1), image)
+    cache.put(key(2), bytearray(10))
+    cache.put(key(3), bytearray(10))
+    # evicting key(0) frees nothing while key(1) holds the shared image, so both go
+    assert key(0) not in cache and key(1) not in cache
+    assert key(2) in cache and key(3) in cache
+    assert cache.stats()["bytes"] == 20
+
+
+def test_hit_rate_and_clear():
+    cache = TileCache(maxBytes=100, sizeOf=len)
+    cache.put(key(0), b"x")
+    assert cache.get(key(0)) == b"x"
+    assert cache.get(key(1), False) is False
+    assert cache.stats()["hitRate"] == 0.5
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()["bytes"] == 0
@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from PyQtMapView.tile_estimate import stratifiedEstimate, stratifiedSample, stratumSizes
+from PyQtMapView.tile_ranges import spanTiles
+
+SPANS = [(x, 10, 10 + x % 5) for x in range(40)]
+
+
+def test_small_selection_is_sampled_completely():
+    spans = [(1, 0, 2), (2, 5, 5)]
+    sample = stratifiedSample(spans, 10, 5)
+    assert [(x, y) for _, x, y in sample] == [(1, 0), (1, 1), (1, 2), (2, 5)]
+    assert stratumSizes(4, 5, 10) == {0: 4}
+    assert stratifiedSample([], 10, 5) == []
+
+
+def test_sample_is_spread_over_the_strata():
+    tiles = [(x, y) for _, x, y in spanTiles(0, SPANS)]
+    sample = stratifiedSample(SPANS, 16, 8, random.Random(1))
+    assert len(sample) == 16
+    assert len({(x, y) for _, x, y in sample}) == 16
+    sizes = stratumSizes(len(tiles), 8, 16)
+    assert sum(sizes.values()) == len(tiles)
+    # every stratum is a block of neighbouring tiles in span order and gets two samples
+    start = 0
+    for stratum in range(8):
+        block = tiles[start:start + sizes[stratum]]
+        drawn = [(x, y) for s, x, y in sample if s == stratum]
+        assert len(drawn) == 2
+        assert all(tile in block for tile in drawn)
+        start += sizes[stratum]
+
+
+def test_sample_is_reproducible():
+    assert stratifiedSample(SPANS, 16, 8, random.Random(3)) == stratifiedSample(SPANS, 16, 8, random.Random(3))
+
+
+def test_estimate_weights_the_strata():
+    mean, error = stratifiedEstimate({0: [10.0, 10.0], 1: [30.0, 30.0]}, {0: 300, 1: 100})
+    assert mean == pytest.approx(15.0)
+    assert error == 0.0
+
+
+def test_estimate_of_a_completely_sampled_stratum_has_no_error():
+    mean, error = stratifiedEstimate({0: [1.0, 2.0, 3.0]}, {0: 3})
+    assert mean == pytest.approx(2.0)
+    assert error == 0.0
+
+
+def test_estimate_covers_the_population_mean():
+    generator = random.Random(7)
+    population = [generator.gauss(20000, 5000) for _ in range(4000)]
+    spans = [(0, 0, len(population) - 1)]
+    sizes = stratumSizes(len(population), 16, 32)
+    values = {}
+    for stratum, _, y in stratifiedSample(spans, 32, 16, generator):
+        values.setdefault(stratum, []).append(population[y])
+    mean, error = stratifiedEstimate(values, sizes)
+    assert error > 0
+    assert abs(mean - sum(population) / len(population)) < 2 * error
+
+
+def test_estimate_without_values():
+    assert stratifiedEstimate({}, {0: 10}) == (0.0, 0.0)
+    assert stratifiedEstimate({0: []}, {0: 10}) == (0.0, 0.0)
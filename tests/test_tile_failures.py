@@ -0,0 +1,66 @@
+import threading
+import time
+
+from PyQtMapView.tile_failures import NegativeTileCache, ServerCircuitBreaker, retryAfterSeconds
+
+
+def test_negative_cache_expires():
+    cache = NegativeTileCache(ttls={"error": 0.05})
+    cache.put("a", "error")
+    cache.put("b", "missing")
+    assert cache.get("a") == "error" and "b" in cache
+    time.sleep(0.06)
+    assert "a" not in cache
+    assert cache.get("b") == "missing"
+
+
+def test_breaker_opens_after_the_threshold():
+    breaker = ServerCircuitBreaker(failureThreshold=3, baseDelay=0.05, maxDelay=0.05)
+    for _ in range(2):
+        breaker.failure()
+        assert breaker.allowRequest()
+        assert breaker.backoff() > 0
+    breaker.failure()
+    assert breaker.state == breaker.OPEN
+    assert breaker.isOpen() and not breaker.allowRequest()
+
+    time.sleep(0.06)
+    assert breaker.allowRequest()  # the probe
+    assert breaker.state == breaker.HALF_OPEN
+    assert not breaker.allowRequest()
+    breaker.success()
+    assert breaker.state == breaker.CLOSED and breaker.allowRequest()
+
+
+def test_failures_of_requests_sent_before_opening_do_not_extend_the_delay():
+    breaker = ServerCircuitBreaker(failureThreshold=1, baseDelay=1.0)
+    breaker.failure()
+    for _ in range(10):
+        breaker.failure()
+    assert breaker.failures == 1
+    assert breaker.stats()["retryIn"] <= 1.0
+
+
+def test_waiting_requests_are_woken_when_the_probe_completes():
+    breaker = ServerCircuitBreaker(failureThreshold=1, baseDelay=0.05, maxDelay=0.05)
+    breaker.failure()
+    assert breaker.waitForRequest(1.0)  # the probe, once the delay has passed
+    assert not breaker.waitForRequest(0.05)
+
+    results = []
+    waiters = [threading.Thread(target=lambda: results.append(breaker.waitForRequest(5.0))) for _ in range(4)]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.05)
+    start = time.monotonic()
+    breaker.success()
+    for waiter in waiters:
+        waiter.join(5)
+    assert results == [True] * 4
+    assert time.monotonic() - start < 1.0
+
+
+def test_retry_after():
+    assert retryAfterSeconds({"retry-after": "7"}) == 7.0
+    assert retryAfterSeconds({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+    assert retryAfterSeconds({}) is None
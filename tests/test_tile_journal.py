@@ -0,0 +1,47 @@
+import pytest
+
+from PyQtMapView.tile_journal import SeedJournal, seedJobId
+
+JOB = {"tile_server": "http://example/{z}/{x}/{y}.png", "zoom_a": 3, "zoom_b": 5, "position_a": (56.6, 84.6)}
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "job.journal")
+    journal = SeedJournal(path, JOB)
+    assert journal.resumed == 0
+    for y in range(4):
+        journal.markDone(5, 2, y)
+    journal.markDone(5, 3, 1)
+    journal.save()
+
+    resumed = SeedJournal(path, dict(JOB))
+    assert resumed.resumed == len(resumed) == 5
+    assert list(resumed.remaining(5, [(2, 0, 7), (3, 0, 2), (4, 0, 1)])) == [(2, 4, 7), (3, 0, 0), (3, 2, 2), (4, 0, 1)]
+    assert list(resumed.remaining(4, [(2, 0, 1)])) == [(2, 0, 1)]
+
+    resumed.remove()
+    assert not (tmp_path / "job.journal").exists()
+    assert SeedJournal(path, JOB).resumed == 0
+
+
+def test_journal_of_another_job(tmp_path):
+    path = str(tmp_path / "job.journal")
+    SeedJournal(path, JOB).save()
+    with pytest.raises(ValueError):
+        SeedJournal(path, dict(JOB, zoom_b=6))
+
+
+def test_save_replaces_the_journal(tmp_path):
+    path = str(tmp_path / "nested" / "job.journal")
+    journal = SeedJournal(path, JOB)
+    journal.markDone(3, 1, 1)
+    journal.save()
+    journal.markDone(3, 1, 2)
+    journal.save()
+    assert not (tmp_path / "nested" / "job.journal.part").exists()
+    assert len(SeedJournal(path, JOB)) == 2
+
+
+def test_job_id():
+    assert seedJobId(JOB) == seedJobId(dict(reversed(list(JOB.items()))))
+    assert seedJobId(JOB) != seedJobId(dict(JOB, zoom_b=6))
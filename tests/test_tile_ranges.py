@@ -0,0 +1,164 @@
+import math
+
+from PyQtMapView.tile_ranges import TileRangeSet, circleSpans, corridorSpans, countSpanTiles, polygonSpans, rectangleSpans, spanTiles
+from PyQtMapView.utility_functions import decimal_to_osm
+
+
+def spanSet(zoom, spans):
+    return set(spanTiles(zoom, spans))
+
+
+def checkMerged(spans):
+    # columns in order, rows of a column sorted, not overlapping and not touching
+    spans = list(spans)
+    for (x0, first0, final0), (x1, first1, final1) in zip(spans, spans[1:]):
+        assert x0 <= x1
+        if x0 == x1:
+            assert final0 + 1 < first1
+    for x, first, final in spans:
+        assert first <= final
+    return spans
+
+
+def insidePolygon(point, polygon):
+    x, y = point
+    inside = False
+    for index in range(len(polygon)):
+        (x0, y0), (x1, y1) = polygon[index - 1], polygon[index]
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+
+def segmentDistance(point, a, b):
+    (x, y), (x0, y0), (x1, y1) = point, a, b
+    length = (x1 - x0) ** 2 + (y1 - y0) ** 2
+    t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - x0) * (x1 - x0) + (y - y0) * (y1 - y0)) / length))
+    return math.hypot(x - (x0 + t * (x1 - x0)), y - (y0 + t * (y1 - y0)))
+
+
+def test_rectangle_spans():
+    zoom = 10
+    upperLeft, lowerRight = (56.6, 84.6), (56.3, 85.2)
+    spans = list(rectangleSpans(upperLeft, lowerRight, zoom))
+    (left, top), (right, bottom) = decimal_to_osm(*upperLeft, zoom), decimal_to_osm(*lowerRight, zoom)
+    assert [x for x, _, _ in spans] == list(range(math.floor(left), math.ceil(right) + 1))
+    assert all((first, final) == (math.floor(top), math.ceil(bottom)) for _, first, final in spans)
+    assert countSpanTiles(spans) == len(spanSet(zoom, spans))
+
+
+def test_circle_spans_match_the_circle_equation():
+    zoom, center, radius = 14, (56.47, 84.95), 5.0
+    spans = list(circleSpans(center, radius, zoom))
+    tiles = list(spanTiles(zoom, spans))
+    # every tile once
+    assert len(tiles) == len(set(tiles)) == countSpanTiles(spans)
+
+    upperLeft = decimal_to_osm(center[0] + radius / 111.0, center[1] - radius / (111.0 * math.cos(math.radians(center[0]))), zoom)
+    centerTile = decimal_to_osm(*center, zoom)
+    centerX, centerY = round(centerTile[0]), round(centerTile[1])
+    radiusSquared = round(upperLeft[0] - centerTile[0]) ** 2
+    inside = {(zoom, x, y) for x in range(centerX - 100, centerX + 101) for y in range(centerY - 100, centerY + 101)
+              if (x - centerX) ** 2 + (y - centerY) ** 2 <= radiusSquared}
+    assert set(tiles) == inside
+
+
+def test_circle_spans_stay_inside_the_world():
+    zoom = 3
+    for x, first, final in circleSpans((80.0, -179.5), 500.0, zoom):
+        assert 0 <= x < 1 << zoom
+        assert 0 <= first <= final < 1 << zoom
+
+
+def test_add_merges_adjacent_rows():
+    tiles = TileRangeSet()
+    for y in (5, 7, 6, 3, 5):
+        tiles.add(10, 2, y)
+    assert len(tiles) == 4
+    assert tiles.toDict() == {"10": {"2": [3, 3, 5, 7]}}
+    tiles.add(10, 2, 4)
+    assert tiles.toDict() == {"10": {"2": [3, 7]}}
+    assert len(tiles) == 5
+
+
+def test_contains():
+    tiles = TileRangeSet()
+    for y in range(10, 20):
+        tiles.add(12, 7, y)
+    tiles.add(12, 7, 25)
+    assert (12, 7, 10) in tiles
+    assert (12, 7, 19) in tiles
+    assert (12, 7, 25) in tiles
+    assert (12, 7, 9) not in tiles
+    assert (12, 7, 20) not in tiles
+    assert (12, 8, 15) not in tiles
+    assert (11, 7, 15) not in tiles
+
+
+def test_subtract():
+    tiles = TileRangeSet()
+    for y in list(range(2, 5)) + list(range(8, 10)):
+        tiles.add(3, 1, y)
+    assert list(tiles.subtract(3, [(1, 0, 12), (2, 0, 1)])) == [(1, 0, 1), (1, 5, 7), (1, 10, 12), (2, 0, 1)]
+    assert list(tiles.subtract(3, [(1, 2, 4)])) == []
+    assert list(tiles.subtract(3, [(1, 3, 9)])) == [(1, 5, 7)]
+    assert list(tiles.subtract(4, [(1, 3, 9)])) == [(1, 3, 9)]
+
+
+def test_dict_round_trip():
+    tiles = TileRangeSet()
+    for zoom, x, y in [(1, 0, 0), (1, 0, 1), (5, 3, 7), (5, 3, 9), (5, 4, 9)]:
+        tiles.add(zoom, x, y)
+    copy = TileRangeSet.fromDict(tiles.toDict())
+    assert len(copy) == len(tiles) == 5
+    assert copy.toDict() == tiles.toDict()
+    assert (5, 3, 9) in copy and (5, 3, 8) not in copy
+    copy.add(5, 3, 8)
+    assert copy.toDict()["5"]["3"] == [7, 9]
+
+
+def test_polygon_covers_the_tiles_inside():
+    zoom = 12
+    corners = [(56.60, 84.60), (56.55, 85.20), (56.30, 85.10), (56.45, 84.90), (56.35, 84.70)]
+    spans = checkMerged(polygonSpans(corners, zoom))
+    tiles = spanSet(zoom, spans)
+    assert countSpanTiles(spans) == len(tiles)
+
+    polygon = [decimal_to_osm(*corner, zoom) for corner in corners]
+    xs, ys = [point[0] for point in polygon], [point[1] for point in polygon]
+    for x in range(math.floor(min(xs)) - 1, math.floor(max(xs)) + 2):
+        for y in range(math.floor(min(ys)) - 1, math.floor(max(ys)) + 2):
+            if insidePolygon((x + 0.5, y + 0.5), polygon):
+                assert (zoom, x, y) in tiles
+    for x, y in polygon:
+        assert (zoom, math.floor(x), math.floor(y)) in tiles
+    for _, x, y in tiles:
+        assert math.floor(min(xs)) <= x <= math.floor(max(xs))
+        assert math.floor(min(ys)) <= y <= math.floor(max(ys))
+
+
+def test_polygon_needs_three_corners():
+    assert list(polygonSpans([(56.6, 84.6), (56.3, 85.2)], 10)) == []
+
+
+def test_corridor_covers_the_tiles_along_the_line():
+    zoom = 15
+    points = [(56.50, 84.80), (56.45, 84.95), (56.47, 85.10)]
+    width = 1.0  # km
+    spans = checkMerged(corridorSpans(points, width, zoom))
+    tiles = spanSet(zoom, spans)
+
+    line = [decimal_to_osm(*point, zoom) for point in points]
+    # the width in tiles grows with the latitude
+    narrowest = width * (1 << zoom) / (40075.016686 * math.cos(math.radians(min(lat for lat, _ in points))))
+    widest = width * (1 << zoom) / (40075.016686 * math.cos(math.radians(max(lat for lat, _ in points))))
+    xs, ys = [point[0] for point in line], [point[1] for point in line]
+    for x in range(math.floor(min(xs)) - 5, math.floor(max(xs)) + 6):
+        for y in range(math.floor(min(ys)) - 5, math.floor(max(ys)) + 6):
+            distance = min(segmentDistance((x + 0.5, y + 0.5), a, b) for a, b in zip(line, line[1:]))
+            if distance <= narrowest:
+                assert (zoom, x, y) in tiles
+            # a tile is covered only if it is near the corridor: the octagons around the points
+            # reach a little further than width, a tile's center is at most half a diagonal away
+            if distance > widest / math.cos(math.pi / 8) + math.sqrt(0.5):
+                assert (zoom, x, y) not in tiles
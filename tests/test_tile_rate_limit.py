@@ -0,0 +1,82 @@
+import threading
+import time
+
+from PyQtMapView.tile_rate_limit import AimdConcurrencyLimit, TokenBucketLimiter
+
+
+def test_burst_then_rate():
+    limiter = TokenBucketLimiter(rate=100, burst=5, maxConcurrent=0)
+    start = time.monotonic()
+    for _ in range(5):
+        assert limiter.acquire() < 0.01
+        limiter.release()
+    for _ in range(5):
+        limiter.acquire()
+        limiter.release()
+    assert time.monotonic() - start >= 0.04
+    assert limiter.stats()["requests"] == 10
+
+
+def test_concurrency_limit():
+    limiter = TokenBucketLimiter(rate=0, burst=1, maxConcurrent=1)
+    limiter.acquire()
+    waiter = threading.Thread(target=limiter.acquire)
+    waiter.start()
+    time.sleep(0.05)
+    assert waiter.is_alive()
+    limiter.release()
+    waiter.join(1)
+    assert not waiter.is_alive()
+    limiter.release()
+    assert limiter.stats()["active"] == 0
+
+
+def test_concurrency_limit_and_stop():
+    limiter = TokenBucketLimiter(rate=0, burst=1, maxConcurrent=1)
+    stop = threading.Event()
+    assert limiter.acquire(stop) is not None
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(limiter.acquire(stop)))
+    waiter.start()
+    time.sleep(0.05)
+    assert waiter.is_alive()
+    stop.set()
+    waiter.join(1)
+    assert results == [None]
+    limiter.release()
+    assert limiter.stats()["active"] == 0
+
+
+def test_stop_during_the_token_delay_releases_the_slot():
+    limiter = TokenBucketLimiter(rate=1, burst=1, maxConcurrent=4)
+    limiter.acquire()
+    limiter.release()
+    stop = threading.Event()
+    threading.Timer(0.05, stop.set).start()
+    start = time.monotonic()
+    assert limiter.acquire(stop) is None
+    assert time.monotonic() - start < 0.5
+    assert limiter.stats()["active"] == 0
+
+
+def test_aimd_increases_and_decreases():
+    limit = AimdConcurrencyLimit(initial=4, maximum=8)
+    for _ in range(20):
+        assert limit.acquire()
+        limit.release(True, 0.01)
+    assert limit.limit > 4
+    increased = limit.limit
+    limit.acquire()
+    limit.release(False)
+    assert limit.limit == increased * 0.5
+
+
+def test_aimd_acquire_stops_and_cancel_keeps_the_limit():
+    limit = AimdConcurrencyLimit(initial=1, maximum=1)
+    stop = threading.Event()
+    assert limit.acquire(stop)
+    stop.set()
+    assert not limit.acquire(stop)
+    limit.cancel()
+    assert limit.stats()["active"] == 0
+    assert limit.limit == 1 and limit.stats()["successes"] == 0
@@ -0,0 +1,96 @@
+import threading
+
+from PyQtMapView.tile_scheduler import TileLoadScheduler
+
+
+def drain(scheduler):
+    tasks = []
+    while True:
+        task = scheduler.get(timeout=0)
+        if task is None:
+            return tasks
+        tasks.append(task)
+
+
+def test_lowest_priority_first():
+    scheduler = TileLoadScheduler()
+    scheduler.put((10, 1, 1), "a", 3)
+    scheduler.put((10, 2, 2), "b", 1)
+    scheduler.put((10, 3, 3), "c", 2)
+    assert len(scheduler) == 3
+    assert drain(scheduler) == [((10, 2, 2), "b"), ((10, 3, 3), "c"), ((10, 1, 1), "a")]
+    assert len(scheduler) == 0
+
+
+def test_equal_priorities_in_queue_order():
+    scheduler = TileLoadScheduler()
+    for y in range(5):
+        scheduler.put((10, 0, y), y, 0)
+    assert [tile for _, tile in drain(scheduler)] == [0, 1, 2, 3, 4]
+
+
+def test_queued_again_keeps_the_better_priority_and_the_new_tile():
+    scheduler = TileLoadScheduler()
+    scheduler.put((10, 1, 1), "old", 1)
+    scheduler.put((10, 2, 2), "other", 2)
+    scheduler.put((10, 1, 1), "new", 5)
+    assert len(scheduler) == 2
+    assert drain(scheduler) == [((10, 1, 1), "new"), ((10, 2, 2), "other")]
+
+    scheduler.put((10, 1, 1), "old", 5)
+    scheduler.put((10, 2, 2), "other", 2)
+    scheduler.put((10, 1, 1), "new", 1)
+    assert drain(scheduler) == [((10, 1, 1), "new"), ((10, 2, 2), "other")]
+
+
+def test_cancel():
+    scheduler = TileLoadScheduler()
+    for zoom in (10, 11):
+        for x in range(3):
+            scheduler.put((zoom, x, 0), None, x)
+    assert scheduler.cancel(lambda key: key[1] == 0) == 2
+    assert scheduler.cancelStaleZoom(11) == 2
+    assert [key for key, _ in drain(scheduler)] == [(11, 1, 0), (11, 2, 0)]
+    assert scheduler.cancelled == 4
+
+    for x in range(100):
+        scheduler.put((12, x, 0), None, x)
+    assert scheduler.clear() == 100
+    assert len(scheduler) == 0
+    assert drain(scheduler) == []
+
+
+def test_cancelled_key_can_be_queued_again():
+    scheduler = TileLoadScheduler()
+    scheduler.put((10, 1, 1), "a", 1)
+    scheduler.cancel(lambda key: True)
+    scheduler.put((10, 1, 1), "b", 7)
+    assert drain(scheduler) == [((10, 1, 1), "b")]
+
+
+def test_reprioritize():
+    scheduler = TileLoadScheduler()
+    for x in range(5):
+        scheduler.put((10, x, 0), None, x)
+    scheduler.cancel(lambda key: key[1] == 2)
+    scheduler.reprioritize(lambda key: -key[1])
+    assert [key[1] for key, _ in drain(scheduler)] == [4, 3, 1, 0]
+
+
+def test_close_wakes_waiting_workers():
+    scheduler = TileLoadScheduler()
+    results = []
+    workers = [threading.Thread(target=lambda: results.append(scheduler.get())) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    scheduler.close()
+    for worker in workers:
+        worker.join(5)
+        assert not worker.is_alive()
+    assert results == [None, None, None]
+    scheduler.put((10, 0, 0), None, 0)
+    assert scheduler.get() is None
+
+
+def test_get_times_out():
+    assert TileLoadScheduler().get(timeout=0.01) is None